@@ -56,9 +56,14 @@ class MechAliasedGroup(click.Group):
 @click.group(context_settings=utils.context_settings(), cls=MechAliasedGroup)
 @click.option('--debug', is_flag=True, default=False)
 @click.option('--cloud')
+@click.option('--connections', metavar='N', type=click.IntRange(min=1),
+              default=utils.DOWNLOAD_CONNECTIONS,
+              help='Number of connections used to download a box.')
+@click.option('--limit-rate', metavar='RATE',
+              help='Maximum speed to download boxes (ex: 500K, 10M).')
 @click.version_option(version=__version__, message='%(prog)s v%(version)s')
 @click.pass_context
-def cli(ctx, debug, cloud):
+def cli(ctx, debug, cloud, connections, limit_rate):
     '''Mech is a command line utility for virtual machine automation.
 
     Create, start, stop, destroy virtual machines (aka instances) with ease.
@@ -79,10 +84,17 @@ def cli(ctx, debug, cloud):
         LOGGER.setLevel(logging.DEBUG)
         LOGGER.debug('cloud:%s', cloud)
 
+    try:
+        limit_rate = utils.parse_rate(limit_rate)
+    except ValueError as exc:
+        sys.exit(click.style(str(exc), fg='red'))
+
     # ensure that ctx.obj exists and is a dict
     ctx.ensure_object(dict)
     ctx.obj['debug'] = debug
     ctx.obj['cloud_name'] = cloud
+    ctx.obj['connections'] = connections
+    ctx.obj['limit_rate'] = limit_rate
 
 
 @cli.command()
@@ -120,13 +132,19 @@ def list(ctx, detail, instance):
     LOGGER.debug('instances:%s', instances)
     mechfiles = utils.load_mechfile()
     LOGGER.debug('mechfiles:%s', mechfiles)
-    for name in instances:
+    insts = [MechInstance(name, mechfiles) for name in instances]
+    # ask each provider once for the state of all of its VMs
+    states = utils.vm_states(insts)
+    for inst in insts:
+        name = inst.name
         LOGGER.debug('name:%s', name)
-        inst = MechInstance(name, mechfiles)
         vm_state = 'unknown'
         if inst.created:
-            ip_address = inst.get_ip()
-            vm_state = inst.get_vm_state()
+            if name in states:
+                vm_state, ip_address = states[name]
+            else:
+                ip_address = inst.get_ip()
+                vm_state = inst.get_vm_state()
             if vm_state is None:
                 vm_state = 'unknown'
             if ip_address is None:
@@ -235,8 +253,14 @@ def port(ctx, instance):
 @cli.command()
 @click.argument('instance', required=False)
 @click.option('-s', '--show-only', is_flag=True, default=False)
+@click.option('-f', '--force', is_flag=True, default=False,
+              help='Run every step, even the ones already applied.')
+@click.option('--from-step', type=click.IntRange(min=1), metavar='N',
+              help='Run the steps from step N (1 is the first step).')
+@click.option('-p', '--parallel', metavar='N', type=int, default=utils.default_parallel,
+              help='Number of instances to provision at the same time.')
 @click.pass_context
-def provision(ctx, instance, show_only):
+def provision(ctx, instance, show_only, force, from_step, parallel):
     '''
     Provision the instance(s).
 
@@ -244,8 +268,16 @@ def provision(ctx, instance, show_only):
 
     Provision types are: 'file', 'shell' (Bash), 'ps' (Powershell), and 'pyinfra'.
 
+    'file' can copy a file, or a directory or glob pattern (ex: 'conf/*.conf')
+    in which case 'destination' is the directory to copy into.
+
     'shell' or 'ps' can be inline.
 
+    'shell' scripts are piped into 'bash -s' in the instance (the commands they
+    run read from /dev/null), unless they start with a '#!' line for another
+    interpreter. Add '"stream": false' to the
+    provisioning entry for scripts that need to be copied to a file first.
+
     'shell', 'ps', and 'pyinfra' can have a remote endpoint ('http', 'https', 'ftp') for the script.
     (ex: 'http://example.com/somefile.sh' or ex: 'ftp://foo.com/install.sh')
 
@@ -254,13 +286,25 @@ def provision(ctx, instance, show_only):
 
     Provisioning is run when the instance is started or you can re-run the provisioning.
 
+    Steps that were already applied (and whose entry and local files have not
+    changed since) are skipped. Use '--force' to run every step again, or
+    '--from-step N' to run the steps from step N on.
+
+    Without an instance, up to N ('parallel') instances are provisioned at the
+    same time (the steps of each instance still run in order), their output is
+    prefixed with the instance name, and a summary is shown at the end. When
+    all of them are provisioned at the same time, a 'pyinfra' step (same script
+    and args) shared by several instances is run once, with all of them in the
+    pyinfra inventory.
+
     An example of provisioning could be installing puppet (or your config tool of choice)
     or preparing the instance "just the way you want it".
 
     '''
 
     cloud_name = ctx.obj['cloud_name']
-    LOGGER.debug('cloud_name:%s show_only:%s instance:%s', cloud_name, show_only, instance)
+    LOGGER.debug('cloud_name:%s show_only:%s force:%s from_step:%s parallel:%s instance:%s',
+                 cloud_name, show_only, force, from_step, parallel, instance)
 
     if cloud_name:
         utils.cloud_run(cloud_name, ['provision'])
@@ -273,13 +317,36 @@ def provision(ctx, instance, show_only):
         # multiple instances
         instances = utils.instances()
 
-    for an_instance in instances:
-        inst = MechInstance(an_instance)
+    insts = {an_instance: MechInstance(an_instance) for an_instance in instances}
+    pyinfra_batch = None
+    if not show_only and len(instances) > 1 and parallel >= len(instances):
+        # all of the instances are provisioned at the same time, so their
+        # shared pyinfra steps can be run as one deploy
+        pyinfra_batch = utils.PyinfraBatch([inst for inst in insts.values() if inst.created])
 
-        if inst.created:
-            utils.provision(inst, show_only)
-        else:
+    def provision_instance(an_instance):
+        inst = insts[an_instance]
+
+        try:
+            if inst.created:
+                return utils.provision(inst, show_only, force=force, from_step=from_step,
+                                       pyinfra_batch=pyinfra_batch)
             click.echo('VM not created.')
+            return False
+        finally:
+            if pyinfra_batch is not None:
+                pyinfra_batch.leave(inst)
+
+    if parallel > 1 and len(instances) > 1:
+        results = utils.run_parallel(provision_instance, instances, parallel=parallel,
+                                     keep_going=True)
+        if not utils.report_parallel(results):
+            sys.exit(click.style('Not all instances were provisioned.', fg='red'))
+        return
+
+    results = [provision_instance(an_instance) for an_instance in instances]
+    if not all(results):
+        sys.exit(click.style('Not all instances were provisioned.', fg='red'))
 
 
 @cli.command()
@@ -420,13 +487,15 @@ def ssh_config(ctx, instance):
 
 @cli.command()
 @click.argument('instance', required=False)
+@click.option('-p', '--parallel', metavar='N', type=int, default=utils.default_parallel,
+              help='Number of instances to suspend at the same time.')
 @click.pass_context
-def suspend(ctx, instance):
+def suspend(ctx, instance, parallel):
     '''
     Suspends the instance(s).
     '''
     cloud_name = ctx.obj['cloud_name']
-    LOGGER.debug('cloud_name:%s instance:%s', cloud_name, instance)
+    LOGGER.debug('cloud_name:%s instance:%s parallel:%s', cloud_name, instance, parallel)
 
     if cloud_name:
         utils.cloud_run(cloud_name, ['suspend'])
@@ -439,34 +508,41 @@ def suspend(ctx, instance):
         # multiple instances
         instances = utils.instances()
 
-    for an_instance in instances:
+    def suspend_instance(an_instance):
         inst = MechInstance(an_instance)
 
         if inst.created:
             if inst.provider == 'vmware':
+                utils.ssh_stop_master(inst)
                 vmrun = VMrun(inst.vmx)
                 if vmrun.suspend() is None:
                     click.secho('Not suspended', fg='red')
-                else:
-                    click.secho('Suspended', fg='green')
-            else:
-                click.secho('Not sure equivalent command on this platform.', fg='red')
-                click.secho('If you know, please open issue on github.', fg='red')
+                    return False
+                click.secho('Suspended', fg='green')
+                return True
+            click.secho('Not sure equivalent command on this platform.', fg='red')
+            click.secho('If you know, please open issue on github.', fg='red')
         else:
             click.secho('VM has not been created.')
+        return False
+
+    results = utils.fan_out(suspend_instance, instances, parallel=parallel)
+    utils.check_fan_out(results, 'Not all instances were suspended.')
 
 
 @cli.command()
 @click.argument('instance', required=False)
 @click.option('--disable-shared-folders', is_flag=True, default=False)
+@click.option('-p', '--parallel', metavar='N', type=int, default=utils.default_parallel,
+              help='Number of instances to resume at the same time.')
 @click.pass_context
-def resume(ctx, instance, disable_shared_folders):
+def resume(ctx, instance, disable_shared_folders, parallel):
     '''
     Resume paused/suspended instance(s).
     '''
     cloud_name = ctx.obj['cloud_name']
-    LOGGER.debug('cloud_name:%s instance:%s disable_shared_folders:%s',
-                 cloud_name, instance, disable_shared_folders)
+    LOGGER.debug('cloud_name:%s instance:%s disable_shared_folders:%s parallel:%s',
+                 cloud_name, instance, disable_shared_folders, parallel)
 
     if cloud_name:
         utils.cloud_run(cloud_name, ['resume', 'unpause'])
@@ -479,16 +555,19 @@ def resume(ctx, instance, disable_shared_folders):
         # multiple instances
         instances = utils.instances()
 
-    for an_instance in instances:
+    def resume_instance(an_instance):
         inst = MechInstance(an_instance)
         inst.disable_shared_folders = disable_shared_folders
-        LOGGER.debug('instance:%s', instance)
+        LOGGER.debug('instance:%s', an_instance)
 
         # if we have started this instance before, try to unpause
         if inst.created:
-            utils.unpause_vm(inst)
-        else:
-            click.secho('VM not created', fg='red')
+            return utils.unpause_vm(inst)
+        click.secho('VM not created', fg='red')
+        return False
+
+    results = utils.fan_out(resume_instance, instances, parallel=parallel)
+    utils.check_fan_out(results, 'Not all instances were resumed.')
 
 
 @cli.command()
@@ -537,13 +616,15 @@ def upgrade(ctx, instance):
 
 @cli.command()
 @click.argument('instance', required=False)
+@click.option('-p', '--parallel', metavar='N', type=int, default=utils.default_parallel,
+              help='Number of instances to pause at the same time.')
 @click.pass_context
-def pause(ctx, instance):
+def pause(ctx, instance, parallel):
     '''
     Pauses the instance(s).
     '''
     cloud_name = ctx.obj['cloud_name']
-    LOGGER.debug('cloud_name:%s instance:%s', cloud_name, instance)
+    LOGGER.debug('cloud_name:%s instance:%s parallel:%s', cloud_name, instance, parallel)
 
     if cloud_name:
         utils.cloud_run(cloud_name, ['pause'])
@@ -556,38 +637,42 @@ def pause(ctx, instance):
         # multiple instances
         instances = utils.instances()
 
-    for an_instance in instances:
+    def pause_instance(an_instance):
         inst = MechInstance(an_instance)
 
         if inst.created:
+            utils.ssh_stop_master(inst)
             if inst.provider == 'vmware':
                 vmrun = VMrun(inst.vmx)
                 pause_results = vmrun.pause()
-                if pause_results is None:
-                    click.secho('Not paused', fg='red')
-                else:
-                    click.secho('Paused', fg='yellow')
             else:
                 vbm = VBoxManage()
                 pause_results = vbm.pause(inst.name)
-                if pause_results is None:
-                    click.secho('Not paused', fg='red')
-                else:
-                    click.secho('Paused', fg='yellow')
-        else:
-            click.secho('VM ({}) not created.'.format(an_instance), fg='red')
+            if pause_results is None:
+                click.secho('Not paused', fg='red')
+                return False
+            click.secho('Paused', fg='yellow')
+            return True
+        click.secho('VM ({}) not created.'.format(an_instance), fg='red')
+        return False
+
+    results = utils.fan_out(pause_instance, instances, parallel=parallel)
+    utils.check_fan_out(results, 'Not all instances were paused.')
 
 
 @cli.command()
 @click.argument('instance', required=False)
 @click.option('--force', '-f', is_flag=True, default=False, help='Force a hard stop.')
+@click.option('-p', '--parallel', metavar='N', type=int, default=utils.default_parallel,
+              help='Number of instances to stop at the same time.')
 @click.pass_context
-def down(ctx, instance, force):
+def down(ctx, instance, force, parallel):
     '''
     Stops the instance(s).
     '''
     cloud_name = ctx.obj['cloud_name']
-    LOGGER.debug('cloud_name:%s instance:%s force:%s', cloud_name, instance, force)
+    LOGGER.debug('cloud_name:%s instance:%s force:%s parallel:%s',
+                 cloud_name, instance, force, parallel)
 
     if cloud_name:
         utils.cloud_run(cloud_name, ['down', 'halt', 'stop'])
@@ -600,41 +685,49 @@ def down(ctx, instance, force):
         # multiple instances
         instances = utils.instances()
 
-    for an_instance in instances:
+    def down_instance(an_instance):
         inst = MechInstance(an_instance)
 
         if inst.created:
+            utils.ssh_stop_master(inst)
             if inst.provider == 'vmware':
                 vmrun = VMrun(inst.vmx)
                 if not force and vmrun.installed_tools():
                     stopped = vmrun.stop()
                 else:
                     stopped = vmrun.stop(mode='hard')
-                if stopped is None:
-                    click.secho('Not stopped', fg='red')
-                else:
-                    click.secho('Stopped', fg='green')
             else:
                 vbm = VBoxManage()
                 stopped = vbm.stop(vmname=inst.name, quiet=True)
-                if stopped is None:
-                    click.secho('Not stopped', fg='red')
-                else:
-                    click.secho('Stopped', fg='green')
-        else:
-            click.secho('VM ({}) not created.'.format(an_instance), fg='red')
+            inst.clear_runtime()
+            if stopped is None:
+                if utils.vm_running(inst) is False:
+                    click.secho('Already stopped', fg='yellow')
+                    return utils.SKIPPED
+                click.secho('Not stopped', fg='red')
+                return False
+            click.secho('Stopped', fg='green')
+            return True
+        click.secho('VM ({}) not created.'.format(an_instance), fg='red')
+        return utils.SKIPPED
+
+    results = utils.fan_out(down_instance, instances, parallel=parallel)
+    utils.check_fan_out(results, 'Not all instances were stopped.')
 
 
 @cli.command()
 @click.argument('instance', required=False)
 @click.option('-f', '--force', is_flag=True, default=False, help='Destroy without confirmation.')
+@click.option('-p', '--parallel', metavar='N', type=int, default=utils.default_parallel,
+              help='Number of instances to destroy at the same time.')
 @click.pass_context
-def destroy(ctx, instance, force):
+def destroy(ctx, instance, force, parallel):
     '''
     Stops and deletes all traces of the instances.
     '''
     cloud_name = ctx.obj['cloud_name']
-    LOGGER.debug('cloud_name:%s instance:%s force:%s', cloud_name, instance, force)
+    LOGGER.debug('cloud_name:%s instance:%s force:%s parallel:%s',
+                 cloud_name, instance, force, parallel)
 
     if cloud_name:
         utils.cloud_run(cloud_name, ['destroy'])
@@ -647,30 +740,57 @@ def destroy(ctx, instance, force):
         # multiple instances
         instances = utils.instances()
 
+    insts = []
     for an_instance in instances:
         inst = MechInstance(an_instance)
-
         if os.path.exists(inst.path):
-            if force or utils.confirm('Are you sure you want to delete {} '
-                                      'at {}'.format(inst.name, inst.path), default='n'):
-                click.secho('Deleting ({})...'.format(an_instance), fg='green')
-
-                if inst.provider == 'vmware':
-                    vmrun = VMrun(inst.vmx)
-                    vmrun.stop(mode='hard', quiet=True)
-                    vmrun.delete_vm()
-                else:
-                    vbm = VBoxManage()
-                    vbm.stop(vmname=inst.name, quiet=True)
-                    vbm.unregister(vmname=inst.name, quiet=True)
-
-                if os.path.exists(inst.path):
-                    shutil.rmtree(inst.path)
-                click.echo('Deleted')
-            else:
-                click.secho('Delete aborted.', fg='red')
+            insts.append(inst)
         else:
             click.secho('VM ({}) not created.'.format(an_instance), fg='red')
+    if not insts:
+        return
+
+    # ask once for the whole batch
+    if len(insts) == 1:
+        prompt = 'Are you sure you want to delete {} at {}'.format(insts[0].name, insts[0].path)
+    else:
+        prompt = 'Are you sure you want to delete {} at {}'.format(
+            ', '.join([inst.name for inst in insts]), utils.mech_dir())
+    if not force and not utils.confirm(prompt, default='n'):
+        click.secho('Delete aborted.', fg='red')
+        return
+
+    names = [inst.name for inst in insts]
+    insts = dict(zip(names, insts))
+
+    def destroy_instance(an_instance):
+        inst = insts[an_instance]
+        click.secho('Deleting ({})...'.format(an_instance), fg='green')
+        utils.ssh_stop_master(inst)
+        inst.clear_runtime()
+
+        if inst.provider == 'vmware':
+            vmrun = VMrun(inst.vmx)
+            vmrun.stop(mode='hard', quiet=True)
+            # a VM that is not running (ex: never started) is just files
+            failed = vmrun.delete_vm() is None and utils.vm_running(inst) is not False
+        else:
+            vbm = VBoxManage()
+            vbm.stop(vmname=inst.name, quiet=True)
+            # not a failure if virtualbox does not know the VM (anymore)
+            failed = (vbm.unregister(vmname=inst.name, quiet=True) is None
+                      and vbm.get_vm_info(inst.name, quiet=True) is not None)
+        if failed:
+            click.secho('Not deleted', fg='red')
+            return False
+
+        if os.path.exists(inst.path):
+            shutil.rmtree(inst.path)
+        click.echo('Deleted')
+        return True
+
+    results = utils.fan_out(destroy_instance, names, parallel=parallel)
+    utils.check_fan_out(results, 'Not all instances were deleted.')
 
 
 @cli.command()
@@ -716,12 +836,30 @@ def global_status(ctx, purge):
         vmrun = VMrun()
         if vmrun.installed():
             click.echo('===VMware VMs===')
-            click.echo(vmrun.list())
+            running = vmrun.running_vms()
+            if running is not None:
+                click.echo('Total running VMs: {}'.format(len(running)))
+                states = vmrun.vm_states(running, running=running)
+                for vmx in running:
+                    state, ip_address = states[vmx]
+                    click.echo('{}\t{}\t{}'.format(
+                        (ip_address or '').rjust(15),
+                        (state or 'unknown').rjust(12),
+                        vmx,
+                    ))
 
         vbm = VBoxManage()
         if vbm.installed():
             click.echo('===VirtualBox VMs===')
-            click.echo(vbm.list())
+            states = vbm.vm_states()
+            if states is not None:
+                for name in sorted(states):
+                    state, ip_address = states[name]
+                    click.echo('{}\t{}\t{}'.format(
+                        (ip_address or '').rjust(15),
+                        (state or 'unknown').rjust(12),
+                        name,
+                    ))
 
 
 @cli.command()
@@ -729,15 +867,21 @@ def global_status(ctx, purge):
 @click.option('--disable-provisioning', is_flag=True, default=False, help='Do not provision.')
 @click.option('--disable-shared-folders', is_flag=True, default=False, help='Do not share folders.')
 @click.option('--gui', is_flag=True, default=False, help='Start GUI, otherwise starts headless.')
+@click.option('-k', '--keep-going', is_flag=True, default=False,
+              help='Keep starting instances after one fails.')
+@click.option('--linked', is_flag=True, default=False,
+              help='Create instances as linked clones of a template VM.')
 @click.option('--memsize', metavar='MEMORY', help='Specify memory size in MB.')
 @click.option('--no-cache', is_flag=True, default=False, help='Do not save the downloaded box.')
 @click.option('--no-nat', is_flag=True, default=False,
               help='Do not use NAT networking (i.e., use bridged).')
 @click.option('--numvcpus', metavar='VCPUS', help='Specify number of vcpus.')
+@click.option('-p', '--parallel', metavar='N', type=int, default=1,
+              help='Number of instances to start at the same time.')
 @click.option('-r', '--remove-vagrant', is_flag=True, default=False, help='Remove vagrant user.')
 @click.pass_context
-def up(ctx, instance, disable_provisioning, disable_shared_folders, gui, memsize, no_cache,
-       no_nat, numvcpus, remove_vagrant):
+def up(ctx, instance, disable_provisioning, disable_shared_folders, gui, keep_going, linked,
+       memsize, no_cache, no_nat, numvcpus, parallel, remove_vagrant):
     '''
     Starts and provisions instance(s).
 
@@ -763,12 +907,24 @@ def up(ctx, instance, disable_provisioning, disable_shared_folders, gui, memsize
     guest VM which is what 'mech' uses to communicate with the VM.
     Be sure you can connect/admin the instance before using this option.
     Be sure to check that root cannot ssh, or change the root password.
+
+    Unless 'keep-going' is used, no more instances are started after one
+    fails. The 'parallel' option starts up to N instances at the same time.
+    Output is prefixed by the instance name and a summary is shown at
+    the end.
+
+    The 'linked' option (or "linked_clone": "true" in the Mechfile) creates
+    new instances as linked clones of a template VM, made once per box
+    version: they only store their changes to the box disks. Do not
+    remove the box while such instances exist.
     '''
     cloud_name = ctx.obj['cloud_name']
     LOGGER.debug('cloud_name:%s instance:%s disable_provisioning:%s disable_shared_folders:%s '
-                 'gui:%s memsize:%s no_cache:%s no_nat:%s numvcpus:%s remove_vagrant:%s',
+                 'gui:%s keep_going:%s linked:%s memsize:%s no_cache:%s no_nat:%s numvcpus:%s '
+                 'parallel:%s remove_vagrant:%s',
                  cloud_name, instance, disable_provisioning, disable_shared_folders,
-                 gui, memsize, no_cache, no_nat, numvcpus, remove_vagrant)
+                 gui, keep_going, linked, memsize, no_cache, no_nat, numvcpus, parallel,
+                 remove_vagrant)
 
     if cloud_name:
         utils.cloud_run(cloud_name, ['up', 'start'])
@@ -781,7 +937,7 @@ def up(ctx, instance, disable_provisioning, disable_shared_folders, gui, memsize
         # multiple instances
         instances = utils.instances()
 
-    for an_instance in instances:
+    def up_instance(an_instance):
         inst = MechInstance(an_instance)
 
         inst.gui = gui
@@ -791,7 +947,7 @@ def up(ctx, instance, disable_provisioning, disable_shared_folders, gui, memsize
         inst.no_nat = no_nat
 
         if not utils.report_provider(inst.provider):
-            return
+            return False
 
         location = inst.url
         if not location:
@@ -811,7 +967,12 @@ def up(ctx, instance, disable_provisioning, disable_shared_folders, gui, memsize
                 memsize=memsize,
                 no_nat=no_nat,
                 windows=inst.windows,
-                provider=inst.provider)
+                provider=inst.provider,
+                checksum=inst.checksum,
+                checksum_type=inst.checksum_type,
+                linked=linked or inst.linked_clone,
+                connections=ctx.obj.get('connections'),
+                limit_rate=ctx.obj.get('limit_rate'))
             if inst.provider == 'vmware':
                 inst.vmx = path_to_vmx_or_vbox
             else:
@@ -826,7 +987,23 @@ def up(ctx, instance, disable_provisioning, disable_shared_folders, gui, memsize
 
             inst.created = True
 
-        utils.start_vm(inst)
+        return utils.start_vm(inst)
+
+    if parallel > 1 and len(instances) > 1:
+        results = utils.run_parallel(up_instance, instances, parallel=parallel,
+                                     keep_going=keep_going)
+        if not utils.report_parallel(results):
+            sys.exit(click.style('Not all instances were started.', fg='red'))
+        return
+
+    failed = False
+    for an_instance in instances:
+        if not up_instance(an_instance):
+            failed = True
+            if not keep_going:
+                break
+    if failed:
+        sys.exit(click.style('Not all instances were started.', fg='red'))
 
 
 @cli.command()
@@ -90,7 +90,9 @@ def add(ctx, location, box_version, force, provider):
         sys.exit(click.style('Need to provide valid provider.', fg='red'))
 
     utils.add_box(name=None, box=None, location=location, box_version=box_version,
-                  force=force, provider=provider)
+                  force=force, provider=provider,
+                  connections=ctx.obj.get('connections'),
+                  limit_rate=ctx.obj.get('limit_rate'))
 
 
 @box.command()
@@ -155,6 +157,9 @@ def remove(ctx, name, provider, version):
 
     path = os.path.abspath(os.path.join(utils.mech_dir(), 'boxes', provider, name, version))
     if os.path.exists(path):
+        if not utils.remove_box_templates(path):
+            sys.exit(click.style("Not removed {} {}, instances are linked clones "
+                                 "of it".format(name, version), fg='red'))
         shutil.rmtree(path)
         print("Removed {} {}".format(name, version))
     else:
@@ -28,7 +28,6 @@ import sys
 
 
 import click
-from pypsrp.client import Client
 
 
 from . import utils
@@ -165,7 +164,5 @@ def fetch(ctx, remote, local, instance):
     inst = MechInstance(instance)
 
     if inst.created:
-        utils.suppress_urllib3_errors()
-        client = Client(inst.get_ip(), username=inst.user, password=inst.password, ssl=False)
-        client.fetch(remote, local)
+        utils.winrm_call(inst, 'fetch', remote, local)
         click.echo("Fetched")
@@ -5,6 +5,7 @@ import os
 import re
 
 from unittest.mock import patch, mock_open, MagicMock
+import click
 from click.testing import CliRunner
 
 import mech.mech
@@ -330,6 +331,36 @@ def test_mech_destroy(mock_locate, mock_load_mechfile,
     assert re.search(r'Deleted', result.output, re.MULTILINE)
 
 
+@patch('mech.utils.get_provider', return_value=None)
+@patch('os.path.exists', return_value=True)
+@patch('shutil.rmtree')
+@patch('mech.vmrun.VMrun.delete_vm', return_value=None)
+@patch('mech.vmrun.VMrun.stop', return_value=None)
+@patch('mech.utils.load_mechfile')
+@patch('mech.utils.locate', return_value='/tmp/first/some.vmx')
+def test_mech_destroy_delete_fails(mock_locate, mock_load_mechfile,
+                                   mock_vmrun_stop, mock_vmrun_delete_vm,
+                                   mock_rmtree, mock_path_exists, mock_get_provider,
+                                   mechfile_two_entries):
+    """Test 'mech destroy' when vmrun cannot delete the VM."""
+    mock_load_mechfile.return_value = mechfile_two_entries
+    runner = CliRunner()
+    # never started, its files are removed
+    with patch('mech.utils.vm_running', return_value=False):
+        result = runner.invoke(cli, ['destroy', '--force', 'first'])
+    mock_rmtree.assert_called()
+    assert re.search(r'Deleted', result.output, re.MULTILINE)
+    assert result.exit_code == 0
+
+    # still running, its files are kept
+    mock_rmtree.reset_mock()
+    with patch('mech.utils.vm_running', return_value=True):
+        result = runner.invoke(cli, ['destroy', '--force', 'first'])
+    mock_rmtree.assert_not_called()
+    assert re.search(r'Not deleted', result.output, re.MULTILINE)
+    assert result.exit_code == 1
+
+
 @patch('os.path.exists', return_value=True)
 @patch('shutil.rmtree')
 @patch('mech.vbm.VBoxManage.unregister')
@@ -374,6 +405,36 @@ def test_mech_destroy_prompted_and_answered_no(mock_locate, mock_load_mechfile,
         assert re.search(r'Delete aborted', result.output, re.MULTILINE)
 
 
+@patch('mech.utils.get_provider', return_value=None)
+@patch('os.path.exists', return_value=True)
+@patch('shutil.rmtree')
+@patch('mech.vmrun.VMrun.delete_vm')
+@patch('mech.vmrun.VMrun.stop', return_value=True)
+@patch('mech.utils.load_mechfile')
+@patch('mech.utils.locate', return_value='/tmp/first/some.vmx')
+def test_mech_destroy_all_prompted_once(mock_locate, mock_load_mechfile,
+                                        mock_vmrun_stop, mock_vmrun_delete_vm,
+                                        mock_rmtree, mock_path_exists,
+                                        mock_get_provider, mechfile_two_entries):
+    """Test 'mech destroy' of all instances asks only once."""
+    mock_load_mechfile.return_value = mechfile_two_entries
+    runner = CliRunner()
+    a_mock = MagicMock()
+    a_mock.return_value = 'Y'
+    with patch('mech.utils.input', a_mock):
+        result = runner.invoke(cli, ['destroy', '--parallel', '2'])
+        a_mock.assert_called_once()
+        assert re.search(r'delete first, second at', a_mock.call_args[0][0])
+        assert mock_vmrun_stop.call_count == 2
+        assert mock_vmrun_delete_vm.call_count == 2
+        assert [line for line in result.output.splitlines() if line.startswith('[')] == [
+            '[first ] Deleting (first)...',
+            '[first ] Deleted',
+            '[second] Deleting (second)...',
+            '[second] Deleted',
+        ]
+
+
 @patch('mech.utils.load_mechfile')
 @patch('mech.utils.locate', return_value=None)
 def test_mech_destroy_not_created(mock_locate, mock_load_mechfile,
@@ -387,6 +448,31 @@ def test_mech_destroy_not_created(mock_locate, mock_load_mechfile,
     assert re.search(r'not created', result.output, re.MULTILINE)
 
 
+@patch('mech.vmrun.VMrun.installed_tools', return_value='running')
+@patch('mech.vmrun.VMrun.stop', return_value=True)
+@patch('mech.utils.load_mechfile')
+@patch('mech.utils.locate', return_value='/tmp/first/some.vmx')
+def test_mech_down_parallel(mock_locate, mock_load_mechfile,
+                            mock_vmrun_stop, mock_installed_tools,
+                            mechfile_two_entries):
+    """Test 'mech down' of all instances reports in order."""
+    mock_load_mechfile.return_value = mechfile_two_entries
+    runner = CliRunner()
+    result = runner.invoke(cli, ['down', '--parallel', '2'])
+    assert mock_vmrun_stop.call_count == 2
+    assert [line for line in result.output.splitlines()
+            if line.startswith('[')] == ['[first ] Stopped', '[second] Stopped']
+    assert re.search(r'^first\s+ok', result.output, re.MULTILINE)
+    assert result.exit_code == 0
+
+    # one of them is not stopped
+    mock_vmrun_stop.side_effect = [True, None]
+    result = runner.invoke(cli, ['down', '--parallel', '1'])
+    assert re.search(r'^second\s+failed', result.output, re.MULTILINE)
+    assert re.search(r'Not all instances were stopped', result.output)
+    assert result.exit_code == 1
+
+
 @patch('mech.vmrun.VMrun.installed_tools', return_value='running')
 @patch('mech.vmrun.VMrun.stop', return_value=True)
 @patch('mech.utils.load_mechfile')
@@ -466,6 +552,25 @@ def test_mech_down_not_created(mock_locate, mock_load_mechfile,
     mock_locate.assert_called()
     mock_load_mechfile.assert_called()
     assert re.search(r' not created', result.output, re.MULTILINE)
+    assert re.search(r'^first\s+skipped', result.output, re.MULTILINE)
+    assert result.exit_code == 0
+
+
+@patch('mech.utils.vm_running', return_value=False)
+@patch('mech.vmrun.VMrun.installed_tools', return_value=False)
+@patch('mech.vmrun.VMrun.stop', return_value=None)
+@patch('mech.utils.load_mechfile')
+@patch('mech.utils.locate', return_value='/tmp/first/some.vmx')
+def test_mech_down_already_stopped(mock_locate, mock_load_mechfile, mock_vmrun_stop,
+                                   mock_installed_tools, mock_vm_running,
+                                   mechfile_two_entries):
+    """Test 'mech down' of an instance that is already stopped."""
+    mock_load_mechfile.return_value = mechfile_two_entries
+    runner = CliRunner()
+    result = runner.invoke(cli, ['down', 'first'])
+    mock_vm_running.assert_called()
+    assert re.search(r'Already stopped', result.output, re.MULTILINE)
+    assert result.exit_code == 0
 
 
 @patch('mech.utils.load_mechfile')
@@ -650,6 +755,54 @@ def test_mech_provision_shell(mock_locate, mock_load_mechfile,
     assert re.search(r' Provision ', result.output, re.MULTILINE)
 
 
+@patch('mech.utils.provision')
+@patch('mech.utils.load_mechfile', return_value=MECHFILE_WITH_PROVISIONING)
+@patch('mech.utils.locate', return_value='/tmp/first/some.vmx')
+def test_mech_provision_force_from_step(mock_locate, mock_load_mechfile, mock_provision):
+    """Test 'mech provision --force' and '--from-step'."""
+    runner = CliRunner()
+    result = runner.invoke(cli, ['provision', '--force', 'second'])
+    assert result.exit_code == 0
+    assert mock_provision.call_args[1] == {'force': True, 'from_step': None,
+                                           'pyinfra_batch': None}
+    result = runner.invoke(cli, ['provision', '--from-step', '2', 'second'])
+    assert result.exit_code == 0
+    assert mock_provision.call_args[1] == {'force': False, 'from_step': 2,
+                                           'pyinfra_batch': None}
+    result = runner.invoke(cli, ['provision', '--from-step', '0', 'second'])
+    assert result.exit_code != 0
+
+
+@patch('mech.utils.provision')
+@patch('mech.utils.load_mechfile')
+@patch('mech.utils.locate', return_value='/tmp/first/some.vmx')
+def test_mech_provision_parallel(mock_locate, mock_load_mechfile, mock_provision,
+                                 mechfile_two_entries):
+    """Test 'mech provision' provisions the instances at the same time."""
+    mock_load_mechfile.return_value = mechfile_two_entries
+
+    def provision(inst, show_only, force, from_step, pyinfra_batch):
+        click.secho('Provisioning instance:{}'.format(inst.name))
+        return inst.name == 'first'
+    mock_provision.side_effect = provision
+    runner = CliRunner()
+    result = runner.invoke(cli, ['provision', '--parallel', '2'])
+    assert mock_provision.call_count == 2
+    assert re.search(r'^\[first \] Provisioning instance:first$', result.output, re.MULTILINE)
+    assert re.search(r'^\[second\] Provisioning instance:second$', result.output, re.MULTILINE)
+    assert re.search(r'^first\s+ok', result.output, re.MULTILINE)
+    assert re.search(r'^second\s+failed', result.output, re.MULTILINE)
+    assert re.search(r'Not all instances were provisioned', result.output)
+    assert result.exit_code == 1
+
+    # one after the other, the others are still provisioned
+    mock_provision.reset_mock()
+    result = runner.invoke(cli, ['provision', '--parallel', '1'])
+    assert mock_provision.call_count == 2
+    assert re.search(r'Not all instances were provisioned', result.output)
+    assert result.exit_code == 1
+
+
 @patch('mech.vmrun.VMrun.suspend', return_value=True)
 @patch('mech.utils.load_mechfile')
 @patch('mech.utils.locate', return_value='/tmp/first/some.vmx')
@@ -658,7 +811,9 @@ def test_mech_suspend(mock_locate, mock_load_mechfile,
     """Test 'mech suspend' powered on."""
     mock_load_mechfile.return_value = mechfile_two_entries
     runner = CliRunner()
-    result = runner.invoke(cli, ['suspend', 'first'])
+    with patch('mech.utils.ssh_stop_master') as mock_ssh_stop_master:
+        result = runner.invoke(cli, ['suspend', 'first'])
+        mock_ssh_stop_master.assert_called()
     mock_locate.assert_called()
     mock_load_mechfile.assert_called()
     mock_vmrun_suspend.assert_called()
@@ -743,7 +898,9 @@ def test_mech_pause(mock_locate, mock_load_mechfile,
     """Test 'mech pause' powered on."""
     mock_load_mechfile.return_value = mechfile_two_entries
     runner = CliRunner()
-    result = runner.invoke(cli, ['pause', 'first'])
+    with patch('mech.utils.ssh_stop_master') as mock_ssh_stop_master:
+        result = runner.invoke(cli, ['pause', 'first'])
+        mock_ssh_stop_master.assert_called()
     mock_locate.assert_called()
     mock_load_mechfile.assert_called()
     mock_vmrun_pause.assert_called()
@@ -1263,6 +1420,27 @@ def test_mech_up_without_provisioning_without_shared_not_created(mock_locate,
         assert re.search(r'started', result.output, re.MULTILINE)
 
 
+@patch('mech.utils.report_provider', return_value=True)
+@patch('mech.utils.init_box', return_value='/tmp/some.vmx')
+@patch('mech.vmrun.VMrun.start', return_value=True)
+@patch('mech.utils.load_mechfile')
+@patch('mech.utils.locate', return_value=None)
+def test_mech_up_linked(mock_locate, mock_load_mechfile, mock_vmrun_start, mock_init_box,
+                        mock_report_provider, mechfile_one_entry):
+    """Test 'mech up --linked' (or with linked_clone in the Mechfile)."""
+    mock_load_mechfile.return_value = mechfile_one_entry
+    runner = CliRunner()
+    with patch.object(mech.mech_instance.MechInstance, 'get_ip', return_value='192.168.1.100'):
+        runner.invoke(cli, ['up', '--disable-shared-folders', '--disable-provisioning'])
+        assert mock_init_box.call_args[1]['linked'] is False
+        runner.invoke(cli, ['up', '--linked', '--disable-shared-folders',
+                            '--disable-provisioning'])
+        assert mock_init_box.call_args[1]['linked'] is True
+        mechfile_one_entry['first']['linked_clone'] = 'true'
+        runner.invoke(cli, ['up', '--disable-shared-folders', '--disable-provisioning'])
+        assert mock_init_box.call_args[1]['linked'] is True
+
+
 @patch('mech.utils.report_provider', return_value=True)
 @patch('mech.vmrun.VMrun.enable_shared_folders')
 @patch('mech.vmrun.VMrun.start', return_value=True)
@@ -1288,6 +1466,51 @@ def test_mech_up_wth_shared_folders(mock_locate, mock_load_mechfile,
         assert re.search(r'started', result.output, re.MULTILINE)
 
 
+@patch('mech.utils.start_vm')
+@patch('mech.utils.report_provider', return_value=True)
+@patch('mech.utils.load_mechfile')
+@patch('mech.utils.locate', return_value='/tmp/first/one.vmx')
+def test_mech_up_parallel(mock_locate, mock_load_mechfile, mock_report_provider,
+                          mock_start_vm, mechfile_two_entries):
+    """Test 'mech up --parallel'."""
+    mock_load_mechfile.return_value = mechfile_two_entries
+
+    def start_vm(inst):
+        click.secho('VM ({}) started'.format(inst.name))
+        return inst.name == 'first'
+    mock_start_vm.side_effect = start_vm
+    runner = CliRunner()
+    result = runner.invoke(cli, ['up', '--parallel', '2', '--keep-going'])
+    assert mock_start_vm.call_count == 2
+    assert re.search(r'^\[first \] VM \(first\) started$', result.output, re.MULTILINE)
+    assert re.search(r'^\[second\] VM \(second\) started$', result.output, re.MULTILINE)
+    assert re.search(r'^first\s+ok', result.output, re.MULTILINE)
+    assert re.search(r'^second\s+failed', result.output, re.MULTILINE)
+    assert re.search(r'Not all instances were started', result.output)
+    assert result.exit_code == 1
+
+
+@patch('mech.utils.start_vm', return_value=True)
+@patch('mech.utils.report_provider', return_value=False)
+@patch('mech.utils.load_mechfile')
+@patch('mech.utils.locate', return_value='/tmp/first/one.vmx')
+def test_mech_up_serial_fails(mock_locate, mock_load_mechfile, mock_report_provider,
+                              mock_start_vm, mechfile_two_entries):
+    """Test 'mech up' stops (and exits non-zero) when an instance cannot be started."""
+    mock_load_mechfile.return_value = mechfile_two_entries
+    runner = CliRunner()
+    result = runner.invoke(cli, ['up'])
+    assert mock_report_provider.call_count == 1
+    mock_start_vm.assert_not_called()
+    assert re.search(r'Not all instances were started', result.output)
+    assert result.exit_code == 1
+
+    mock_report_provider.reset_mock()
+    result = runner.invoke(cli, ['up', '--keep-going'])
+    assert mock_report_provider.call_count == 2
+    assert result.exit_code == 1
+
+
 @patch('mech.utils.load_mechfile')
 @patch('mech.utils.locate', return_value=None)
 def test_mech_ssh_config_not_created(mock_locate, mock_load_mechfile,
@@ -1630,14 +1853,14 @@ def test_mech_global_status(mock_list, mock_vmrun_installed):
 
 @patch('mech.utils.get_provider')
 @patch('os.path.exists', return_value=True)
-@patch('mech.vbm.VBoxManage.list', return_value="")
+@patch('mech.vbm.VBoxManage.vm_states', return_value={'first': ('running', '192.168.56.101')})
 @patch('mech.vmrun.VMrun.list', return_value="")
 @patch('mech.vmrun.VMrun.installed', return_value=True)
 @patch('mech.vbm.VBoxManage.installed', return_value=True)
 @patch('mech.utils.get_fallback_executable')
 def test_mech_global_status_virtualbox(mock_get_fallback, mock_vbm_installed,
                                        mock_vmrun_installed, mock_vmrun_list,
-                                       mock_vbm_list, mock_exists,
+                                       mock_vbm_vm_states, mock_exists,
                                        mock_get_provider):
     """Test 'mech global-status'."""
     runner = CliRunner()
@@ -1646,9 +1869,48 @@ def test_mech_global_status_virtualbox(mock_get_fallback, mock_vbm_installed,
     result = runner.invoke(cli, ['--debug', 'global-status'])
     print('result:{}'.format(result))
     mock_vbm_installed.assert_called()
-    mock_vbm_list.assert_called()
+    mock_vbm_vm_states.assert_called()
     mock_get_provider.assert_called()
     assert re.search(r'===VirtualBox VMs===', result.output, re.MULTILINE)
+    assert re.search(r'192.168.56.101\s+running\s+first', result.output, re.MULTILINE)
+
+
+@patch('mech.vmrun.VMrun.vm_states')
+@patch('mech.vmrun.VMrun.list',
+       return_value="Total running VMs: 1\n/tmp/first/.mech/first/some.vmx")
+@patch('mech.vmrun.VMrun.installed', return_value=True)
+@patch('mech.vbm.VBoxManage.installed', return_value=False)
+def test_mech_global_status_vmware_states(mock_vbm_installed, mock_vmrun_installed,
+                                          mock_vmrun_list, mock_vm_states):
+    """Test 'mech global-status' shows state and ip of running VMware VMs."""
+    mock_vm_states.return_value = {
+        '/tmp/first/.mech/first/some.vmx': ('started', '192.168.2.120')
+    }
+    runner = CliRunner()
+    result = runner.invoke(cli, ['global-status'])
+    mock_vmrun_list.assert_called_once()
+    mock_vm_states.assert_called()
+    assert re.search(r'Total running VMs: 1', result.output, re.MULTILINE)
+    assert re.search(r'192.168.2.120\s+started\s+/tmp/first', result.output, re.MULTILINE)
+
+
+@patch('mech.utils.vm_states', return_value={'first': ('started', '192.168.1.145')})
+@patch('mech.utils.load_mechfile')
+@patch('mech.utils.locate', return_value='/tmp/first/some.vmx')
+def test_mech_list_uses_bulk_states(mock_locate, mock_load_mechfile, mock_vm_states,
+                                    mechfile_two_entries):
+    """Test 'mech list' uses the bulk state snapshot when available."""
+    mock_load_mechfile.return_value = mechfile_two_entries
+    runner = CliRunner()
+    with patch.object(mech.mech_instance.MechInstance, 'get_ip') as mock_get_ip:
+        with patch.object(mech.mech_instance.MechInstance,
+                          'get_vm_state') as mock_get_vm_state:
+            result = runner.invoke(cli, ['list', 'first'])
+            mock_vm_states.assert_called()
+            mock_get_ip.assert_not_called()
+            mock_get_vm_state.assert_not_called()
+            assert re.search(r'192.168.1.145', result.output, re.MULTILINE)
+            assert re.search(r'started', result.output, re.MULTILINE)
 
 
 @patch('mech.utils.cleanup_dir_and_vms_from_dir', return_value=None)
@@ -1804,3 +2066,20 @@ def test_mech_scp_with_cloud():
     with patch('mech.utils.cloud_run') as mock_cloud_run:
         runner.invoke(cli, ['--cloud', 'foo', 'scp', 'now', 'first:/tmp/now', 'foo'])
         mock_cloud_run.assert_called()
+
+
+def test_mech_limit_rate():
+    """Test 'mech --limit-rate' and '--connections'."""
+    runner = CliRunner()
+    result = runner.invoke(cli, ['--limit-rate', 'fast', 'list'])
+    assert re.search(r"Invalid rate 'fast'", '{}'.format(result.exception))
+    result = runner.invoke(cli, ['--connections', '0', 'list'])
+    assert result.exit_code != 0
+    with patch('mech.utils.add_box') as mock_add_box:
+        result = runner.invoke(cli, ['--connections', '2', '--limit-rate', '1K',
+                                     'box', 'add', 'bento/ubuntu-18.04'])
+        mock_add_box.assert_called_once()
+        assert mock_add_box.call_args[1]['connections'] == 2
+        assert mock_add_box.call_args[1]['limit_rate'] == 1024
+    assert mech.utils.DOWNLOAD_CONNECTIONS == 4
+    assert mech.utils.DOWNLOAD_LIMIT_RATE is None
@@ -113,6 +113,7 @@ def test_mech_box_add_new(mock_os_getcwd, mock_os_path_exists,
     runner = CliRunner()
     mock_requests_get.return_value.status_code = 200
     mock_requests_get.return_value.json.return_value = catalog_as_json
+    mock_requests_get.return_value.headers = {}
     result = runner.invoke(cli, ['box', 'add', '--provider', 'vmware', 'bento/ubuntu-18.04'])
     assert re.search(r'Checking integrity', result.output, re.MULTILINE)
 
@@ -161,6 +162,20 @@ def test_mech_box_remove_exists(mock_os_path_exists, mock_rmtree):
     assert re.search(r'Removed ', result.output, re.MULTILINE)
 
 
+@patch('mech.utils.remove_box_templates', return_value=False)
+@patch('shutil.rmtree')
+@patch('os.path.exists', return_value=True)
+def test_mech_box_remove_with_linked_clones(mock_os_path_exists, mock_rmtree,
+                                            mock_remove_box_templates):
+    """Test 'mech box remove' keeps a box with linked clones."""
+    runner = CliRunner()
+    result = runner.invoke(cli, ['box', 'remove', '--version', 'somever', '--provider',
+                                 'vmware', '--name', 'bento/ubuntu-18.04'])
+    mock_remove_box_templates.assert_called()
+    mock_rmtree.assert_not_called()
+    assert re.search(r'instances are linked clones', str(result.exception))
+
+
 @patch('os.path.exists')
 def test_mech_box_remove_does_not_exists(mock_os_path_exists):
     """Test 'mech box remove'."""
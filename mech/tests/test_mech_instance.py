@@ -1,6 +1,7 @@
 # Copyright (c) 2020 Mike Kinney
 
 """mech tests"""
+import os
 from unittest.mock import patch
 from pytest import raises
 
@@ -35,6 +36,15 @@ def test_mech_instance_windows(mock_locate, mechfile_one_entry_windows):
     assert inst.windows is True
 
 
+@patch('mech.utils.locate', return_value='/tmp/first/some.vmx')
+def test_mech_instance_linked_clone(mock_locate, mechfile_one_entry):
+    """Test mech instance class."""
+    assert mech.mech.MechInstance('first', mechfile_one_entry).linked_clone is False
+    for linked_clone in (True, 'true', 'True'):
+        mechfile_one_entry['first']['linked_clone'] = linked_clone
+        assert mech.mech.MechInstance('first', mechfile_one_entry).linked_clone is True
+
+
 @patch('mech.vmrun.VMrun.get_guest_ip_address', return_value="192.168.1.100")
 @patch('mech.utils.locate', return_value='/tmp/first/some.vmx')
 def test_mech_instance_get_ip(mock_locate, mock_get_ip_address,
@@ -113,3 +123,77 @@ def test_mech_instance_winrm_raw_config_no_ip(mock_locate, mock_fallback,
         with patch.object(mech.mech_instance.MechInstance,
                           'get_ip', return_value=None):
             assert inst.winrm_raw_config()
+
+
+@patch('mech.utils.port_open', return_value=True)
+@patch('mech.vmrun.VMrun.get_guest_ip_address', return_value="192.168.1.100")
+def test_mech_instance_get_ip_cached(mock_get_ip_address, mock_port_open,
+                                     tmpdir, mechfile_one_entry):
+    """Test get_ip uses the runtime cache from a previous invocation."""
+    vmx = tmpdir.join('some.vmx')
+    vmx.write('')
+    with patch('mech.utils.locate', return_value=str(vmx)):
+        inst = mech.mech.MechInstance('first', mechfile_one_entry)
+        inst.path = str(tmpdir)
+        assert inst.get_ip() == '192.168.1.100'
+        mock_get_ip_address.assert_called_once()
+
+        inst = mech.mech.MechInstance('first', mechfile_one_entry)
+        inst.path = str(tmpdir)
+        assert inst.get_ip() == '192.168.1.100'
+        mock_get_ip_address.assert_called_once()
+        mock_port_open.assert_called_with('192.168.1.100', 22)
+
+        # no longer reachable
+        mock_port_open.return_value = False
+        inst = mech.mech.MechInstance('first', mechfile_one_entry)
+        inst.path = str(tmpdir)
+        inst.get_ip()
+        assert mock_get_ip_address.call_count == 2
+
+        inst.clear_runtime()
+        assert not tmpdir.join(mech.mech_instance.RUNTIME_CACHE).exists()
+
+
+@patch('mech.vmrun.VMrun.vm_state', return_value="running")
+def test_mech_instance_get_vm_state_cached(mock_vm_state, tmpdir, mechfile_one_entry):
+    """Test get_vm_state uses the runtime cache while vmware.log is unchanged."""
+    vmx = tmpdir.join('some.vmx')
+    vmx.write('')
+    vmware_log = tmpdir.join('vmware.log')
+    vmware_log.write('some log')
+    with patch('mech.utils.locate', return_value=str(vmx)):
+        inst = mech.mech.MechInstance('first', mechfile_one_entry)
+        inst.path = str(tmpdir)
+        assert inst.get_vm_state() == 'running'
+        assert inst.get_vm_state() == 'running'
+        mock_vm_state.assert_called_once()
+
+        # the log changed, so the state may have changed
+        vmware_log.write('some more log')
+        os.utime(str(vmware_log), ns=(0, 0))
+        mock_vm_state.return_value = 'stopped'
+        assert inst.get_vm_state() == 'stopped'
+        assert mock_vm_state.call_count == 2
+
+
+def test_mech_instance_log_file_virtualbox(tmpdir, mechfile_one_entry_virtualbox):
+    """Test the VirtualBox log is the one next to the .vbox file (ex: of a linked clone)."""
+    vbox = tmpdir.join('first', 'vm', 'first.vbox')
+    with patch('mech.utils.locate', return_value=str(vbox)):
+        inst = mech.mech.MechInstance('first', mechfile_one_entry_virtualbox)
+    inst.path = str(tmpdir.join('first'))
+    assert inst.log_file() == os.path.join(str(tmpdir), 'first', 'vm', 'Logs', 'VBox.log')
+    with patch('mech.utils.locate', return_value=None):
+        inst = mech.mech.MechInstance('first', mechfile_one_entry_virtualbox)
+    assert inst.log_file() is None
+    assert inst.log_mtime() is None
+
+
+def test_mech_instance_save_runtime_not_created(tmpdir, mechfile_one_entry):
+    """Test save_runtime does nothing if there is no instance directory."""
+    with patch('mech.utils.locate', return_value=None):
+        inst = mech.mech.MechInstance('first', mechfile_one_entry)
+    inst.path = str(tmpdir.join('first'))
+    inst.save_runtime('ip', '192.168.1.100')
+    assert inst.load_runtime() == {}
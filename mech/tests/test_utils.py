@@ -1,11 +1,18 @@
 # Copyright (c) 2020 Mike Kinney
 
 """Test mech utils."""
+import io
 import os
 import re
 import sys
 import requests
+import click
 import subprocess
+import hashlib
+import tarfile
+import zipfile
+import threading
+import time
 
 from unittest.mock import patch, mock_open, MagicMock
 from collections import OrderedDict
@@ -112,6 +119,33 @@ def test_start_vm_vbm(mechfile_one_entry):
                         mock_create_hostonly.assert_called()
 
 
+@patch('mech.utils.ssh_stop_master')
+@patch('mech.vmrun.VMrun.start', return_value=None)
+def test_start_vm_stops_ssh_master(mock_start, mock_ssh_stop_master, mechfile_one_entry):
+    """Test start_vm() does not reuse an ssh master connection from before."""
+    inst = mech.mech_instance.MechInstance('first', mechfile_one_entry)
+    assert not mech.utils.start_vm(inst)
+    mock_ssh_stop_master.assert_called_once_with(inst)
+
+
+@patch('mech.utils.provision')
+@patch('mech.vmrun.VMrun.start', return_value=True)
+def test_start_vm_provision_fails(mock_start, mock_provision, mechfile_one_entry):
+    """Test start_vm() fails when the provisioning does."""
+    inst = mech.mech_instance.MechInstance('first', mechfile_one_entry)
+    inst.disable_shared_folders = True
+    with patch.object(inst, 'get_ip', return_value='192.168.1.200'), \
+            patch('mech.utils.ssh_stop_master'):
+        mock_provision.return_value = False
+        assert not mech.utils.start_vm(inst)
+        mock_provision.return_value = True
+        assert mech.utils.start_vm(inst)
+        inst.disable_provisioning = True
+        mock_provision.reset_mock()
+        assert mech.utils.start_vm(inst)
+        mock_provision.assert_not_called()
+
+
 def test_unpause_vm_vbm(mechfile_one_entry):
     """Test unpause_vm()."""
     inst = mech.mech_instance.MechInstance('first', mechfile_one_entry)
@@ -1439,11 +1473,8 @@ def test_run_pyinfra_script_pyinfra_not_installed(mock_path_exists, mock_pyinfra
 def test_run_pyinfra_script_pyinfra_success(mock_path_exists, mock_pyinfra_installed):
     """Test pyinfra_script"""
     mock_subprocess = MagicMock()
-    mock_subprocess.return_value = subprocess.CompletedProcess(args='',
-                                                               returncode=0,
-                                                               stdout=b'',
-                                                               stderr=b'')
-    with patch('subprocess.run', mock_subprocess):
+    mock_subprocess.return_value = (0, '', '')
+    with patch('mech.utils.run_streaming', mock_subprocess):
         return_code, stdout, stderr = mech.utils.run_pyinfra_script(host='foo', username='vagrant',
                                                                     script_path='/tmp/file1.py')
         assert return_code == 0
@@ -1459,11 +1490,8 @@ def test_run_pyinfra_script_pyinfra_success(mock_path_exists, mock_pyinfra_insta
 def test_run_pyinfra_script_pyinfra_failed(mock_path_exists, mock_pyinfra_installed):
     """Test pyinfra_script"""
     mock_subprocess = MagicMock()
-    mock_subprocess.return_value = subprocess.CompletedProcess(args='',
-                                                               returncode=1,
-                                                               stdout=b'some output',
-                                                               stderr=b'some error')
-    with patch('subprocess.run', mock_subprocess):
+    mock_subprocess.return_value = (1, 'some output', 'some error')
+    with patch('mech.utils.run_streaming', mock_subprocess):
         return_code, stdout, stderr = mech.utils.run_pyinfra_script(host='foo', username='vagrant',
                                                                     script_path='/tmp/file1.py')
         assert return_code == 1
@@ -1630,7 +1658,7 @@ def test_init_box_cannot_find_valid_box(mock_locate):
 @patch('mech.utils.makedirs', return_value=True)
 @patch('mech.utils.add_box')
 @patch('mech.utils.locate')
-def test_init_box_cannot_extract_box(mock_locate, mock_add_box, mock_makedirs):
+def test_init_box_cannot_extract_box(mock_locate, mock_add_box, mock_makedirs, tmpdir):
     """Test init_box."""
     a_mock = MagicMock()
     another_mock = MagicMock()
@@ -1645,19 +1673,21 @@ def test_init_box_cannot_extract_box(mock_locate, mock_add_box, mock_makedirs):
     mock_locate.return_value = None
     mock_add_box.return_value = 'bento', '1.23', 'ubuntu'
     with raises(SystemExit, match=r"Cannot extract box"):
-        with patch('subprocess.Popen', a_mock):
-            mech.utils.init_box(name='first', box='bento/ubuntu', box_version='1.23')
+        with patch('subprocess.Popen', a_mock), \
+                patch('mech.utils.load_box_index', return_value=['some.vmx']):
+            mech.utils.init_box(name='first', box='bento/ubuntu', box_version='1.23',
+                                instance_path=str(tmpdir.join('first')), save=False)
 
 
-@patch('tarfile.open')
+@patch('mech.utils.clone_tree')
+@patch('mech.utils.extract_box_image')
 @patch('mech.utils.makedirs', return_value=True)
 @patch('mech.utils.add_box')
 @patch('mech.utils.locate')
-def test_init_box_when_no_vmx_after_extraction(mock_locate, mock_add_box,
-                                               mock_makedirs, mock_tarfile_open):
+def test_init_box_when_no_vmx_after_extraction(mock_locate, mock_add_box, mock_makedirs,
+                                               mock_extract_box_image, mock_clone_tree):
     """Test init_box."""
     mock_subprocess_popen = MagicMock()
-    mock_tarfile_open = MagicMock()
     yet_another_mock = MagicMock()
     yet_another_mock.returncode = 0
     yet_another_mock.return_value = 'someoutput', None
@@ -1670,20 +1700,19 @@ def test_init_box_when_no_vmx_after_extraction(mock_locate, mock_add_box,
             mock_locate.assert_called()
             mock_add_box.assert_called()
             mock_makedirs.assert_called()
-            mock_tarfile_open.assert_called()
+            mock_extract_box_image.assert_called()
 
 
 @patch('mech.utils.update_vmx', return_value='/tmp/first/some.vmx')
-@patch('tarfile.open')
+@patch('mech.utils.clone_tree')
+@patch('mech.utils.extract_box_image')
 @patch('mech.utils.makedirs', return_value=True)
 @patch('mech.utils.add_box')
 @patch('mech.utils.locate')
 def test_init_box_success_vmware(mock_locate, mock_add_box, mock_makedirs,
-                                 mock_tarfile_open, mock_update_vmx):
+                                 mock_extract_box_image, mock_clone_tree, mock_update_vmx):
     """Test init_box."""
     mock_subprocess_popen = MagicMock()
-    mock_tarfile_open = MagicMock()
-    mock_tarfile_open.returncode = 0
     yet_another_mock = MagicMock()
     yet_another_mock.returncode = 0
     yet_another_mock.return_value = 'someoutput', None
@@ -1698,24 +1727,21 @@ def test_init_box_success_vmware(mock_locate, mock_add_box, mock_makedirs,
         mech.utils.init_box(name='first', box='bento/ubuntu', box_version='1.23')
         mock_locate.assert_called()
         mock_add_box.assert_called()
-        mock_makedirs.assert_called()
+        mock_clone_tree.assert_called_once_with(mock_extract_box_image.return_value, None)
         mock_update_vmx.assert_called()
 
 
 @patch('subprocess.Popen')
-@patch('tarfile.open')
-@patch('mech.utils.makedirs', return_value=True)
+@patch('mech.utils.fill_dir')
 @patch('mech.utils.add_box')
 @patch('mech.utils.locate')
-def test_init_box_success_virtualbox(mock_locate, mock_add_box, mock_makedirs,
-                                     mock_tarfile_open, mock_popen):
+def test_init_box_success_virtualbox(mock_locate, mock_add_box, mock_fill_dir,
+                                     mock_popen):
     """Test init_box."""
     process_mock = MagicMock()
     attrs = {'communicate.return_value': ('output', 'error')}
     process_mock.configure_mock(**attrs)
     mock_popen.return_value = process_mock
-    mock_tarfile_open = MagicMock()
-    mock_tarfile_open.returncode = 0
     mock_locate.side_effect = [None, None, '/tmp/boxes/some.box',
                                '/tmp/first/some.ovf', '/tmp/first/some.vbox']
     mock_add_box.return_value = 'bento', '1.23', 'ubuntu'
@@ -1727,27 +1753,23 @@ def test_init_box_success_virtualbox(mock_locate, mock_add_box, mock_makedirs,
                                       instance_path='/tmp/first', save=False)
             mock_locate.assert_called()
             mock_add_box.assert_called()
-            mock_makedirs.assert_called()
-            mock_popen.assert_called()
+            mock_fill_dir.assert_called()
             mock_rmtree.assert_called()
             mock_import.assert_called()
             assert got == expected
 
 
 @patch('subprocess.Popen')
-@patch('tarfile.open')
-@patch('mech.utils.makedirs', return_value=True)
+@patch('mech.utils.fill_dir')
 @patch('mech.utils.add_box')
 @patch('mech.utils.locate')
-def test_init_box_virtualbox_no_vbox(mock_locate, mock_add_box, mock_makedirs,
-                                     mock_tarfile_open, mock_popen):
+def test_init_box_virtualbox_no_vbox(mock_locate, mock_add_box, mock_fill_dir,
+                                     mock_popen):
     """Test init_box."""
     process_mock = MagicMock()
     attrs = {'communicate.return_value': ('output', 'error')}
     process_mock.configure_mock(**attrs)
     mock_popen.return_value = process_mock
-    mock_tarfile_open = MagicMock()
-    mock_tarfile_open.returncode = 0
     mock_locate.side_effect = [None, None, '/tmp/boxes/some.box',
                                '/tmp/first/some.ovf', None]
     mock_add_box.return_value = 'bento', '1.23', 'ubuntu'
@@ -1759,19 +1781,16 @@ def test_init_box_virtualbox_no_vbox(mock_locate, mock_add_box, mock_makedirs,
 
 
 @patch('subprocess.Popen')
-@patch('tarfile.open')
-@patch('mech.utils.makedirs', return_value=True)
+@patch('mech.utils.fill_dir')
 @patch('mech.utils.add_box')
 @patch('mech.utils.locate')
-def test_init_box_virtualbox_no_ovf(mock_locate, mock_add_box, mock_makedirs,
-                                    mock_tarfile_open, mock_popen):
+def test_init_box_virtualbox_no_ovf(mock_locate, mock_add_box, mock_fill_dir,
+                                    mock_popen):
     """Test init_box."""
     process_mock = MagicMock()
     attrs = {'communicate.return_value': ('output', 'error')}
     process_mock.configure_mock(**attrs)
     mock_popen.return_value = process_mock
-    mock_tarfile_open = MagicMock()
-    mock_tarfile_open.returncode = 0
     mock_locate.side_effect = [None, None, '/tmp/boxes/some.box', None]
     mock_add_box.return_value = 'bento', '1.23', 'ubuntu'
     with raises(SystemExit, match=r"Cannot locate an OVF file"):
@@ -1781,56 +1800,45 @@ def test_init_box_virtualbox_no_ovf(mock_locate, mock_add_box, mock_makedirs,
 
 
 @patch('mech.utils.mech_dir')
-@patch('mech.utils.copyfile')
+@patch('mech.utils.place_file', return_value='copied')
 @patch('mech.utils.makedirs')
-@patch('mech.utils.tar_cmd')
-def test_add_box_file(mock_tar_cmd, mock_makedirs, mock_copyfile, mock_mech_dir):
+@patch('mech.utils.list_box')
+def test_add_box_file(mock_list_box, mock_makedirs, mock_place_file, mock_mech_dir):
     """Test add_box_file."""
-    mock_tarfile_open = MagicMock()
-    mock_tarfile_open.returncode = 0
-    mock_tarfile_open.return_value.getnames.return_value = ['aaa', 'some.vmx']
-    mock_tar_cmd.return_value = None
+    mock_list_box.return_value = ['aaa', 'some.vmx']
     mock_mech_dir.return_value = '/tmp'
-    with patch('tarfile.open', mock_tarfile_open, create=True):
+    with patch('mech.utils.save_box_index') as mock_save_box_index:
         box, box_version = mech.utils.add_box_file(box='bento/ubuntu',
                                                    box_version='1.23',
                                                    filename='/tmp/foo.box')
-        mock_tarfile_open.assert_called()
-        mock_tar_cmd.assert_called()
+        mock_list_box.assert_called_once_with('/tmp/foo.box')
+        mock_save_box_index.assert_called_once_with('/tmp/boxes/bento/ubuntu/1.23/foo.box',
+                                                    ['aaa', 'some.vmx'])
         mock_makedirs.assert_called()
-        mock_copyfile.assert_called()
+        mock_place_file.assert_called_once_with('/tmp/foo.box',
+                                                '/tmp/boxes/bento/ubuntu/1.23/foo.box',
+                                                move=False)
         assert box == '/tmp/boxes/bento/ubuntu/1.23/foo.box'
         assert box_version == '1.23'
 
 
-@patch('mech.utils.tar_cmd')
-def test_add_box_file_do_not_save(mock_tar_cmd):
+@patch('mech.utils.list_box', return_value=['aaa', 'some.vmx'])
+def test_add_box_file_do_not_save(mock_list_box):
     """Test add_box_file."""
-    mock_tarfile_open = MagicMock()
-    mock_tarfile_open.returncode = 0
-    mock_tarfile_open.return_value.getnames.return_value = ['aaa', 'some.vmx']
-    mock_tar_cmd.return_value = None
-    with patch('tarfile.open', mock_tarfile_open, create=True):
-        box, box_version = mech.utils.add_box_file(box='bento/ubuntu',
-                                                   box_version='1.23',
-                                                   filename='/tmp/foo.box',
-                                                   save=False)
-        mock_tarfile_open.assert_called()
-        mock_tar_cmd.assert_called()
-        assert box == '/tmp/foo.box'
-        assert box_version == '1.23'
+    box, box_version = mech.utils.add_box_file(box='bento/ubuntu',
+                                               box_version='1.23',
+                                               filename='/tmp/foo.box',
+                                               save=False)
+    mock_list_box.assert_called()
+    assert box == '/tmp/foo.box'
+    assert box_version == '1.23'
 
 
-@patch('mech.utils.tar_cmd')
-def test_add_box_file_that_has_leading_slashes(mock_tar_cmd):
+@patch('mech.utils.list_box', return_value=['/aaa', '/some.vmx'])
+def test_add_box_file_that_has_leading_slashes(mock_list_box):
     """Test add_box_file."""
-    mock_tarfile_open = MagicMock()
-    mock_tarfile_open.returncode = 0
-    mock_tarfile_open.return_value.getnames.return_value = ['/aaa', '/some.vmx']
-    mock_tar_cmd.return_value = None
     with raises(SystemExit, match=r"This box is comprised of filenames starting with"):
-        with patch('tarfile.open', mock_tarfile_open, create=True):
-            mech.utils.add_box_file(box='bento/ubuntu', box_version='1.23', filename='/tmp/foo.box')
+        mech.utils.add_box_file(box='bento/ubuntu', box_version='1.23', filename='/tmp/foo.box')
 
 
 def test_add_mechfile_with_empty_mechfile():
@@ -1847,11 +1855,14 @@ def test_add_mechfile_with_boxfile(mock_add_box_file, mechfile_one_entry_with_fi
 
 @patch('requests.get')
 @patch('mech.utils.locate')
-def test_add_box_url(mock_locate, mock_requests_get, catalog_as_json):
+@patch('mech.utils.main_dir')
+def test_add_box_url(mock_main_dir, mock_locate, mock_requests_get, catalog_as_json, tmpdir):
     """Test init_box."""
+    mock_main_dir.return_value = str(tmpdir)
     mock_locate.return_value = False
     mock_requests_get.return_value.status_code = 200
     mock_requests_get.return_value.json.return_value = catalog_as_json
+    mock_requests_get.return_value.headers = {}
     got = mech.utils.add_box_url(name='first', box='abox', box_version='aver', url='')
     assert got is None
 
@@ -1899,6 +1910,242 @@ def test_get_provider_simulate_win(mock_sys_platform):
         assert provider == 'ws'
 
 
+@patch('sys.platform', 'linux')
+@patch('mech.utils.save_vmrun_cache')
+@patch('mech.utils.load_vmrun_cache', return_value={})
+@patch('mech.utils.detect_provider', return_value='ws')
+@patch('os.stat')
+def test_get_provider_is_cached(mock_stat, mock_detect, mock_load, mock_save):
+    """Test get_provider only detects the hosttype once per executable/mtime."""
+    mech.utils.VMRUN_CACHE.clear()
+    mock_stat.return_value.st_mtime = 1234.0
+    assert mech.utils.get_provider('/tmp/vmrun') == 'ws'
+    assert mech.utils.get_provider('/tmp/vmrun') == 'ws'
+    mock_detect.assert_called_once()
+    mock_save.assert_called_once()
+    # a newer vmrun means detecting the hosttype again
+    mock_stat.return_value.st_mtime = 5678.0
+    assert mech.utils.get_provider('/tmp/vmrun') == 'ws'
+    assert mock_detect.call_count == 2
+    mech.utils.VMRUN_CACHE.clear()
+
+
+@patch('sys.platform', 'linux')
+@patch('mech.utils.detect_provider')
+@patch('os.stat')
+def test_get_provider_from_disk_cache(mock_stat, mock_detect):
+    """Test get_provider using the on-disk cache."""
+    mech.utils.VMRUN_CACHE.clear()
+    mock_stat.return_value.st_mtime = 1234.0
+    cache = {'/tmp/vmrun': {'mtime': 1234.0, 'provider': 'player'}}
+    with patch('mech.utils.load_vmrun_cache', return_value=cache):
+        assert mech.utils.get_provider('/tmp/vmrun') == 'player'
+    mock_detect.assert_not_called()
+    mech.utils.VMRUN_CACHE.clear()
+
+
+def test_load_vmrun_cache_invalid():
+    """Test load_vmrun_cache with an invalid file."""
+    a_mock = mock_open(read_data='not json')
+    with patch('builtins.open', a_mock, create=True):
+        assert mech.utils.load_vmrun_cache() == {}
+
+
+@patch('os.path.isdir', return_value=False)
+def test_save_vmrun_cache_no_mech_dir(mock_isdir):
+    """Test save_vmrun_cache does not create the mech directory."""
+    assert not mech.utils.save_vmrun_cache({})
+    mock_isdir.assert_called()
+
+
+@patch('sys.platform', 'linux')
+@patch('os.path.exists', return_value=True)
+@patch('mech.utils.get_fallback_executable', return_value='/tmp/vmrun')
+def test_get_vmrun_executable_is_cached(mock_fallback, mock_exists):
+    """Test get_vmrun_executable only resolves the executable once."""
+    mech.utils.VMRUN_CACHE.clear()
+    assert mech.utils.get_vmrun_executable() == '/tmp/vmrun'
+    assert mech.utils.get_vmrun_executable() == '/tmp/vmrun'
+    mock_fallback.assert_called_once()
+    mech.utils.VMRUN_CACHE.clear()
+
+
+def test_run_async():
+    """Test run_async."""
+    got = mech.utils.run_coroutine(mech.utils.run_async(
+        [sys.executable, '-c', 'import sys; print("out"); print("err", file=sys.stderr)']))
+    assert got == (0, 'out\n', 'err\n')
+
+
+def test_run_async_not_utf8():
+    """Test run_async with an output that is not valid utf-8."""
+    got = mech.utils.run_coroutine(mech.utils.run_async(
+        [sys.executable, '-c', 'import sys; sys.stdout.buffer.write(b"caf\\xe9")']))
+    assert got == (0, 'caf\ufffd', '')
+
+
+def test_run_async_timeout():
+    """Test run_async with a command that takes too long."""
+    got = mech.utils.run_coroutine(mech.utils.run_async(
+        [sys.executable, '-c', 'import time; time.sleep(30)'], timeout=0.5))
+    assert got == (None, '', 'Timed out after 0.5 seconds')
+
+
+@patch('mech.utils.ASYNC_CONCURRENCY', 2)
+def test_run_async_concurrency():
+    """Test run_async runs at most ASYNC_CONCURRENCY commands at a time."""
+    cmd = [sys.executable, '-c', 'pass']
+    running = []
+    most = []
+
+    async def create_subprocess_exec(*args, **kwargs):
+        running.append(args)
+        most.append(len(running))
+        await mech.utils.asyncio.sleep(0.01)
+        running.pop()
+        proc = MagicMock(returncode=0)
+
+        async def communicate():
+            return b'', b''
+        proc.communicate = communicate
+        return proc
+
+    async def run_all():
+        return await mech.utils.asyncio.gather(*[mech.utils.run_async(cmd) for _ in range(6)])
+
+    with patch('asyncio.create_subprocess_exec', side_effect=create_subprocess_exec):
+        results = mech.utils.run_coroutine(run_all())
+    assert results == [(0, '', '')] * 6
+    assert max(most) == 2
+
+
+def test_run_parallel():
+    """Test run_parallel."""
+    def func(name):
+        if name == 'second':
+            sys.exit(click.style('Cannot extract box', fg='red'))
+        return name != 'third'
+
+    results = mech.utils.run_parallel(func, ['first', 'second', 'third', 'fourth'],
+                                      parallel=2, keep_going=True)
+    assert [(name, status, error) for name, status, _, error in results] == [
+        ('first', 'ok', None),
+        ('second', 'failed', 'Cannot extract box'),
+        ('third', 'failed', None),
+        ('fourth', 'ok', None),
+    ]
+
+
+def test_run_parallel_fail_fast():
+    """Test run_parallel stops starting new work after a failure."""
+    def func(name):
+        raise ValueError('failed {}'.format(name))
+
+    results = mech.utils.run_parallel(func, ['first', 'second', 'third'], parallel=1)
+    assert [(name, status, error) for name, status, _, error in results] == [
+        ('first', 'failed', 'failed first'),
+        ('second', 'skipped', None),
+        ('third', 'skipped', None),
+    ]
+
+
+def test_run_parallel_stops_running_workers():
+    """Test run_parallel tells the workers still running to stop after a failure."""
+    started = threading.Event()
+
+    def func(name):
+        if name == 'first':
+            started.wait(5)
+            return False
+        started.set()
+        for _ in range(500):
+            mech.utils.check_cancelled()
+            time.sleep(0.01)
+        return True
+
+    results = mech.utils.run_parallel(func, ['first', 'second', 'third'], parallel=2)
+    assert [(name, status) for name, status, _, _ in results] == [
+        ('first', 'failed'),
+        ('second', 'skipped'),
+        ('third', 'skipped'),
+    ]
+    assert results[1][2] < 4
+    # outside of run_parallel, or with keep_going, nothing is cancelled
+    mech.utils.check_cancelled()
+    event = threading.Event()
+    event.set()
+    with raises(mech.utils.Cancelled):
+        mech.utils.check_cancelled(event)
+
+
+def test_run_parallel_prefixed_output(capsys):
+    """Test run_parallel prefixes the output of each worker."""
+    def func(name):
+        click.echo('partial ', nl=False)
+        click.echo('line of {}'.format(name))
+
+    mech.utils.run_parallel(func, ['first', 'second'], parallel=2)
+    out, _ = capsys.readouterr()
+    assert sorted(out.splitlines()) == ['[first ] partial line of first',
+                                        '[second] partial line of second']
+
+
+def test_fan_out_ordered(capsys):
+    """Test fan_out reports the output in order."""
+    def func(name):
+        # the last one finishes first
+        mech.utils.time.sleep({'first': 0.2, 'second': 0.1, 'third': 0}[name])
+        click.echo(name)
+
+    mech.utils.fan_out(func, ['first', 'second', 'third'], parallel=3)
+    out, _ = capsys.readouterr()
+    assert out.splitlines() == ['[first ] first', '[second] second', '[third ] third']
+
+
+def test_fan_out_serial(capsys):
+    """Test fan_out with a single instance does not prefix the output."""
+    mech.utils.fan_out(click.echo, ['first'], parallel=3)
+    mech.utils.fan_out(click.echo, ['first', 'second'], parallel=1)
+    out, _ = capsys.readouterr()
+    assert out.splitlines() == ['first', 'first', 'second']
+
+
+def test_fan_out_results():
+    """Test fan_out returns which names failed (serial or not)."""
+    for parallel in (1, 2):
+        results = mech.utils.fan_out(lambda name: name == 'first', ['first', 'second'],
+                                     parallel=parallel)
+        assert [(name, status) for name, status, _, _ in results] == [
+            ('first', 'ok'), ('second', 'failed')]
+
+
+def test_check_fan_out(capsys):
+    """Test check_fan_out."""
+    mech.utils.check_fan_out([('first', 'ok', 1, None)], 'Not all')
+    mech.utils.check_fan_out([('first', 'ok', 1, None), ('second', 'ok', 1, None)], 'Not all')
+    out, _ = capsys.readouterr()
+    assert re.search(r'^second\s+ok', out, re.MULTILINE)
+    with raises(SystemExit, match=r'Not all'):
+        mech.utils.check_fan_out([('first', 'failed', 1, None)], 'Not all')
+    mech.utils.check_fan_out([('first', 'skipped', 1, None)], 'Not all')
+    mech.utils.check_fan_out([('first', 'ok', 1, None), ('second', 'skipped', 1, None)],
+                             'Not all')
+    for parallel in (1, 2):
+        results = mech.utils.fan_out(lambda name: mech.utils.SKIPPED, ['first', 'second'],
+                                     parallel=parallel)
+        assert [status for _, status, _, _ in results] == ['skipped', 'skipped']
+
+
+def test_report_parallel(capsys):
+    """Test report_parallel."""
+    assert mech.utils.report_parallel([('first', 'ok', 1.25, None)])
+    assert not mech.utils.report_parallel([('first', 'ok', 1.25, None),
+                                           ('second', 'failed', 2, 'Cannot extract box')])
+    out, _ = capsys.readouterr()
+    assert re.search(r'^first\s+ok\s+1.2s$', out, re.MULTILINE)
+    assert re.search(r'^second\s+failed\s+2.0s\s+Cannot extract box$', out, re.MULTILINE)
+
+
 def test_valid_provider():
     """Test valid_provider."""
     assert mech.utils.valid_provider('vmware')
@@ -1908,6 +2155,34 @@ def test_valid_provider():
     assert not mech.utils.valid_provider('atari')
 
 
+@patch('mech.vbm.VBoxManage.vm_states', return_value={'first': ('running', '192.168.56.101')})
+@patch('mech.vbm.VBoxManage.installed', return_value=True)
+@patch('mech.vmrun.VMrun.vm_states', return_value={'/tmp/first/some.vmx': ('started', '')})
+@patch('mech.vmrun.VMrun.installed', return_value=True)
+def test_vm_states(mock_vmrun_installed, mock_vmrun_vm_states,
+                   mock_vbm_installed, mock_vbm_vm_states, mechfile_two_entries):
+    """Test vm_states."""
+    first = mech.mech_instance.MechInstance('first', mechfile_two_entries)
+    first.created = True
+    first.vmx = '/tmp/first/some.vmx'
+    second = mech.mech_instance.MechInstance('second', mechfile_two_entries)
+    second.created = True
+    second.provider = 'virtualbox'
+    got = mech.utils.vm_states([first, second])
+    assert got == {'first': ('started', ''), 'second': (None, None)}
+    mock_vmrun_vm_states.assert_called_once()
+    mock_vbm_vm_states.assert_called_once()
+
+
+@patch('mech.vmrun.VMrun.installed', return_value=False)
+def test_vm_states_provider_not_installed(mock_vmrun_installed, mechfile_two_entries):
+    """Test vm_states when the provider is not installed."""
+    first = mech.mech_instance.MechInstance('first', mechfile_two_entries)
+    first.created = True
+    first.vmx = '/tmp/first/some.vmx'
+    assert mech.utils.vm_states([first]) == {}
+
+
 def test_vm_ready_based_on_state():
     """Test vm_ready_based_on_state."""
     assert mech.utils.vm_ready_based_on_state('powered on')
@@ -2251,3 +2526,1470 @@ def test_load_mechcloudfile_file_not_present_but_should_be(mock_os_getcwd,
     mock_os_path_isfile.return_value = False
     with raises(SystemExit, match=r"Could not find a Mechcloudfile"):
         mech.utils.load_mechcloudfile(True)
+
+
+def test_port_open():
+    """Test port_open."""
+    with patch('socket.create_connection') as mock_create_connection:
+        assert mech.utils.port_open('192.168.1.100', 22)
+        mock_create_connection.assert_called_with(('192.168.1.100', 22), timeout=0.5)
+        mock_create_connection.side_effect = ConnectionRefusedError
+        assert not mech.utils.port_open('192.168.1.100', 22)
+
+
+@patch('sys.platform', 'linux')
+def test_ssh_control_path(tmpdir):
+    """Test ssh_control_path."""
+    inst = MagicMock(path=str(tmpdir))
+    assert mech.utils.ssh_control_path(inst) == str(tmpdir.join('ssh-control'))
+    inst.path = str(tmpdir.join('not_created'))
+    assert mech.utils.ssh_control_path(inst) is None
+    inst.path = str(tmpdir.mkdir('x' * 100))
+    assert mech.utils.ssh_control_path(inst) is None
+
+
+@patch('sys.platform', 'linux')
+@patch('subprocess.run')
+def test_ssh_master_started(mock_run, tmpdir):
+    """Test ssh_master starts a master connection on first use."""
+    mock_run.return_value.returncode = 0
+    control_path = str(tmpdir.join('ssh-control'))
+    inst = MagicMock(path=str(tmpdir))
+    got = mech.utils.ssh_master(inst, '/tmp/config', 'first')
+    assert got == ['-o', 'ControlPath={}'.format(control_path), '-o', 'ControlMaster=no']
+    mock_run.assert_called_once()
+    cmds = mock_run.call_args[0][0]
+    assert cmds[:5] == ['ssh', '-F', '/tmp/config', '-N', '-f']
+    assert 'ControlMaster=yes' in cmds
+    assert cmds[-1] == 'first'
+
+
+@patch('sys.platform', 'linux')
+@patch('subprocess.run')
+def test_ssh_master_reused(mock_run, tmpdir):
+    """Test ssh_master reuses a running master connection."""
+    mock_run.return_value.returncode = 0
+    control_path = tmpdir.join('ssh-control')
+    control_path.write('')
+    inst = MagicMock(path=str(tmpdir))
+    got = mech.utils.ssh_master(inst, '/tmp/config', 'first')
+    assert got == ['-o', 'ControlPath={}'.format(control_path), '-o', 'ControlMaster=no']
+    mock_run.assert_called_once()
+    assert mock_run.call_args[0][0][:5] == ['ssh', '-F', '/tmp/config', '-O', 'check']
+
+
+@patch('sys.platform', 'linux')
+@patch('subprocess.run')
+def test_ssh_master_stale_and_fails(mock_run, tmpdir):
+    """Test ssh_master with a stale socket and a master that cannot start."""
+    mock_run.return_value.returncode = 255
+    control_path = tmpdir.join('ssh-control')
+    control_path.write('')
+    inst = MagicMock(path=str(tmpdir))
+    assert mech.utils.ssh_master(inst, '/tmp/config', 'first') == []
+    assert mock_run.call_count == 2
+    assert not control_path.exists()
+
+
+@patch('sys.platform', 'linux')
+@patch('subprocess.run')
+def test_ssh_stop_master(mock_run, tmpdir):
+    """Test ssh_stop_master."""
+    inst = MagicMock(path=str(tmpdir))
+    inst.name = 'first'
+    mech.utils.ssh_stop_master(inst)
+    mock_run.assert_not_called()
+    control_path = tmpdir.join('ssh-control')
+    control_path.write('')
+    mech.utils.ssh_stop_master(inst)
+    mock_run.assert_called_once_with(['ssh', '-o', 'ControlPath={}'.format(control_path),
+                                      '-O', 'exit', 'first'], capture_output=True)
+    assert not control_path.exists()
+
+
+def test_run_streaming(capsys):
+    """Test run_streaming."""
+    got = mech.utils.run_streaming(
+        [sys.executable, '-c',
+         'import sys; data = sys.stdin.read(); print(data.upper()); '
+         'print("err", file=sys.stderr); sys.exit(3)'],
+        b'hello')
+    assert got == (3, 'HELLO', 'err')
+    out, err = capsys.readouterr()
+    assert out == 'HELLO\n'
+    assert err == 'err\n'
+
+
+def test_run_streaming_input_fails():
+    """Test run_streaming stops the command when its input cannot be written."""
+    def input_data(pipe):
+        pipe.write(b'hello')
+        raise OSError('cannot read the file')
+
+    got = mech.utils.run_streaming(
+        [sys.executable, '-c', 'import sys; sys.stdin.read(); print("done")'], input_data)
+    assert got[0] != 0
+    assert got[1] == ''
+
+
+def test_script_needs_file():
+    """Test script_needs_file."""
+    assert not mech.utils.script_needs_file(b'echo hello\n')
+    assert not mech.utils.script_needs_file(b'#!/bin/bash\necho hello\n')
+    assert not mech.utils.script_needs_file(b'#!/usr/bin/env sh\necho hello\n')
+    assert mech.utils.script_needs_file(b'#!/usr/bin/env python3\nprint("hello")\n')
+    assert mech.utils.script_needs_file(b'#!/usr/bin/perl\n')
+
+
+def test_read_script(tmpdir, capfd):
+    """Test read_script."""
+    script = tmpdir.join('file1.sh')
+    script.write('echo hello')
+    assert mech.utils.read_script(None, str(script)) == b'echo hello'
+    assert mech.utils.read_script('echo inline', None) == b'echo inline'
+    assert mech.utils.read_script(None, None) is None
+    assert mech.utils.read_script(None, str(tmpdir.join('missing.sh'))) is None
+    out, _ = capfd.readouterr()
+    assert re.search(r'No script to execute', out, re.MULTILINE)
+    assert re.search(r'Cannot open', out, re.MULTILINE)
+
+
+@patch('requests.get')
+def test_read_script_url(mock_requests_get):
+    """Test read_script with a remote script."""
+    mock_requests_get.return_value.content = b'echo remote'
+    assert mech.utils.read_script(None, 'https://example.com/file1.sh') == b'echo remote'
+    mock_requests_get.return_value.raise_for_status.side_effect = requests.HTTPError
+    assert mech.utils.read_script(None, 'https://example.com/file1.sh') is None
+
+
+@patch('mech.utils.create_tempfile_in_guest')
+@patch('mech.utils.ssh', return_value=(0, 'hello', ''))
+def test_provision_shell_stream(mock_ssh, mock_create_tempfile,
+                                mechfile_one_entry_with_auth_and_mech_use):
+    """Test provision_shell pipes the script into bash."""
+    inst = mech.mech_instance.MechInstance('first',
+                                           mechfile_one_entry_with_auth_and_mech_use)
+    got = mech.utils.provision_shell(inst, inline='echo $1', script_path=None,
+                                     args=['hello', None], stream=True)
+    assert got == (0, 'hello', '')
+    mock_ssh.assert_called_once_with(instance=inst, command='bash -s --',
+                                     command_args='hello',
+                                     input_data=b'{\necho $1\n} < /dev/null\n')
+    mock_create_tempfile.assert_not_called()
+
+
+def test_stream_script():
+    """Test a streamed script is not read by the commands it runs."""
+    script = mech.utils.stream_script(b'#!/bin/bash\nread line\necho "read:$line $1"\n'
+                                      b'echo after\n')
+    result = subprocess.run(['bash', '-s', '--', 'arg'], input=script,
+                            stdout=subprocess.PIPE, check=True)
+    assert result.stdout == b'read: arg\nafter\n'
+
+
+@patch('mech.utils.ssh', return_value=(0, '', ''))
+@patch('mech.utils.scp', return_value=True)
+@patch('mech.utils.create_tempfile_in_guest', return_value='/tmp/foo')
+def test_provision_shell_stream_needs_file(mock_create_tempfile, mock_scp, mock_ssh,
+                                           mechfile_one_entry_with_auth_and_mech_use):
+    """Test provision_shell copies scripts for other interpreters to the guest."""
+    inst = mech.mech_instance.MechInstance('first',
+                                           mechfile_one_entry_with_auth_and_mech_use)
+    mech.utils.provision_shell(inst, inline='#!/usr/bin/env python3\nprint(1)\n',
+                               script_path=None, stream=True)
+    mock_create_tempfile.assert_called()
+    mock_scp.assert_called()
+    assert mock_ssh.call_args_list[-2][1]['command'] == '/tmp/foo'
+
+
+@patch('mech.utils.ssh', return_value=(0, '', ''))
+@patch('mech.utils.create_tempfile_in_guest', return_value='/tmp/foo')
+def test_provision_shell_not_utf8(mock_create_tempfile, mock_ssh, tmpdir,
+                                  mechfile_one_entry_with_auth_and_mech_use):
+    """Test provision_shell sends scripts that are not utf-8 as they are."""
+    inst = mech.mech_instance.MechInstance('first',
+                                           mechfile_one_entry_with_auth_and_mech_use)
+    script = tmpdir.join('script.py')
+    script.write_binary(b'#!/usr/bin/env python3\n# caf\xe9\nprint(1)\n')
+    copied = []
+
+    def scp(instance, src, dst, upload):
+        with open(src, 'rb') as the_file:
+            copied.append(the_file.read())
+        return True
+
+    with patch('mech.utils.scp', side_effect=scp):
+        mech.utils.provision_shell(inst, inline=None, script_path=str(script), stream=True)
+    assert copied == [script.read_binary()]
+
+    script = tmpdir.join('script.sh')
+    script.write_binary(b'\xef\xbb\xbfecho caf\xe9\n')
+    mock_ssh.reset_mock()
+    mech.utils.provision_shell(inst, inline=None, script_path=str(script), stream=True)
+    assert mock_ssh.call_args[1]['input_data'] == b'{\n' + script.read_binary() + b'} < /dev/null\n'
+
+
+def make_file_tree(tmpdir):
+    """Create some files to provision."""
+    conf = tmpdir.mkdir('conf')
+    conf.join('a.conf').write('a = 1\n' * 100)
+    conf.join('b.conf').write('b = 2\n')
+    os.chmod(str(conf.join('b.conf')), 0o750)
+    conf.mkdir('sub').join('c.png').write('not really a png')
+    return conf
+
+
+def test_file_entries(tmpdir):
+    """Test file_entries with a directory and a glob pattern."""
+    conf = make_file_tree(tmpdir)
+    assert mech.utils.file_entries(str(conf)) == [
+        (str(conf.join('a.conf')), 'a.conf'),
+        (str(conf.join('b.conf')), 'b.conf'),
+        (str(conf.join('sub')), 'sub'),
+    ]
+    assert mech.utils.file_entries(str(conf.join('*.conf'))) == [
+        (str(conf.join('a.conf')), 'a.conf'),
+        (str(conf.join('b.conf')), 'b.conf'),
+    ]
+    assert sorted(name for _, name in mech.utils.walk_entries(
+        mech.utils.file_entries(str(conf)))) == ['a.conf', 'b.conf', os.path.join('sub', 'c.png')]
+
+
+def test_worth_compressing(tmpdir):
+    """Test worth_compressing."""
+    conf = make_file_tree(tmpdir)
+    assert mech.utils.worth_compressing(mech.utils.file_entries(str(conf)))
+    assert not mech.utils.worth_compressing([(str(conf.join('sub')), 'sub')])
+
+
+@patch('mech.utils.ssh', return_value=(0, '', ''))
+def test_scp_files(mock_ssh, tmpdir):
+    """Test scp_files sends one tar stream."""
+    conf = make_file_tree(tmpdir)
+    entries = mech.utils.file_entries(str(conf))
+    mock_inst = MagicMock()
+    assert mech.utils.scp_files(mock_inst, entries, '/etc/my app') == (0, '', '')
+    mock_ssh.assert_called_once()
+    assert mock_ssh.call_args[0][1] == ("mkdir -p '/etc/my app' && "
+                                        "tar -xzpf - --no-same-owner -C '/etc/my app'")
+    pipe = io.BytesIO()
+    mock_ssh.call_args[1]['input_data'](pipe)
+    pipe.seek(0)
+    with tarfile.open(fileobj=pipe, mode='r:gz') as tar:
+        assert sorted(tar.getnames()) == ['a.conf', 'b.conf', 'sub', 'sub/c.png']
+        assert tar.getmember('b.conf').mode == 0o750
+
+    # the home directory of the guest user is still expanded
+    mock_ssh.reset_mock()
+    mech.utils.scp_files(mock_inst, entries, '~/my app')
+    assert mock_ssh.call_args[0][1] == ("mkdir -p ~/'my app' && "
+                                        "tar -xzpf - --no-same-owner -C ~/'my app'")
+
+
+def test_guest_quote():
+    """Test guest_quote."""
+    assert mech.utils.guest_quote('/tmp/a b') == "'/tmp/a b'"
+    assert mech.utils.guest_quote('~') == '~'
+    assert mech.utils.guest_quote('~/conf') == '~/conf'
+    assert mech.utils.guest_quote('~/a b') == "~/'a b'"
+    assert mech.utils.guest_quote('~other') == "'~other'"
+
+
+@patch('mech.utils.ssh', return_value=(2, '', 'tar: error'))
+def test_scp_files_fails(mock_ssh, tmpdir):
+    """Test scp_files when tar fails in the guest."""
+    conf = make_file_tree(tmpdir)
+    assert mech.utils.scp_files(MagicMock(), mech.utils.file_entries(str(conf)), '/tmp') is None
+
+
+@patch('mech.utils.scp_files', return_value=(0, '', ''))
+@patch('mech.utils.scp')
+def test_provision_file_directory(mock_scp, mock_scp_files, tmpdir):
+    """Test provision_file with a directory and a glob pattern."""
+    conf = make_file_tree(tmpdir)
+    mock_inst = MagicMock(windows=False)
+    assert mech.utils.provision_file(mock_inst, str(conf), '/tmp/conf') == (0, '', '')
+    assert mech.utils.provision_file(mock_inst, str(conf.join('*.conf')), '/tmp/conf')
+    assert mech.utils.provision_file(mock_inst, str(conf.join('*.none')), '/tmp/conf') is None
+    assert mock_scp_files.call_count == 2
+    mock_scp.assert_not_called()
+
+
+@patch('mech.utils.Client')
+def test_winrm_copy_files(mock_client, tmpdir):
+    """Test winrm_copy_files sends one zip archive."""
+    conf = make_file_tree(tmpdir)
+    zips = []
+
+    def copy(src, dest, expand_variables=False):
+        with zipfile.ZipFile(src) as the_zip:
+            zips.append({info.filename: info.compress_type for info in the_zip.infolist()})
+        return 'C:\\Temp\\mech.zip'
+    mock_client.return_value.copy.side_effect = copy
+    mock_client.return_value.execute_ps.return_value = ('', MagicMock(error=[]), False)
+    mock_inst = MagicMock(windows=True)
+    got = mech.utils.winrm_copy_files(mock_inst, mech.utils.file_entries(str(conf)), 'C:\\conf')
+    assert got == (0, '', '')
+    assert zips == [{'a.conf': zipfile.ZIP_DEFLATED, 'b.conf': zipfile.ZIP_DEFLATED,
+                     'sub/c.png': zipfile.ZIP_STORED}]
+    script = mock_client.return_value.execute_ps.call_args[0][0]
+    assert "Expand-Archive -Path 'C:\\Temp\\mech.zip' -DestinationPath 'C:\\conf'" in script
+
+    # quotes in the destination are escaped
+    mech.utils.winrm_copy_files(mock_inst, mech.utils.file_entries(str(conf)),
+                                "C:\\it's'; Remove-Item C:\\ -Recurse; '")
+    script = mock_client.return_value.execute_ps.call_args[0][0]
+    assert ("-DestinationPath 'C:\\it''s''; Remove-Item C:\\ -Recurse; ''' -Force; "
+            "Remove-Item -Path 'C:\\Temp\\mech.zip'") in script
+
+
+def test_source_hashes_uses_manifest(tmpdir):
+    """Test source_hashes only hashes files that changed."""
+    conf = make_file_tree(tmpdir)
+    mock_inst = MagicMock(path=str(tmpdir))
+    a_conf = str(conf.join('a.conf'))
+    expected = hashlib.sha256(b'a = 1\n' * 100).hexdigest()
+    assert mech.utils.source_hashes(mock_inst, [a_conf]) == {a_conf: expected}
+    assert tmpdir.join('file_manifest.json').exists()
+    with patch('mech.utils.file_sha256', return_value='123') as mock_file_sha256:
+        assert mech.utils.source_hashes(mock_inst, [a_conf]) == {a_conf: expected}
+        mock_file_sha256.assert_not_called()
+        conf.join('a.conf').write('a = 2\n')
+        mech.utils.source_hashes(mock_inst, [a_conf])
+        mock_file_sha256.assert_called_once_with(a_conf)
+
+
+@patch('mech.utils.ssh')
+def test_guest_sha256(mock_ssh):
+    """Test guest_sha256 gets all the hashes with one ssh command."""
+    mock_ssh.return_value = (1, 'abc  /tmp/a.conf\ndef  /tmp/my dir/b.conf', '')
+    mock_inst = MagicMock(windows=False)
+    got = mech.utils.guest_sha256(mock_inst, ['/tmp/a.conf', '/tmp/my dir/b.conf', '/tmp/c'])
+    assert got == {'/tmp/a.conf': 'abc', '/tmp/my dir/b.conf': 'def'}
+    mock_ssh.assert_called_once_with(
+        mock_inst, "sha256sum -- /tmp/a.conf '/tmp/my dir/b.conf' /tmp/c 2>/dev/null")
+
+
+@patch('mech.utils.scp_files', return_value=(0, '', ''))
+@patch('mech.utils.scp', return_value=(0, '', ''))
+@patch('mech.utils.ssh')
+def test_provision_file_skips_unchanged_in_home(mock_ssh, mock_scp, mock_scp_files, tmpdir):
+    """Test the files copied to '~/...' in the guest are hashed (and skipped)."""
+    conf = make_file_tree(tmpdir)
+    mock_inst = MagicMock(path=str(tmpdir), windows=False)
+    a_conf = mech.utils.file_sha256(str(conf.join('a.conf')))
+    mock_ssh.return_value = (0, '{}  /home/vagrant/a.conf'.format(a_conf), '')
+    assert mech.utils.provision_file(mock_inst, str(conf.join('a.conf')),
+                                     '~/a.conf') == (0, '', '')
+    assert mock_ssh.call_args[0][1] == 'sha256sum -- ~/a.conf 2>/dev/null'
+    mock_scp.assert_not_called()
+
+    mock_ssh.return_value = (1, '{}  /home/vagrant/my conf/a.conf'.format(a_conf), '')
+    mech.utils.provision_file(mock_inst, str(conf), '~/my conf')
+    assert "~/'my conf/a.conf'" in mock_ssh.call_args[0][1]
+    assert sorted(name for _, name in mock_scp_files.call_args[0][1]) == [
+        'b.conf', os.path.join('sub', 'c.png')]
+
+
+@patch('mech.utils.Client')
+def test_guest_sha256_windows(mock_client):
+    """Test guest_sha256 on a windows guest."""
+    mock_client.return_value.execute_ps.return_value = ('abc  C:\\a.conf\n', None, False)
+    mock_inst = MagicMock(windows=True)
+    assert mech.utils.guest_sha256(mock_inst, ['C:\\a.conf']) == {'C:\\a.conf': 'abc'}
+    assert "@('C:\\a.conf')" in mock_client.return_value.execute_ps.call_args[0][0]
+
+
+@patch('mech.utils.scp_files', return_value=(0, '', ''))
+@patch('mech.utils.scp', return_value=(0, '', ''))
+@patch('mech.utils.guest_sha256')
+def test_provision_file_skips_unchanged(mock_guest_sha256, mock_scp, mock_scp_files,
+                                        tmpdir, capfd):
+    """Test provision_file only copies files that changed."""
+    conf = make_file_tree(tmpdir)
+    mock_inst = MagicMock(path=str(tmpdir), windows=False)
+    hashes = {name: mech.utils.file_sha256(str(conf.join(name)))
+              for name in ('a.conf', 'b.conf', os.path.join('sub', 'c.png'))}
+
+    # a single file
+    mock_guest_sha256.return_value = {'/tmp/a.conf': hashes['a.conf']}
+    assert mech.utils.provision_file(mock_inst, str(conf.join('a.conf')),
+                                     '/tmp/a.conf') == (0, '', '')
+    mock_scp.assert_not_called()
+    out, _ = capfd.readouterr()
+    assert re.search(r'Unchanged', out)
+
+    # a directory, where only b.conf is different
+    mock_guest_sha256.return_value = {'/tmp/conf/a.conf': hashes['a.conf'],
+                                      '/tmp/conf/sub/c.png': hashes[os.path.join('sub', 'c.png')]}
+    mech.utils.provision_file(mock_inst, str(conf), '/tmp/conf')
+    mock_scp_files.assert_called_once_with(mock_inst, [(str(conf.join('b.conf')), 'b.conf')],
+                                           '/tmp/conf')
+
+    # nothing in the guest, send everything
+    mock_guest_sha256.return_value = {}
+    mech.utils.provision_file(mock_inst, str(conf), '/tmp/conf')
+    assert mock_scp_files.call_args[0][1] == mech.utils.file_entries(str(conf))
+
+
+@patch('mech.utils.provision_shell', return_value=(0, '', ''))
+def test_provision_skips_applied_steps(mock_provision_shell, tmpdir, capfd):
+    """Test provision only runs the steps that changed (unless forced)."""
+    script = tmpdir.join('install.sh')
+    script.write('echo one\n')
+    mock_inst = MagicMock(path=str(tmpdir))
+    mock_inst.name = 'first'
+    mock_inst.provision = [{"type": "shell", "inline": "echo hello"},
+                           {"type": "shell", "path": str(script)}]
+    assert mech.utils.provision(mock_inst) is True
+    assert mock_provision_shell.call_count == 2
+    assert tmpdir.join('provisioned.json').exists()
+    capfd.readouterr()
+
+    # nothing changed
+    mech.utils.provision(mock_inst)
+    assert mock_provision_shell.call_count == 2
+    out, _ = capfd.readouterr()
+    assert re.search(r'skipped 2 steps', out)
+
+    # the script of the second step changed
+    script.write('echo two\n')
+    mech.utils.provision(mock_inst)
+    assert mock_provision_shell.call_count == 3
+    assert mock_provision_shell.call_args[0][2] == str(script)
+
+    # run again from the first step
+    mech.utils.provision(mock_inst, from_step=1)
+    assert mock_provision_shell.call_count == 5
+
+    mech.utils.provision(mock_inst, force=True)
+    assert mock_provision_shell.call_count == 7
+
+
+@patch('mech.utils.provision_shell', return_value=(1, '', 'oops'))
+def test_provision_does_not_record_failed_steps(mock_provision_shell, tmpdir):
+    """Test provision runs a step again if it failed before."""
+    mock_inst = MagicMock(path=str(tmpdir))
+    mock_inst.provision = [{"type": "shell", "inline": "false"}]
+    assert mech.utils.provision(mock_inst) is False
+    assert mech.utils.provision(mock_inst) is False
+    assert mock_provision_shell.call_count == 2
+    assert mech.utils.load_provisioned(mock_inst) == {}
+
+
+def test_step_fingerprint(tmpdir):
+    """Test step_fingerprint changes with the entry and the local files."""
+    conf = make_file_tree(tmpdir)
+    mock_inst = MagicMock(path=str(tmpdir), box_version='1.0')
+    pro = {"type": "file", "source": str(conf), "destination": "/tmp/conf"}
+    before = mech.utils.step_fingerprint(mock_inst, pro)
+    assert mech.utils.step_fingerprint(MagicMock(path=str(tmpdir), box_version='2.0'),
+                                       pro) != before
+    assert mech.utils.step_fingerprint(mock_inst, dict(pro)) == before
+    assert mech.utils.step_fingerprint(mock_inst, dict(pro, destination='/tmp/other')) != before
+    conf.join('sub', 'c.png').write('changed')
+    assert mech.utils.step_fingerprint(mock_inst, pro) != before
+
+
+@patch('mech.utils.Client')
+def test_winrm_client_is_pooled(mock_client):
+    """Test winrm operations on an instance share one client."""
+    mock_client.return_value.execute_ps.return_value = ('hello', None, False)
+    mock_client.return_value.execute_cmd.return_value = ('hello', '', 0)
+    mock_inst = MagicMock()
+    mech.utils.winrm_execute_ps(mock_inst, 'echo hello')
+    mech.utils.winrm_execute_cmd(mock_inst, 'echo hello')
+    mech.utils.winrm_copy(mock_inst, 'local', 'remote')
+    mock_client.assert_called_once()
+    mock_inst.get_ip.assert_called_once()
+
+    mech.utils.winrm_close(mock_inst)
+    mock_client.return_value.close.assert_called_once()
+    mech.utils.winrm_execute_cmd(mock_inst, 'echo hello')
+    assert mock_client.call_count == 2
+
+
+@patch('mech.utils.Client')
+def test_winrm_call_reconnects(mock_client):
+    """Test winrm_call retries once with a new client if the connection was lost."""
+    first, second = MagicMock(), MagicMock()
+    mock_client.side_effect = [first, second]
+    first.execute_cmd.side_effect = [('', '', 0), requests.ConnectionError('gone')]
+    second.execute_cmd.return_value = ('again', '', 0)
+    mock_inst = MagicMock()
+    mech.utils.winrm_call(mock_inst, 'execute_cmd', 'dir')
+    assert mech.utils.winrm_call(mock_inst, 'execute_cmd', 'dir') == ('again', '', 0)
+    first.close.assert_called_once()
+
+
+@patch('mech.utils.Client')
+def test_winrm_call_drops_failed_client(mock_client):
+    """Test winrm_call does not keep a client that failed."""
+    mock_client.return_value.execute_ps.side_effect = ValueError('bad')
+    mock_inst = MagicMock()
+    with raises(ValueError):
+        mech.utils.winrm_call(mock_inst, 'execute_ps', 'dir')
+    assert mock_inst not in mech.utils.WINRM_CLIENTS
+
+
+@patch('mech.utils.VMRUN_COPY_MIN_SIZE', 1000)
+@patch('mech.utils.WINRM_CHUNK_SIZE', 10)
+@patch('mech.utils.guest_sha256')
+@patch('mech.utils.Client')
+def test_winrm_upload_chunks(mock_client, mock_guest_sha256, tmpdir, capfd):
+    """Test winrm_upload sends a big file in chunks and checks the result."""
+    local = tmpdir.join('setup.exe')
+    local.write('0123456789' * 5)
+    chunks = {}
+
+    def copy(src, dest, expand_variables=False):
+        with open(src) as the_file:
+            chunks[dest] = the_file.read()
+    mock_client.return_value.copy.side_effect = copy
+    mock_client.return_value.execute_ps.return_value = ('C:\\Temp\\setup.exe\r\n', None, False)
+    mock_guest_sha256.return_value = {'C:\\Temp\\setup.exe': mech.utils.file_sha256(str(local))}
+    mock_inst = MagicMock(provider='vmware')
+    assert mech.utils.winrm_upload(mock_inst, str(local), '%TEMP%\\setup.exe') == \
+        'C:\\Temp\\setup.exe'
+    assert sorted(chunks) == ['C:\\Temp\\setup.exe.part{}'.format(n) for n in range(4)]
+    assert ''.join([chunks[name] for name in sorted(chunks)]) == local.read()
+    script = mock_client.return_value.execute_ps.call_args[0][0]
+    assert "[IO.File]::Create('C:\\Temp\\setup.exe')" in script
+    out, _ = capfd.readouterr()
+    assert re.search(r'Sent 0.0 MB in', out)
+
+    mock_guest_sha256.return_value = {}
+    assert mech.utils.winrm_upload(mock_inst, str(local), 'C:\\Temp\\setup.exe') is None
+
+
+@patch('mech.utils.VMRUN_COPY_MIN_SIZE', 10)
+@patch('mech.utils.guest_sha256')
+@patch('mech.utils.Client')
+def test_winrm_upload_with_vmrun(mock_client, mock_guest_sha256, tmpdir):
+    """Test winrm_upload uses VMware Tools for big files of vmware instances."""
+    local = tmpdir.join('setup.exe')
+    local.write('0123456789' * 5)
+    mock_client.return_value.execute_ps.return_value = ('C:\\setup.exe', None, False)
+    mock_guest_sha256.return_value = {'C:\\setup.exe': mech.utils.file_sha256(str(local))}
+    mock_inst = MagicMock(provider='vmware', vmx='/tmp/first/one.vmx')
+    with patch.object(mech.vmrun.VMrun, 'copy_file_from_host_to_guest',
+                      return_value='') as mock_copy:
+        assert mech.utils.winrm_upload(mock_inst, str(local), 'C:\\setup.exe') == 'C:\\setup.exe'
+        mock_copy.assert_called_once_with(str(local), 'C:\\setup.exe', quiet=True)
+    mock_client.return_value.copy.assert_not_called()
+
+
+@patch('mech.utils.pyinfra_installed', return_value=True)
+@patch('mech.utils.run_streaming')
+def test_run_pyinfra_deploy(mock_run_streaming, mock_pyinfra_installed, tmpdir):
+    """Test run_pyinfra_deploy runs one pyinfra deploy for all the hosts."""
+    script = tmpdir.join('deploy.py')
+    script.write('')
+    inventories = []
+
+    def run_streaming(cmds):
+        with open(cmds[1]) as the_file:
+            inventories.append(the_file.read())
+        return 0, 'done', ''
+    mock_run_streaming.side_effect = run_streaming
+    inventory = [('first', {'ssh_hostname': '192.168.2.120', 'ssh_user': 'vagrant'}),
+                 ('second', {'ssh_hostname': '192.168.2.121', 'ssh_user': 'vagrant'})]
+    assert mech.utils.run_pyinfra_deploy(inventory, script_path=str(script)) == (0, 'done', '')
+    mock_run_streaming.assert_called_once()
+    assert mock_run_streaming.call_args[0][0][0] == 'pyinfra'
+    assert mock_run_streaming.call_args[0][0][2] == str(script)
+    namespace = {}
+    exec(inventories[0], namespace)  # pylint: disable=exec-used
+    assert namespace['mech'] == inventory
+
+
+def test_pyinfra_step_keys():
+    """Test pyinfra_step_keys."""
+    keys = mech.utils.pyinfra_step_keys([
+        {"type": "shell", "inline": "echo hello"},
+        {"type": "pyinfra", "path": "deploy.py"},
+        {"type": "pyinfra", "path": "deploy.py", "args": ["a=1"]},
+        {"type": "pyinfra", "path": "deploy.py"},
+    ])
+    assert sorted(keys) == [2, 3, 4]
+    assert len(set(keys.values())) == 3
+
+
+@patch('mech.utils.provision_pyinfra_instances', return_value=(0, '', ''))
+def test_pyinfra_batch(mock_provision_pyinfra_instances):
+    """Test PyinfraBatch runs a shared pyinfra step once for all the instances."""
+    insts = []
+    for name in ('first', 'second', 'third'):
+        inst = MagicMock()
+        inst.name = name
+        inst.provision = [{"type": "pyinfra", "path": "deploy.py"}]
+        insts.append(inst)
+    insts[2].provision = [{"type": "pyinfra", "path": "other.py"}]
+    batch = mech.utils.PyinfraBatch(insts)
+    key = mech.utils.pyinfra_step_keys(insts[0].provision)[1]
+    assert batch.shared(key)
+    assert not batch.shared(mech.utils.pyinfra_step_keys(insts[2].provision)[1])
+
+    results = mech.utils.run_parallel(
+        lambda name: batch.run(insts[0 if name == 'first' else 1], key, 'deploy.py', [None]),
+        ['first', 'second'], parallel=2)
+    assert [status for _, status, _, _ in results] == ['ok', 'ok']
+    mock_provision_pyinfra_instances.assert_called_once()
+    assert sorted([inst.name for inst in mock_provision_pyinfra_instances.call_args[0][0]]) == \
+        ['first', 'second']
+
+
+@patch('mech.utils.provision_pyinfra_instances', return_value=(0, '', ''))
+def test_pyinfra_batch_steps_in_another_order(mock_provision_pyinfra_instances):
+    """Test PyinfraBatch does not share steps the instances run in another order."""
+    first = MagicMock()
+    first.name = 'first'
+    first.provision = [{"type": "pyinfra", "path": "x.py"}, {"type": "pyinfra", "path": "y.py"}]
+    second = MagicMock()
+    second.name = 'second'
+    second.provision = list(reversed(first.provision))
+    batch = mech.utils.PyinfraBatch([first, second])
+    for inst in (first, second):
+        for key in mech.utils.pyinfra_step_keys(inst.provision).values():
+            assert not batch.shared(key)
+
+    # the steps after a shared step (with the same steps before) are shared
+    second.provision = first.provision + [{"type": "shell", "inline": "true"}]
+    batch = mech.utils.PyinfraBatch([first, second])
+    assert all(batch.shared(key) for key in mech.utils.pyinfra_step_keys(first.provision).values())
+
+
+@patch('mech.utils.provision_pyinfra_instances', return_value=(0, '', ''))
+def test_pyinfra_batch_leave(mock_provision_pyinfra_instances):
+    """Test PyinfraBatch does not wait for an instance that left."""
+    insts = []
+    for name in ('first', 'second'):
+        inst = MagicMock()
+        inst.name = name
+        inst.provision = [{"type": "pyinfra", "path": "deploy.py"}]
+        insts.append(inst)
+    batch = mech.utils.PyinfraBatch(insts)
+    key = mech.utils.pyinfra_step_keys(insts[0].provision)[1]
+    batch.leave(insts[1])
+    assert batch.run(insts[0], key, 'deploy.py', [None]) == (0, '', '')
+    mock_provision_pyinfra_instances.assert_called_once_with([insts[0]], 'deploy.py', [None])
+
+
+def download_response(status_code, content, headers=None, fail=False):
+    """Return a mock requests response (failing after its content if fail)."""
+    response = MagicMock(status_code=status_code, headers=headers or {})
+
+    def iter_content(chunk_size):
+        yield content
+        if fail:
+            raise requests.exceptions.ChunkedEncodingError('connection reset')
+    response.iter_content.side_effect = iter_content
+    return response
+
+
+@patch('time.sleep')
+@patch('requests.get')
+def test_download_file_resumes(mock_requests_get, mock_sleep, tmpdir):
+    """Test download_file resumes an interrupted download with a Range request."""
+    filename = str(tmpdir.join('downloads', 'one.box'))
+    headers = {'content-length': '10', 'etag': '"abc"', 'content-type': 'application/x-tar'}
+    mock_requests_get.side_effect = [
+        download_response(200, b'01234', headers, fail=True),
+        download_response(206, b'56789', {'content-length': '5'}),
+    ]
+    assert mech.utils.download_file('http://example.com/one.box', filename) == \
+        'application/x-tar'
+    with open(filename, 'rb') as the_file:
+        assert the_file.read() == b'0123456789'
+    assert mock_requests_get.call_args[1]['headers'] == {'Range': 'bytes=5-', 'If-Range': '"abc"'}
+    assert mock_requests_get.call_args[1]['timeout'] == mech.utils.DOWNLOAD_TIMEOUT
+    mock_sleep.assert_called_once_with(1)
+    assert os.listdir(str(tmpdir.join('downloads'))) == ['one.box']
+
+
+@patch('requests.get')
+def test_download_file_partial_from_earlier_run(mock_requests_get, tmpdir):
+    """Test download_file continues the partial download of an earlier run."""
+    filename = str(tmpdir.join('one.box'))
+    tmpdir.join('one.box.partial').write('01234')
+    mech.utils.save_download_state(filename + '.partial', {
+        'url': 'http://example.com/one.box', 'etag': None, 'length': 10, 'content_type': None})
+    mock_requests_get.return_value = download_response(206, b'56789')
+    mech.utils.download_file('http://example.com/one.box', filename)
+    assert mock_requests_get.call_args[1]['headers'] == {'Range': 'bytes=5-'}
+    assert tmpdir.join('one.box').read() == '0123456789'
+
+    # a partial download of another url is not used
+    tmpdir.join('one.box.partial').write('01234')
+    mech.utils.save_download_state(filename + '.partial', {'url': 'http://example.com/two.box'})
+    mock_requests_get.return_value = download_response(200, b'abc')
+    mech.utils.download_file('http://example.com/one.box', filename)
+    assert mock_requests_get.call_args[1]['headers'] == {}
+    assert tmpdir.join('one.box').read() == 'abc'
+
+
+@patch('time.sleep')
+@patch('requests.get', side_effect=requests.ConnectionError('down'))
+def test_download_file_gives_up(mock_requests_get, mock_sleep, tmpdir):
+    """Test download_file gives up after DOWNLOAD_RETRIES retries."""
+    with raises(requests.ConnectionError):
+        mech.utils.download_file('http://example.com/one.box', str(tmpdir.join('one.box')))
+    assert mock_requests_get.call_count == mech.utils.DOWNLOAD_RETRIES + 1
+    assert [args[0][0] for args in mock_sleep.call_args_list] == [1, 2, 4, 8, 16]
+
+
+def range_server(content, accept_ranges=True):
+    """Return a fake requests.get serving content (honoring Range requests).
+       Every request must have a timeout.
+    """
+    requested = []
+
+    def get(url, stream=False, headers=None, *, timeout):
+        assert timeout == mech.utils.DOWNLOAD_TIMEOUT
+        requested.append(dict(headers or {}))
+        match = re.match(r'bytes=(\d+)-(\d*)$', (headers or {}).get('Range', ''))
+        if_range = (headers or {}).get('If-Range')
+        if not match or not accept_ranges or if_range not in (None, '"v1"'):
+            return download_response(200, content, {
+                'content-length': str(len(content)), 'etag': '"v1"',
+                'accept-ranges': 'bytes' if accept_ranges else 'none'})
+        start = int(match.group(1))
+        end = int(match.group(2)) + 1 if match.group(2) else len(content)
+        return download_response(206, content[start:end])
+    return get, requested
+
+
+@patch('mech.utils.DOWNLOAD_SEGMENT_MIN', 4)
+@patch('requests.get')
+def test_download_file_in_segments(mock_requests_get, tmpdir):
+    """Test download_file uses several connections when the server supports ranges."""
+    content = bytes(range(100))
+    mock_requests_get.side_effect, requested = range_server(content)
+    filename = str(tmpdir.join('one.box'))
+    mech.utils.download_file('http://example.com/one.box', filename, connections=3)
+    with open(filename, 'rb') as the_file:
+        assert the_file.read() == content
+    ranges = [headers['Range'] for headers in requested[1:]]
+    assert len(ranges) > 3
+    assert all([headers.get('If-Range') == '"v1"' for headers in requested[1:]])
+    assert not tmpdir.join('one.box.partial.json').exists()
+
+
+@patch('mech.utils.DOWNLOAD_SEGMENT_MIN', 4)
+@patch('requests.get')
+def test_download_file_in_segments_resumes(mock_requests_get, tmpdir):
+    """Test download_file only downloads the segments that are missing."""
+    content = bytes(range(100))
+    mock_requests_get.side_effect, requested = range_server(content)
+    filename = str(tmpdir.join('one.box'))
+    with open(filename + '.partial', 'wb') as the_file:
+        the_file.write(content[:60])
+    mech.utils.save_download_state(filename + '.partial', {
+        'url': 'http://example.com/one.box', 'etag': '"v1"', 'length': 100,
+        'content_type': None, 'segments': [[0, 60]]})
+    mech.utils.download_file('http://example.com/one.box', filename, connections=2)
+    with open(filename, 'rb') as the_file:
+        assert the_file.read() == content
+    starts = [int(re.match(r'bytes=(\d+)-', headers['Range']).group(1)) for headers in requested]
+    assert min(starts) == 60
+
+
+@patch('mech.utils.download_backoff')
+@patch('mech.utils.DOWNLOAD_SEGMENT_MIN', 4)
+@patch('requests.get')
+def test_download_segments_stops_when_a_connection_fails(mock_requests_get, mock_backoff,
+                                                         tmpdir):
+    """Test the other connections stop when one of them fails (and why it failed is raised)."""
+    content = bytes(range(100))
+    get, requested = range_server(content)
+    slow = threading.Event()
+
+    def failing_get(url, stream=False, headers=None, *, timeout):
+        if headers['Range'].startswith('bytes=0-'):
+            raise requests.ConnectionError('down')
+        slow.wait(0.05)
+        return get(url, stream, headers, timeout=timeout)
+    mock_requests_get.side_effect = failing_get
+    partial = str(tmpdir.join('one.box.partial'))
+    state = {'url': 'http://example.com/one.box', 'etag': '"v1"', 'length': 100,
+             'content_type': None, 'segments': []}
+    with raises(requests.ConnectionError):
+        mech.utils.download_segments('http://example.com/one.box', partial, state, 2)
+    assert len(requested) < 5
+
+
+@patch('mech.utils.DOWNLOAD_SEGMENT_MIN', 4)
+@patch('requests.get')
+def test_download_file_in_segments_changed(mock_requests_get, tmpdir):
+    """Test download_file starts over when the download changed on the server."""
+    content = bytes(range(100))
+    mock_requests_get.side_effect, requested = range_server(content)
+    filename = str(tmpdir.join('one.box'))
+    with open(filename + '.partial', 'wb') as the_file:
+        the_file.write(b'x' * 60)
+    mech.utils.save_download_state(filename + '.partial', {
+        'url': 'http://example.com/one.box', 'etag': '"v0"', 'length': 100,
+        'content_type': None, 'segments': [[0, 60]]})
+    mech.utils.download_file('http://example.com/one.box', filename, connections=2)
+    with open(filename, 'rb') as the_file:
+        assert the_file.read() == content
+    assert requested[0]['If-Range'] == '"v0"'
+    assert not tmpdir.join('one.box.partial.json').exists()
+
+
+@patch('mech.utils.DOWNLOAD_SEGMENT_MIN', 4)
+@patch('requests.get')
+def test_download_file_without_ranges(mock_requests_get, tmpdir):
+    """Test download_file uses one stream when the server does not support ranges."""
+    content = bytes(range(100))
+    mock_requests_get.side_effect, requested = range_server(content, accept_ranges=False)
+    filename = str(tmpdir.join('one.box'))
+    mech.utils.download_file('http://example.com/one.box', filename, connections=3)
+    assert len(requested) == 1
+    with open(filename, 'rb') as the_file:
+        assert the_file.read() == content
+
+
+@patch('mech.utils.DOWNLOAD_SEGMENT_MAX', 50)
+@patch('mech.utils.DOWNLOAD_SEGMENT_MIN', 10)
+def test_segment_queue():
+    """Test the segments get smaller as less is left to download."""
+    queue = mech.utils.SegmentQueue([(0, 100), (150, 200)], 2)
+    segments = []
+    segment = queue.next()
+    while segment is not None:
+        segments.append(segment)
+        segment = queue.next()
+    assert segments[0] == (0, 37)
+    assert segments[-1][1] == 200
+    assert sum([end - start for start, end in segments]) == 150
+    assert max([end - start for start, end in segments][-2:]) <= 10
+
+
+def test_missing_and_merge_ranges():
+    """Test missing_ranges and merge_ranges."""
+    assert mech.utils.missing_ranges([(10, 20), (0, 5)], 30) == [(5, 10), (20, 30)]
+    assert mech.utils.missing_ranges([], 30) == [(0, 30)]
+    assert mech.utils.merge_ranges([(10, 20), (0, 10), (25, 30)]) == [(0, 20), (25, 30)]
+
+
+def test_parse_rate():
+    """Test parse_rate."""
+    assert mech.utils.parse_rate(None) is None
+    assert mech.utils.parse_rate('500') == 500
+    assert mech.utils.parse_rate('500K') == 500 * 1024
+    assert mech.utils.parse_rate('1.5m') == 1536 * 1024
+    with raises(ValueError):
+        mech.utils.parse_rate('fast')
+
+
+@patch('time.sleep')
+@patch('time.time', return_value=100.0)
+def test_rate_limiter(mock_time, mock_sleep):
+    """Test RateLimiter waits to stay under the rate."""
+    limiter = mech.utils.RateLimiter(1000)
+    limiter.throttle(500)
+    mock_sleep.assert_called_once_with(0.5)
+    mech.utils.RateLimiter(None).throttle(500)
+    mock_sleep.assert_called_once()
+
+
+def test_catalog_to_mechfile_with_checksum(catalog_as_json):
+    """Test catalog_to_mechfile keeps the checksum of the box."""
+    provider = catalog_as_json['versions'][0]['providers'][0]
+    provider['checksum'] = 'abc'
+    provider['checksum_type'] = 'sha256'
+    got = mech.utils.catalog_to_mechfile(catalog_as_json, name='first')
+    assert got['checksum'] == 'abc'
+    assert got['checksum_type'] == 'sha256'
+
+
+@patch('mech.utils.DOWNLOAD_SEGMENT_MIN', 4)
+@patch('mech.utils.main_dir')
+@patch('requests.get')
+def test_download_file_checks_checksum(mock_requests_get, mock_main_dir, tmpdir):
+    """Test download_file checks the checksum as it downloads (one or several connections)."""
+    mock_main_dir.return_value = str(tmpdir)
+    tmpdir.mkdir('.mech').mkdir('boxes')
+    content = bytes(range(100))
+    expected = hashlib.sha256(content).hexdigest()
+    filename = str(tmpdir.join('one.box'))
+    catch_up = mech.utils.DownloadHasher.catch_up
+    read_back = []
+
+    def record_catch_up(self, end):
+        read_back.append(max(0, end - self.position))
+        catch_up(self, end)
+    for connections in (1, 3):
+        mock_requests_get.side_effect, _ = range_server(content)
+        read_back[:] = []
+        with patch.object(mech.utils.DownloadHasher, 'catch_up', record_catch_up):
+            mech.utils.download_file('http://example.com/one.box', filename,
+                                     connections=connections,
+                                     checksum=expected.upper(), checksum_type='SHA256')
+        if connections == 1:
+            # nothing was read back from the file
+            assert sum(read_back) == 0
+        else:
+            assert sum(read_back) == 100
+        assert mech.utils.file_checksum(filename, 'sha256') == expected
+
+    mock_requests_get.side_effect, _ = range_server(content)
+    with raises(SystemExit, match='checksum'):
+        mech.utils.download_file('http://example.com/one.box', filename,
+                                 checksum='bad', checksum_type='sha256')
+    assert not tmpdir.join('one.box.partial').exists()
+
+
+@patch('mech.utils.main_dir')
+def test_add_box_file_checks_checksum(mock_main_dir, tmpdir):
+    """Test add_box_file rejects a box whose checksum does not match, and
+       does not compute the checksum of a file again.
+    """
+    mock_main_dir.return_value = str(tmpdir)
+    tmpdir.mkdir('.mech').mkdir('boxes')
+    box_file = tmpdir.join('one.box')
+    box_file.write('not a box')
+    expected = hashlib.sha1(b'not a box').hexdigest()
+    with patch('mech.utils.tar_cmd') as mock_tar_cmd:
+        with raises(SystemExit, match='checksum'):
+            mech.utils.add_box_file(box='bento/ubuntu', box_version='1', filename=str(box_file),
+                                    checksum='bad', checksum_type='sha1')
+        mock_tar_cmd.assert_not_called()
+
+    with patch('mech.utils.tar_cmd', return_value=None), \
+            patch('tarfile.open'):
+        mech.utils.add_box_file(box='bento/ubuntu', box_version='1', filename=str(box_file),
+                                save=False, checksum=expected, checksum_type='sha1')
+        with patch('mech.utils.DownloadHasher') as mock_hasher:
+            mech.utils.add_box_file(box='bento/ubuntu', box_version='1', filename=str(box_file),
+                                    save=False, checksum=expected, checksum_type='sha1')
+            mock_hasher.assert_not_called()
+
+
+def test_place_file(tmpdir):
+    """Test place_file links (or clones) a file instead of copying it."""
+    source = tmpdir.join('one.box')
+    source.write('box')
+    how = mech.utils.place_file(str(source), str(tmpdir.join('two.box')))
+    assert how in ('cloned', 'linked')
+    assert tmpdir.join('two.box').read() == 'box'
+    if how == 'linked':
+        assert os.path.samefile(str(source), str(tmpdir.join('two.box')))
+
+    with patch('mech.utils.reflink', return_value=False), \
+            patch('os.link', side_effect=OSError('cross-device link')):
+        assert mech.utils.place_file(str(source), str(tmpdir.join('three.box'))) == 'copied'
+    assert tmpdir.join('three.box').read() == 'box'
+
+    assert mech.utils.place_file(str(source), str(tmpdir.join('four.box')), move=True) == 'moved'
+    assert not source.exists()
+    assert sorted(os.listdir(str(tmpdir))) == ['four.box', 'three.box', 'two.box']
+
+
+def test_place_file_keeps_mode(tmpdir):
+    """Test the files cloned or copied by place_file keep their mode."""
+    source = tmpdir.join('run.sh')
+    source.write('#!/bin/sh\n')
+    source.chmod(0o750)
+
+    def fake_reflink(source, destination):
+        with open(source, 'rb') as src, open(destination, 'wb') as dst:
+            dst.write(src.read())
+        return True
+
+    with patch('mech.utils.reflink', side_effect=fake_reflink):
+        assert mech.utils.place_file(str(source), str(tmpdir.join('cloned.sh')),
+                                     link=False) == 'cloned'
+    with patch('mech.utils.reflink', return_value=False):
+        assert mech.utils.place_file(str(source), str(tmpdir.join('copied.sh')),
+                                     link=False) == 'copied'
+    for name in ('cloned.sh', 'copied.sh'):
+        assert os.stat(str(tmpdir.join(name))).st_mode & 0o777 == 0o750
+
+
+@patch('sys.platform', 'linux')
+def test_reflink_not_supported(tmpdir):
+    """Test reflink cleans up when the filesystem cannot clone files."""
+    source = tmpdir.join('one.box')
+    source.write('box')
+    with patch('fcntl.ioctl', side_effect=OSError('Operation not supported')):
+        assert mech.utils.reflink(str(source), str(tmpdir.join('two.box'))) is False
+    assert not tmpdir.join('two.box').exists()
+
+
+def make_box(path, members):
+    """Make a (gzipped) box file with the members (names to contents)."""
+    with tarfile.open(str(path), 'w:gz') as tar:
+        for name, data in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+
+
+def test_box_index(tmpdir):
+    """Test the member index of a box is forgotten when the box changes."""
+    box = tmpdir.join('some.box')
+    box.write('box')
+    assert mech.utils.load_box_index(str(box)) is None
+    mech.utils.save_box_index(str(box), ['some.vmx'])
+    assert mech.utils.load_box_index(str(box)) == ['some.vmx']
+    assert tmpdir.join('some.box.index.json').check()
+    box.write('another box')
+    assert mech.utils.load_box_index(str(box)) is None
+
+
+def test_list_box(tmpdir):
+    """Test list_box (with tar, or tarfile when tar is not available)."""
+    make_box(tmpdir.join('some.box'), {'some.vmx': b'vmx', 'disk.vmdk': b'disk'})
+    tmpdir.join('not.box').write('<html>')
+    for tar_cmd in (mech.utils.tar_cmd, lambda *args, **kwargs: None):
+        with patch('mech.utils.tar_cmd', side_effect=tar_cmd):
+            assert mech.utils.list_box(str(tmpdir.join('some.box'))) == ['some.vmx', 'disk.vmdk']
+            assert mech.utils.list_box(str(tmpdir.join('not.box'))) is None
+
+
+def test_check_box_members():
+    """Test check_box_members."""
+    assert mech.utils.check_box_members(['aaa', 'some.vmx'], 'vmware')
+    assert not mech.utils.check_box_members(['aaa', 'some.vmx'], 'virtualbox')
+    assert mech.utils.check_box_members(['./box.ovf'], 'virtualbox')
+    for name in ('/etc/passwd', '../x.vmx', 'a/../../x', 'C:\\x.vmx', 'a\\..\\..\\x'):
+        with raises(SystemExit, match=r"This box is comprised of filenames starting with"):
+            mech.utils.check_box_members(['some.vmx', name], 'vmware')
+
+
+def test_extract_box_checks_and_indexes(tmpdir):
+    """Test a box is checked and indexed while it is extracted (read once)."""
+    box = tmpdir.join('.mech', 'boxes', 'vmware', 'bento', 'ubuntu', '1.0', 'some.box')
+    box.dirpath().ensure(dir=True)
+    make_box(box, {'some.vmx': b'vmx', 'disk.vmdk': b'disk'})
+    instance = tmpdir.mkdir('first')
+    with patch('mech.utils.main_dir', return_value=str(tmpdir)), \
+            patch('mech.utils.tar_cmd') as mock_tar_cmd:
+        mech.utils.extract_box(str(box), str(instance), 'vmware')
+        mock_tar_cmd.assert_not_called()
+    assert instance.join('disk.vmdk').read() == 'disk'
+    assert mech.utils.load_box_index(str(box)) == ['some.vmx', 'disk.vmdk']
+
+    # once indexed, it is extracted with tar
+    instance = tmpdir.mkdir('second')
+    with patch('mech.utils.main_dir', return_value=str(tmpdir)):
+        mech.utils.extract_box(str(box), str(instance), 'vmware')
+    assert instance.join('some.vmx').read() == 'vmx'
+
+
+def test_extract_box_with_unsafe_member(tmpdir):
+    """Test a box with an unsafe member is not extracted (nor kept in the cache)."""
+    box = tmpdir.join('.mech', 'boxes', 'vmware', 'bento', 'ubuntu', '1.0', 'some.box')
+    box.dirpath().ensure(dir=True)
+    make_box(box, {'some.vmx': b'vmx', '../escaped': b'oops'})
+    instance = tmpdir.mkdir('first')
+    with patch('mech.utils.main_dir', return_value=str(tmpdir)):
+        with raises(SystemExit, match=r"This box is comprised of filenames starting with"):
+            mech.utils.extract_box(str(box), str(instance), 'vmware')
+    assert not tmpdir.join('escaped').check()
+    assert not box.check()
+
+
+def test_extract_box_with_escaping_link(tmpdir):
+    """Test a box with a link out of the instance directory (and a file
+       written through it) is not extracted, with or without tarfile filters.
+    """
+    for index, data_filter in enumerate((True, False)):
+        box = tmpdir.join('.mech', 'boxes', 'vmware', 'bento', 'ubuntu', str(index), 'some.box')
+        box.dirpath().ensure(dir=True)
+        outside = tmpdir.mkdir('outside{}'.format(index))
+        with tarfile.open(str(box), 'w') as tar:
+            link = tarfile.TarInfo('link')
+            link.type = tarfile.SYMTYPE
+            link.linkname = str(outside)
+            tar.addfile(link)
+            for name in ('link/escaped', 'some.vmx'):
+                info = tarfile.TarInfo(name)
+                info.size = 4
+                tar.addfile(info, io.BytesIO(b'oops'))
+        instance = tmpdir.mkdir('instance{}'.format(index))
+        with patch('mech.utils.main_dir', return_value=str(tmpdir)):
+            with patch.dict(vars(tarfile)), \
+                    raises(SystemExit, match=r"This box is comprised of filenames"):
+                if not data_filter:
+                    vars(tarfile).pop('data_filter', None)
+                mech.utils.extract_box(str(box), str(instance), 'vmware')
+        assert not outside.join('escaped').check()
+        assert not box.check()
+
+    # a link within the instance directory is fine
+    assert not mech.utils.unsafe_tar_member(
+        tarfile.TarInfo('a/b'), str(tmpdir.join('instance0')))
+    link = tarfile.TarInfo('a/link')
+    link.type = tarfile.SYMTYPE
+    link.linkname = '../disk.vmdk'
+    assert not mech.utils.unsafe_tar_member(link, str(tmpdir.join('instance0')))
+    link.linkname = '../../disk.vmdk'
+    assert mech.utils.unsafe_tar_member(link, str(tmpdir.join('instance0')))
+
+
+def test_extract_box_without_vmx(tmpdir):
+    """Test a box without a VMX file is not kept in the cache."""
+    box = tmpdir.join('.mech', 'boxes', 'vmware', 'bento', 'ubuntu', '1.0', 'some.box')
+    box.dirpath().ensure(dir=True)
+    make_box(box, {'disk.vmdk': b'disk'})
+    instance = tmpdir.mkdir('first')
+    with patch('mech.utils.main_dir', return_value=str(tmpdir)):
+        with raises(SystemExit, match=r"Cannot find a valid box with a VMX/OVF"):
+            mech.utils.extract_box(str(box), str(instance), 'vmware')
+    assert not box.check()
+
+
+def test_init_box_without_cache_extracts_aside(tmpdir):
+    """Test init_box (--no-cache) leaves no instance files when the box is not valid."""
+    box = tmpdir.join('.mech', 'boxes', 'vmware', 'bento', 'ubuntu', '1.0', 'some.box')
+    box.dirpath().ensure(dir=True)
+    make_box(box, {'disk.vmdk': b'disk', '../escaped': b'oops'})
+    instance = tmpdir.join('.mech', 'first')
+    with patch('mech.utils.main_dir', return_value=str(tmpdir)), \
+            patch('mech.utils.add_box', return_value=('bento/ubuntu', '1.0')):
+        with raises(SystemExit, match=r"This box is comprised of filenames starting with"):
+            mech.utils.init_box(name='first', box='bento/ubuntu', box_version='1.0',
+                                instance_path=str(instance), save=False)
+    assert not instance.check()
+    assert tmpdir.join('.mech').listdir() == [tmpdir.join('.mech', 'boxes')]
+
+    make_box(box, {'some.vmx': b'vmx', 'disk.vmdk': b'disk'})
+    with patch('mech.utils.main_dir', return_value=str(tmpdir)), \
+            patch('mech.utils.add_box', return_value=('bento/ubuntu', '1.0')), \
+            patch('mech.utils.update_vmx') as mock_update_vmx:
+        vmx = mech.utils.init_box(name='first', box='bento/ubuntu', box_version='1.0',
+                                  instance_path=str(instance), save=False)
+        mock_update_vmx.assert_called()
+    assert vmx == str(instance.join('some.vmx'))
+    assert instance.join('disk.vmdk').read() == 'disk'
+
+
+@patch('mech.utils.list_box')
+def test_add_box_file_when_indexed(mock_list_box, tmpdir):
+    """Test re-adding a box that was indexed does not read it again."""
+    source = tmpdir.join('some.box')
+    make_box(source, {'some.vmx': b'vmx'})
+    mock_list_box.return_value = ['some.vmx']
+    with patch('mech.utils.main_dir', return_value=str(tmpdir)):
+        box, _ = mech.utils.add_box_file(box='bento/ubuntu', box_version='1.0',
+                                         filename=str(source))
+        assert mech.utils.load_box_index(box) == ['some.vmx']
+        mock_list_box.reset_mock()
+        again, _ = mech.utils.add_box_file(box='bento/ubuntu', box_version='1.0',
+                                           filename=str(source))
+    assert again == box
+    mock_list_box.assert_not_called()
+
+
+@patch('mech.utils.list_box')
+def test_add_box_file_without_validation(mock_list_box, tmpdir):
+    """Test a box is not read when it is checked while extracted."""
+    source = tmpdir.join('some.box')
+    source.write('box')
+    with patch('mech.utils.main_dir', return_value=str(tmpdir)):
+        box, _ = mech.utils.add_box_file(box='bento/ubuntu', box_version='1.0',
+                                         filename=str(source), validate=False)
+    mock_list_box.assert_not_called()
+    assert os.path.isfile(box)
+    assert mech.utils.load_box_index(box) is None
+
+
+def test_extract_box_image(tmpdir):
+    """Test a box is extracted once, then cloned (or copied) for each instance."""
+    box = tmpdir.join('.mech', 'boxes', 'vmware', 'bento', 'ubuntu', '1.0', 'some.box')
+    box.dirpath().ensure(dir=True)
+    make_box(box, {'some.vmx': b'vmx', 'disks/disk.vmdk': b'disk'})
+    with patch('mech.utils.main_dir', return_value=str(tmpdir)):
+        image = mech.utils.extract_box_image(str(box), 'vmware')
+        assert image == str(box.dirpath().join('extracted'))
+        with patch('mech.utils.extract_box') as mock_extract_box:
+            assert mech.utils.extract_box_image(str(box), 'vmware') == image
+            mock_extract_box.assert_not_called()
+    assert sorted(os.listdir(str(box.dirpath()))) == [
+        'extracted', 'some.box', 'some.box.index.json']
+
+    instance = tmpdir.join('first')
+    how = mech.utils.clone_tree(image, str(instance))
+    assert sum(how.values()) == 2
+    assert set(how) <= {'cloned', 'copied'}
+    instance.join('disks', 'disk.vmdk').write('changed')
+    assert box.dirpath().join('extracted', 'disks', 'disk.vmdk').read() == 'disk'
+    assert instance.join('some.vmx').read() == 'vmx'
+
+
+def test_extract_box_image_that_fails(tmpdir):
+    """Test a box that cannot be extracted leaves no extracted directory."""
+    box = tmpdir.join('some.box')
+    box.write('<html>')
+    with raises(SystemExit, match=r"Cannot extract box"):
+        mech.utils.extract_box_image(str(box))
+    assert tmpdir.listdir() == [box]
+
+
+def test_add_box_file_forgets_extracted_box(tmpdir):
+    """Test the files extracted from a box (and its template) are removed when
+       it is replaced.
+    """
+    source = tmpdir.join('some.box')
+    source.write('box')
+    with patch('mech.utils.main_dir', return_value=str(tmpdir)), \
+            patch('mech.utils.list_box', return_value=['some.vmx']):
+        box, _ = mech.utils.add_box_file(box='bento/ubuntu', box_version='1.0',
+                                         filename=str(source))
+        image = mech.utils.box_image_dir(box)
+        os.makedirs(image)
+        mech.utils.add_box_file(box='bento/ubuntu', box_version='1.0',
+                                filename=str(source))
+        assert os.path.isdir(image)
+        template = mech.utils.box_template_dir(box)
+        os.makedirs(template)
+        with open(os.path.join(template, 'some.vmx'), 'w') as the_file:
+            the_file.write('vmx')
+        with patch('mech.utils.VMrun.unregister') as mock_unregister:
+            mech.utils.add_box_file(box='bento/ubuntu', box_version='1.0',
+                                    filename=str(source), force=True)
+            mock_unregister.assert_called_once_with(quiet=True)
+        assert not os.path.exists(image)
+        assert not os.path.exists(template)
+
+
+@patch('mech.utils.VMrun.register')
+@patch('mech.utils.VMrun.snapshot', return_value='')
+@patch('mech.utils.VMrun.list_snapshots')
+def test_vmware_template(mock_list_snapshots, mock_snapshot, mock_register, tmpdir):
+    """Test the template VM of a box is made (and snapshotted) once."""
+    box = tmpdir.join('.mech', 'boxes', 'vmware', 'bento', 'ubuntu', '1.0', 'some.box')
+    box.dirpath().ensure(dir=True)
+    make_box(box, {'some.vmx': b'vmx', 'disk.vmdk': b'disk'})
+    template = tmpdir.join(os.path.relpath(mech.utils.box_template_dir(str(box)), str(tmpdir)))
+    template_vmx = str(template.join('some.vmx'))
+    mock_list_snapshots.return_value = 'Total snapshots: 0'
+    with patch('mech.utils.main_dir', return_value=str(tmpdir)):
+        assert mech.utils.vmware_template(str(box)) == template_vmx
+        mock_register.assert_called_once()
+        mock_snapshot.assert_called_once_with('mech-template')
+        assert template.join('disk.vmdk').read() == 'disk'
+        # the box is only extracted once more for (not linked) instances
+        assert not box.dirpath().join('extracted').check()
+
+        mock_snapshot.reset_mock()
+        mock_list_snapshots.return_value = 'Total snapshots: 1\nmech-template'
+        with patch('mech.utils.extract_box') as mock_extract_box:
+            assert mech.utils.vmware_template(str(box)) == template_vmx
+            mock_extract_box.assert_not_called()
+        mock_snapshot.assert_not_called()
+
+        mock_list_snapshots.return_value = None
+        assert mech.utils.vmware_template(str(box)) is None
+
+    # the template takes over the files already extracted
+    template.remove()
+    mock_list_snapshots.return_value = 'Total snapshots: 0'
+    with patch('mech.utils.main_dir', return_value=str(tmpdir)):
+        image = mech.utils.extract_box_image(str(box))
+        with patch('mech.utils.extract_box') as mock_extract_box:
+            assert mech.utils.vmware_template(str(box)) == template_vmx
+            mock_extract_box.assert_not_called()
+    assert not os.path.exists(image)
+
+
+@patch('mech.utils.VMrun.clone')
+def test_vmware_linked_clone(mock_clone):
+    """Test vmware_linked_clone."""
+    mock_clone.return_value = ''
+    vmx = mech.utils.vmware_linked_clone('/tmp/template/some.vmx', '/tmp/first')
+    assert vmx == '/tmp/first/some.vmx'
+    mock_clone.assert_called_once_with('/tmp/first/some.vmx', 'linked', 'mech-template')
+    mock_clone.return_value = None
+    assert mech.utils.vmware_linked_clone('/tmp/template/some.vmx', '/tmp/first') is None
+
+
+@patch('mech.utils.get_vmrun_executable', return_value='/tmp/vmrun')
+@patch('mech.utils.get_provider', return_value='ws')
+@patch('subprocess.Popen')
+def test_vmware_linked_clone_command(mock_popen, mock_get_provider, mock_get_vmrun_executable):
+    """Test the vmrun command line of vmware_linked_clone."""
+    mock_popen.return_value.communicate.return_value = ('', '')
+    mock_popen.return_value.returncode = 0
+    vmx = mech.utils.vmware_linked_clone('/tmp/template/some.vmx', '/tmp/first')
+    assert vmx == '/tmp/first/some.vmx'
+    assert mock_popen.call_args[0][0] == ['/tmp/vmrun', '-T', 'ws', 'clone',
+                                          '/tmp/template/some.vmx', '/tmp/first/some.vmx',
+                                          'linked', '-snapshot=mech-template']
+
+
+@patch('mech.utils.update_vmx')
+@patch('mech.utils.add_box', return_value=('bento/ubuntu', '1.0'))
+def test_init_box_linked(mock_add_box, mock_update_vmx, tmpdir):
+    """Test init_box with linked clones (and when they cannot be made)."""
+    box = tmpdir.join('.mech', 'boxes', 'vmware', 'bento', 'ubuntu', '1.0', 'some.box')
+    box.dirpath().ensure(dir=True)
+    make_box(box, {'some.vmx': b'vmx'})
+    template_vmx = os.path.join(mech.utils.box_template_dir(str(box)), 'some.vmx')
+
+    def clone(template, instance_path):
+        tmpdir.join(os.path.basename(instance_path), 'some.vmx').write('linked', ensure=True)
+        return os.path.join(instance_path, 'some.vmx')
+
+    with patch('mech.utils.main_dir', return_value=str(tmpdir)), \
+            patch('mech.utils.vmware_template', return_value=template_vmx), \
+            patch('mech.utils.vmware_linked_clone', side_effect=clone) as mock_linked_clone:
+        vmx = mech.utils.init_box(name='first', box='bento/ubuntu', box_version='1.0',
+                                  instance_path=str(tmpdir.join('first')), linked=True)
+        mock_linked_clone.assert_called_once_with(template_vmx, str(tmpdir.join('first')))
+        assert tmpdir.join('first', 'some.vmx').read() == 'linked'
+        assert vmx == str(tmpdir.join('first', 'some.vmx'))
+
+        mock_linked_clone.side_effect = None
+        mock_linked_clone.return_value = None
+        mech.utils.init_box(name='second', box='bento/ubuntu', box_version='1.0',
+                            instance_path=str(tmpdir.join('second')), linked=True)
+        assert tmpdir.join('second', 'some.vmx').read() == 'vmx'
+
+
+@patch('mech.vbm.VBoxManage.snapshot', return_value='')
+@patch('mech.vbm.VBoxManage.list_snapshots', return_value=[])
+@patch('mech.vbm.VBoxManage.importvm')
+@patch('mech.vbm.VBoxManage.get_vm_info')
+def test_virtualbox_template(mock_get_vm_info, mock_importvm, mock_list_snapshots,
+                             mock_snapshot, tmpdir):
+    """Test the base VM of a box is imported (and snapshotted) once."""
+    box = tmpdir.join('.mech', 'boxes', 'virtualbox', 'bento', 'ubuntu', '1.0', 'some.box')
+    box.dirpath().ensure(dir=True)
+    make_box(box, {'box.ovf': b'ovf', 'disk.vmdk': b'disk'})
+    mock_get_vm_info.side_effect = [None, 'info']
+    with patch('mech.utils.main_dir', return_value=str(tmpdir)):
+        vmname = mech.utils.virtualbox_template(str(box))
+    assert vmname.startswith('mech-bento-ubuntu-1.0-')
+    mock_importvm.assert_called_once_with(
+        path_to_ovf=str(box.dirpath().join('extracted', 'box.ovf')), name=vmname,
+        base_folder=mech.utils.box_template_dir(str(box)), quiet=True)
+    mock_snapshot.assert_called_once_with(vmname, 'mech-template')
+    # the base VM has its own copy of the files
+    assert not box.dirpath().join('extracted').check()
+
+    # already imported and snapshotted
+    mock_importvm.reset_mock()
+    mock_snapshot.reset_mock()
+    mock_get_vm_info.side_effect = None
+    mock_list_snapshots.return_value = ['mech-template']
+    with patch('mech.utils.main_dir', return_value=str(tmpdir)):
+        assert mech.utils.virtualbox_template(str(box)) == vmname
+    mock_importvm.assert_not_called()
+    mock_snapshot.assert_not_called()
+
+    # the import failed
+    mock_get_vm_info.return_value = None
+    assert mech.utils.virtualbox_template(str(box)) is None
+
+
+@patch('mech.vbm.VBoxManage.unregister')
+def test_remove_box_template(mock_unregister, tmpdir):
+    """Test the base VM of a box is unregistered and deleted with its template."""
+    template = tmpdir.join('template')
+    template.join('mech-base', 'mech-base.vbox').write('vbox', ensure=True)
+    # it still has linked clones
+    mock_unregister.return_value = None
+    mech.utils.remove_box_template(str(template))
+    mock_unregister.assert_called_once_with('mech-base', delete=True, quiet=True)
+    assert template.check()
+
+    mock_unregister.return_value = ''
+    mech.utils.remove_box_template(str(template))
+    assert not template.check()
+    mech.utils.remove_box_template(str(template))
+
+
+@patch('mech.utils.VMrun.unregister')
+def test_remove_box_template_with_linked_clones(mock_unregister, tmpdir):
+    """Test the template VM of a box is kept while it has linked clones."""
+    box_dir = tmpdir.join('.mech', 'boxes', 'vmware', 'bento', 'ubuntu', '1.0')
+    template = box_dir.join('template-0123abcd')
+    template.join('some.vmx').write('vmx', ensure=True)
+    template.join('disk.vmdk').write('disk')
+    box_dir.join('template-0123abcd.xyz.tmp').ensure(dir=True)
+    clone = tmpdir.join('.mech', 'first', 'disk-cl1.vmdk')
+    clone.write('# Disk DescriptorFile\nparentFileNameHint="{}"\n'.format(
+        template.join('disk.vmdk')), ensure=True)
+    with patch('mech.utils.main_dir', return_value=str(tmpdir)):
+        assert mech.utils.box_template_dirs(str(box_dir)) == [str(template)]
+        assert mech.utils.vmware_linked_clones(str(template)) == [str(clone)]
+        assert not mech.utils.remove_box_templates(str(box_dir))
+        mock_unregister.assert_not_called()
+        assert template.join('disk.vmdk').check()
+
+        # once the linked clone is destroyed
+        clone.remove()
+        assert mech.utils.remove_box_templates(str(box_dir))
+        mock_unregister.assert_called_once_with(quiet=True)
+        assert not template.check()
+
+
+def test_virtualbox_template_of_replaced_box(tmpdir):
+    """Test a box that is replaced gets another base VM."""
+    box = tmpdir.join('.mech', 'boxes', 'virtualbox', 'bento', 'ubuntu', '1.0', 'some.box')
+    box.dirpath().ensure(dir=True)
+    make_box(box, {'box.ovf': b'ovf'})
+    vmnames = set()
+    with patch('mech.vbm.VBoxManage.get_vm_info', return_value='info'), \
+            patch('mech.vbm.VBoxManage.list_snapshots', return_value=['mech-template']):
+        vmnames.add(mech.utils.virtualbox_template(str(box)))
+        make_box(box, {'box.ovf': b'another ovf'})
+        os.utime(str(box), ns=(1, 1))
+        vmnames.add(mech.utils.virtualbox_template(str(box)))
+    assert len(vmnames) == 2
+
+
+@patch('mech.vbm.VBoxManage.clonevm')
+def test_virtualbox_linked_clone(mock_clonevm):
+    """Test virtualbox_linked_clone."""
+    with patch('mech.utils.main_dir', return_value='/tmp'):
+        assert mech.utils.virtualbox_linked_clone('mech-base', 'first')
+        mock_clonevm.assert_called_once_with('mech-base', 'first', base_folder='/tmp/.mech',
+                                             snapshot='mech-template', link=True)
+        mock_clonevm.return_value = None
+        assert not mech.utils.virtualbox_linked_clone('mech-base', 'first')
+
+
+@patch('mech.vbm.VBoxManage.importvm')
+@patch('mech.utils.add_box', return_value=('bento/ubuntu', '1.0'))
+def test_init_box_virtualbox_linked(mock_add_box, mock_importvm, tmpdir):
+    """Test init_box with virtualbox linked clones (and when they cannot be made)."""
+    box = tmpdir.join('.mech', 'boxes', 'virtualbox', 'bento', 'ubuntu', '1.0', 'some.box')
+    box.dirpath().ensure(dir=True)
+    make_box(box, {'box.ovf': b'ovf'})
+    instance_path = str(tmpdir.join('.mech', 'first'))
+
+    def clone(template, name):
+        tmpdir.join('.mech', name, name + '.vbox').write('vbox', ensure=True)
+        return True
+
+    with patch('mech.utils.main_dir', return_value=str(tmpdir)), \
+            patch('mech.utils.virtualbox_template', return_value='mech-base'), \
+            patch('mech.utils.virtualbox_linked_clone', side_effect=clone) as mock_linked_clone:
+        vbox = mech.utils.init_box(name='first', box='bento/ubuntu', box_version='1.0',
+                                   provider='virtualbox', instance_path=instance_path,
+                                   linked=True)
+        mock_linked_clone.assert_called_once_with('mech-base', 'first')
+        assert vbox == str(tmpdir.join('.mech', 'first', 'first.vbox'))
+        mock_importvm.assert_not_called()
+        assert not os.path.exists(instance_path + '_tmp')
+
+        # imported from the extracted box
+        def importvm(path_to_ovf, name, base_folder, quiet):
+            tmpdir.join('.mech', name, name + '.vbox').write('vbox', ensure=True)
+
+        mock_linked_clone.side_effect = None
+        mock_linked_clone.return_value = False
+        mock_importvm.side_effect = importvm
+        mech.utils.init_box(name='second', box='bento/ubuntu', box_version='1.0',
+                            provider='virtualbox', linked=True,
+                            instance_path=str(tmpdir.join('.mech', 'second')))
+        mock_importvm.assert_called_once_with(
+            path_to_ovf=str(box.dirpath().join('extracted', 'box.ovf')), name='second',
+            base_folder=str(tmpdir.join('.mech')), quiet=True)
+    assert box.dirpath().join('extracted', 'box.ovf').check()
@@ -1,9 +1,11 @@
 # Copyright (c) 2020 Mike Kinney
 """Tests for VBoxManage class."""
+import itertools
 from unittest.mock import patch, MagicMock
 
 
 import mech.vbm
+import mech.utils
 
 
 @patch('subprocess.Popen')
@@ -90,6 +92,52 @@ def test_vbm_ip_with_no_wait():
         assert got == expected
 
 
+def test_vbm_wait_ip():
+    """Test wait_ip method."""
+    vbm = mech.vbm.VBoxManage(executable='/bin/VBoxManage')
+    line = 'Name: /VirtualBox/GuestInfo/Net/0/V4/IP, value: 192.168.56.195, flags:'
+    with patch.object(mech.vbm.VBoxManage, 'run', return_value=line) as mock_run:
+        assert vbm.wait_ip(vmname='first', timeout=2.5) == '192.168.56.195'
+        mock_run.assert_called_with('guestproperty', 'wait', 'first', mech.vbm.IP_PROPERTY,
+                                    '--timeout', '2500', quiet=False)
+    with patch.object(mech.vbm.VBoxManage, 'run', return_value='Time out or interruption'):
+        assert vbm.wait_ip(vmname='first', timeout=1) == ''
+    with patch.object(mech.vbm.VBoxManage, 'run', return_value=None):
+        assert vbm.wait_ip(vmname='first', timeout=1) is None
+
+
+def test_vbm_ip_with_wait_uses_guestproperty_wait():
+    """Test ip method waits for the guest property."""
+    vbm = mech.vbm.VBoxManage(executable='/bin/VBoxManage')
+    with patch.object(mech.vbm.VBoxManage, '_ip', return_value=None), \
+            patch.object(mech.vbm.VBoxManage, 'wait_ip',
+                         side_effect=['', '192.168.56.195']) as mock_wait_ip:
+        assert vbm.ip(vmname='first', wait=True) == '192.168.56.195'
+        assert mock_wait_ip.call_count == 2
+
+
+@patch('time.sleep')
+def test_vbm_ip_with_wait_falls_back_to_polling(mock_sleep):
+    """Test ip method polls with backoff when guestproperty wait fails."""
+    vbm = mech.vbm.VBoxManage(executable='/bin/VBoxManage')
+    with patch.object(mech.vbm.VBoxManage, '_ip',
+                      side_effect=[None, None, None, None, '192.168.56.195']), \
+            patch.object(mech.vbm.VBoxManage, 'wait_ip', return_value=None) as mock_wait_ip:
+        assert vbm.ip(vmname='first', wait=True) == '192.168.56.195'
+        mock_wait_ip.assert_called_once()
+        assert [call[0][0] for call in mock_sleep.call_args_list] == [0.25, 0.5, 1]
+
+
+@patch('time.sleep')
+def test_vbm_ip_with_wait_times_out(mock_sleep):
+    """Test ip method gives up after the timeout."""
+    vbm = mech.vbm.VBoxManage(executable='/bin/VBoxManage')
+    with patch.object(mech.vbm.VBoxManage, '_ip', return_value=None), \
+            patch.object(mech.vbm.VBoxManage, 'wait_ip', return_value=''), \
+            patch('time.time', side_effect=itertools.count(0, 3)):
+        assert vbm.ip(vmname='first', wait=True, timeout=10) is None
+
+
 def test_vbm_start_gui():
     """Test start method."""
     vbm = mech.vbm.VBoxManage(executable='/bin/VBoxManage', test_mode=True)
@@ -112,6 +160,46 @@ def test_vbm_unregister():
     expected = ['/bin/VBoxManage', 'unregistervm', 'first']
     got = vbm.unregister('first')
     assert got == expected
+    expected = ['/bin/VBoxManage', 'unregistervm', 'first', '--delete']
+    assert vbm.unregister('first', delete=True) == expected
+
+
+def test_vbm_clonevm():
+    """Test clonevm method."""
+    vbm = mech.vbm.VBoxManage(executable='/bin/VBoxManage', test_mode=True)
+    expected = ['/bin/VBoxManage', 'clonevm', 'base', '--name', 'first',
+                '--basefolder', '/tmp', '--register']
+    assert vbm.clonevm('base', 'first', base_folder='/tmp') == expected
+    expected = ['/bin/VBoxManage', 'clonevm', 'base', '--name', 'first',
+                '--basefolder', '/tmp', '--register',
+                '--snapshot', 'mech-template', '--options', 'link']
+    got = vbm.clonevm('base', 'first', base_folder='/tmp', snapshot='mech-template', link=True)
+    assert got == expected
+
+
+def test_vbm_snapshots():
+    """Test the snapshot methods."""
+    vbm = mech.vbm.VBoxManage(executable='/bin/VBoxManage', test_mode=True)
+    assert vbm.snapshot('base', 'snap') == ['/bin/VBoxManage', 'snapshot', 'base', 'take', 'snap']
+    assert vbm.delete_snapshot('base', 'snap') == ['/bin/VBoxManage', 'snapshot', 'base',
+                                                   'delete', 'snap']
+    assert vbm.restore_snapshot('base', 'snap') == ['/bin/VBoxManage', 'snapshot', 'base',
+                                                    'restore', 'snap']
+
+
+def test_vbm_list_snapshots():
+    """Test list_snapshots method."""
+    vbm = mech.vbm.VBoxManage(executable='/bin/VBoxManage')
+    output = ('SnapshotName="mech-template"\nSnapshotUUID="1234"\n'
+              'SnapshotName-1="child"\nSnapshotUUID-1="5678"\n'
+              'CurrentSnapshotName="child"\n')
+    with patch.object(vbm, 'run', return_value=output) as mock_run:
+        assert vbm.list_snapshots('base') == ['mech-template', 'child']
+        mock_run.assert_called_once_with('snapshot', 'base', 'list', '--machinereadable',
+                                         quiet=True)
+    # fails when there is no snapshot
+    with patch.object(vbm, 'run', return_value=None):
+        assert vbm.list_snapshots('base') == []
 
 
 def test_vbm_stop():
@@ -339,3 +427,78 @@ def test_vbm_list_running():
     with patch.object(mech.vbm.VBoxManage, 'run', return_value=output):
         got = vbm.list_running()
         assert got == expected
+
+
+async def fake_aip(vmname, quiet=False, timeout=None):
+    """Fake for VBoxManage._aip()."""
+    return '192.168.56.101'
+
+
+def test_vbm_vm_states():
+    """Test vm_states method."""
+    vbm = mech.vbm.VBoxManage(executable='/bin/VBoxManage', test_mode=True)
+    output = """Name:                        first
+Groups:                      /
+State:                       running (since 2020-02-28T00:24:40.461000000)
+Shared folders:
+
+Name: 'mech', Host path: '/tmp' (machine mapping), writable
+
+Name:                        second
+Groups:                      /
+State:                       powered off (since 2020-02-28T00:24:40.461000000)
+"""
+    expected = {'first': ('running', '192.168.56.101'), 'second': ('powered off', None)}
+    with patch.object(mech.vbm.VBoxManage, 'run', return_value=output) as mock_run:
+        with patch.object(mech.vbm.VBoxManage, '_aip', side_effect=fake_aip) as mock_ip:
+            got = vbm.vm_states()
+            assert got == expected
+            mock_run.assert_called_once()
+            mock_ip.assert_called_once()
+
+
+def test_vbm_vm_states_failed():
+    """Test vm_states method when VBoxManage fails."""
+    vbm = mech.vbm.VBoxManage(executable='/bin/VBoxManage', test_mode=True)
+    with patch.object(mech.vbm.VBoxManage, 'run', return_value=None):
+        assert vbm.vm_states() is None
+
+
+def test_vbm_arun():
+    """Test arun method."""
+    vbm = mech.vbm.VBoxManage(executable='/bin/VBoxManage', test_mode=True)
+    expected = ['/bin/VBoxManage', 'list', 'vms']
+    assert mech.utils.run_coroutine(vbm.arun('list', 'vms')) == expected
+
+
+@patch('mech.utils.run_async')
+def test_vbm_arun_timeout(mock_run_async):
+    """Test arun method when the command times out."""
+    async def timed_out(cmds, timeout=None):
+        return None, '', 'Timed out after 1 seconds'
+    mock_run_async.side_effect = timed_out
+    vbm = mech.vbm.VBoxManage(executable='/bin/VBoxManage')
+    assert mech.utils.run_coroutine(vbm.arun('list', 'vms', timeout=1)) is None
+
+
+def test_vbm_astart_astop():
+    """Test astart and astop methods."""
+    vbm = mech.vbm.VBoxManage(executable='/bin/VBoxManage', test_mode=True)
+    assert mech.utils.run_coroutine(vbm.astart('first')) == [
+        '/bin/VBoxManage', 'startvm', 'first', '--type', 'headless']
+    assert mech.utils.run_coroutine(vbm.astop('first')) == [
+        '/bin/VBoxManage', 'controlvm', 'first', 'poweroff']
+
+
+def test_vbm_aip_and_avm_state():
+    """Test aip and avm_state methods."""
+    vbm = mech.vbm.VBoxManage(executable='/bin/VBoxManage')
+
+    async def arun(cmd, *args, **kwargs):
+        if cmd == 'guestproperty':
+            return 'Value: 192.168.56.195'
+        return 'State:                       running (since 2020-02-28T00:24:40.461000000)'
+
+    with patch.object(mech.vbm.VBoxManage, 'arun', side_effect=arun):
+        assert mech.utils.run_coroutine(vbm.aip('first', wait=True)) == '192.168.56.195'
+        assert mech.utils.run_coroutine(vbm.avm_state('first')) == 'running'
@@ -1,9 +1,11 @@
 # Copyright (c) 2020 Mike Kinney
 """Tests for VMrun class."""
+import io
 from unittest.mock import patch, MagicMock, mock_open
 
 
 import mech.vmrun
+import mech.utils
 
 
 @patch('subprocess.Popen')
@@ -563,6 +565,10 @@ def test_vmrun_clone():
                 'a_dest_vmx', 'a_mode']
     got = vmrun.clone('a_dest_vmx', 'a_mode')
     assert got == expected
+    expected = ['/tmp/vmrun', '-T', 'ws', 'clone', '/tmp/first/some.vmx',
+                'a_dest_vmx', 'linked', '-snapshot=a_snapshot']
+    got = vmrun.clone('a_dest_vmx', 'linked', 'a_snapshot')
+    assert got == expected
 
 
 def test_vmrun_begin_recording():
@@ -680,49 +686,163 @@ def test_installed_tools(mock_tools_state):
     mock_tools_state.assert_called()
 
 
-@patch('os.path.isfile', return_value=True)
-def test_vm_state_started(mock_isfile):
+def write_vmware_log(tmpdir, contents):
+    """Write a vmware.log next to a vmx file, return the path to the vmx file."""
+    tmpdir.join('vmware.log').write(contents, mode='a')
+    return str(tmpdir.join('some.vmx'))
+
+
+def test_vm_state_started(tmpdir):
     """Test vm_state."""
-    vmrun = mech.vmrun.VMrun('/tmp/first/some.vmx', executable='/bin/vmrun',
+    vmx = write_vmware_log(tmpdir, 'blah\nReporting power state change (opcode=2, err=0)\nblah')
+    vmrun = mech.vmrun.VMrun(vmx, executable='/bin/vmrun',
                              user='admin', password='1234', provider='ws', test_mode=True)
-    a_mock = mock_open()
-    a_mock = mock_open(read_data='blah\nReporting power state change (opcode=2, err=0)\nblah')
-    with patch('builtins.open', a_mock, create=True):
-        assert vmrun.vm_state() == "started"
-        mock_isfile.assert_called()
+    assert vmrun.vm_state() == "started"
 
 
-@patch('os.path.isfile', return_value=True)
-def test_vm_state_stopped(mock_isfile):
+def test_vm_state_stopped(tmpdir):
     """Test vm_state."""
-    vmrun = mech.vmrun.VMrun('/tmp/first/some.vmx', executable='/bin/vmrun',
+    vmx = write_vmware_log(tmpdir, 'blah\nVMX exit (0)\nblah')
+    vmrun = mech.vmrun.VMrun(vmx, executable='/bin/vmrun',
                              user='admin', password='1234', provider='ws', test_mode=True)
-    a_mock = mock_open()
-    a_mock = mock_open(read_data='blah\nVMX exit (0)\nblah')
-    with patch('builtins.open', a_mock, create=True):
-        assert vmrun.vm_state() == "stopped"
-        mock_isfile.assert_called()
+    assert vmrun.vm_state() == "stopped"
 
 
-@patch('os.path.isfile', return_value=True)
-def test_vm_state_unpaused(mock_isfile):
+def test_vm_state_unpaused(tmpdir):
     """Test vm_state."""
-    vmrun = mech.vmrun.VMrun('/tmp/first/some.vmx', executable='/bin/vmrun',
+    vmx = write_vmware_log(tmpdir, 'blah\nVMAutomation_Pause: pause = FALSE\nblah')
+    vmrun = mech.vmrun.VMrun(vmx, executable='/bin/vmrun',
                              user='admin', password='1234', provider='ws', test_mode=True)
-    a_mock = mock_open()
-    a_mock = mock_open(read_data='blah\nVMAutomation_Pause: pause = FALSE\nblah')
-    with patch('builtins.open', a_mock, create=True):
-        assert vmrun.vm_state() == "unpaused"
-        mock_isfile.assert_called()
+    assert vmrun.vm_state() == "unpaused"
 
 
-@patch('os.path.isfile', return_value=True)
-def test_vm_state_paused(mock_isfile):
+def test_vm_state_paused(tmpdir):
     """Test vm_state."""
-    vmrun = mech.vmrun.VMrun('/tmp/first/some.vmx', executable='/bin/vmrun',
+    vmx = write_vmware_log(tmpdir, 'blah\nVMAutomation_Pause: pause = TRUE\nblah')
+    vmrun = mech.vmrun.VMrun(vmx, executable='/bin/vmrun',
                              user='admin', password='1234', provider='ws', test_mode=True)
-    a_mock = mock_open()
-    a_mock = mock_open(read_data='blah\nVMAutomation_Pause: pause = TRUE\nblah')
-    with patch('builtins.open', a_mock, create=True):
+    assert vmrun.vm_state() == "paused"
+
+
+def test_vm_state_no_log(tmpdir):
+    """Test vm_state without a vmware.log."""
+    vmrun = mech.vmrun.VMrun(str(tmpdir.join('some.vmx')), executable='/bin/vmrun',
+                             provider='ws', test_mode=True)
+    assert vmrun.vm_state() == "unknown"
+
+
+def test_vm_state_uses_cache(tmpdir):
+    """Test vm_state only reads what was appended to the log since the last call."""
+    vmx = write_vmware_log(tmpdir, 'blah\nVMAutomation_Pause: pause = TRUE\n')
+    vmrun = mech.vmrun.VMrun(vmx, executable='/bin/vmrun', provider='ws', test_mode=True)
+    assert vmrun.vm_state() == "paused"
+    assert tmpdir.join(mech.vmrun.VM_STATE_CACHE).check()
+    # unchanged log means the log is not read at all
+    with patch('mech.vmrun.last_log_state') as mock_last_log_state:
+        assert vmrun.vm_state() == "paused"
+        mock_last_log_state.assert_not_called()
+    # appended lines without a state change keep the cached state
+    size = tmpdir.join('vmware.log').size()
+    write_vmware_log(tmpdir, 'blah\n')
+    with patch('mech.vmrun.last_log_state', return_value=None) as mock_last_log_state:
         assert vmrun.vm_state() == "paused"
-        mock_isfile.assert_called()
+        assert mock_last_log_state.call_args[0][1] == size
+    write_vmware_log(tmpdir, 'VMX exit (0)\n')
+    assert vmrun.vm_state() == "stopped"
+
+
+def test_last_log_state_across_chunks():
+    """Test last_log_state with lines spanning many chunks."""
+    data = (b'VMX exit (0)\n' + b'x' * 100 + b'\nVMAutomation_Pause: pause = TRUE\n'
+            + b'y' * 100 + b'\n')
+    got = mech.vmrun.last_log_state(io.BytesIO(data), 0, len(data), chunk_size=7)
+    assert got == 'paused'
+    # only look at the beginning of the file
+    got = mech.vmrun.last_log_state(io.BytesIO(data), 0, 20, chunk_size=7)
+    assert got == 'stopped'
+    assert mech.vmrun.last_log_state(io.BytesIO(b'blah\nblah'), 0, 9, chunk_size=3) is None
+
+
+def test_last_line_offset():
+    """Test last_line_offset."""
+    data = b'one\ntwo\nthr'
+    assert mech.vmrun.last_line_offset(io.BytesIO(data), 0, len(data), chunk_size=2) == 8
+    assert mech.vmrun.last_line_offset(io.BytesIO(data), 9, len(data), chunk_size=2) == 9
+
+
+def test_vmrun_running_vms():
+    """Test running_vms method."""
+    vmrun = mech.vmrun.VMrun(executable='/tmp/vmrun', provider='ws', test_mode=True)
+    output = 'Total running VMs: 2\n/tmp/first/some.vmx\n/tmp/second/some.vmx'
+    with patch.object(mech.vmrun.VMrun, 'list', return_value=output):
+        assert vmrun.running_vms() == ['/tmp/first/some.vmx', '/tmp/second/some.vmx']
+
+
+async def fake_aget_guest_ip_address(wait=True, quiet=False, timeout=None):
+    """Fake for VMrun.aget_guest_ip_address()."""
+    return '192.168.2.120'
+
+
+@patch('mech.vmrun.VMrun.vm_state', return_value='started')
+@patch('mech.vmrun.VMrun.aget_guest_ip_address', side_effect=fake_aget_guest_ip_address)
+def test_vmrun_vm_states(mock_get_guest_ip_address, mock_vm_state):
+    """Test vm_states method."""
+    vmrun = mech.vmrun.VMrun(executable='/tmp/vmrun', provider='ws', test_mode=True)
+    output = 'Total running VMs: 1\n/tmp/first/some.vmx'
+    with patch.object(mech.vmrun.VMrun, 'list', return_value=output) as mock_list:
+        got = vmrun.vm_states(['/tmp/first/some.vmx', '/tmp/second/some.vmx'])
+        mock_list.assert_called_once()
+        mock_get_guest_ip_address.assert_called_once()
+        assert got == {'/tmp/first/some.vmx': ('started', '192.168.2.120'),
+                       '/tmp/second/some.vmx': ('started', None)}
+
+
+def test_vmrun_vm_states_failed():
+    """Test vm_states method when vmrun fails."""
+    vmrun = mech.vmrun.VMrun(executable='/tmp/vmrun', provider='ws', test_mode=True)
+    with patch.object(mech.vmrun.VMrun, 'list', return_value=None):
+        assert vmrun.vm_states(['/tmp/first/some.vmx']) is None
+
+
+def test_vmrun_avmrun():
+    """Test avmrun method."""
+    vmrun = mech.vmrun.VMrun('/tmp/first/some.vmx', executable='/tmp/vmrun',
+                             provider='ws', test_mode=True)
+    expected = ['/tmp/vmrun', '-T', 'ws', 'start', '/tmp/first/some.vmx', 'nogui']
+    assert mech.utils.run_coroutine(vmrun.astart()) == expected
+    expected = ['/tmp/vmrun', '-T', 'ws', 'stop', '/tmp/first/some.vmx', 'hard']
+    assert mech.utils.run_coroutine(vmrun.astop(mode='hard')) == expected
+
+
+@patch('mech.utils.run_async')
+def test_vmrun_aget_guest_ip_address(mock_run_async):
+    """Test aget_guest_ip_address method."""
+    async def run_async(cmds, timeout=None):
+        return 0, 'unknown\n', ''
+    mock_run_async.side_effect = run_async
+    vmrun = mech.vmrun.VMrun('/tmp/first/some.vmx', executable='/tmp/vmrun', provider='ws')
+    assert mech.utils.run_coroutine(vmrun.aget_guest_ip_address(wait=False)) == ''
+    assert mock_run_async.call_args[0][0] == ['/tmp/vmrun', '-T', 'ws', 'getGuestIPAddress',
+                                              '/tmp/first/some.vmx']
+
+
+@patch('mech.utils.run_async')
+def test_vmrun_avmrun_failed(mock_run_async):
+    """Test avmrun method when the command fails or times out."""
+    async def failed(cmds, timeout=None):
+        return 255, '', 'Error: The virtual machine is not powered on'
+
+    async def timed_out(cmds, timeout=None):
+        return None, '', 'Timed out after 1 seconds'
+    vmrun = mech.vmrun.VMrun('/tmp/first/some.vmx', executable='/tmp/vmrun', provider='ws')
+    mock_run_async.side_effect = failed
+    assert mech.utils.run_coroutine(vmrun.astop(quiet=True)) is None
+    mock_run_async.side_effect = timed_out
+    assert mech.utils.run_coroutine(vmrun.astop(timeout=1)) is None
+
+
+def test_vmrun_avm_state(tmpdir):
+    """Test avm_state method."""
+    vmx = write_vmware_log(tmpdir, 'blah\nVMX exit (0)\n')
+    vmrun = mech.vmrun.VMrun(vmx, executable='/bin/vmrun', provider='ws', test_mode=True)
+    assert mech.utils.run_coroutine(vmrun.avm_state()) == 'stopped'
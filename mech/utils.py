@@ -30,16 +30,29 @@ from __future__ import division, absolute_import
 import os
 import re
 import random
+import asyncio
 import string
+import socket
 import sys
+import time
 import json
+import glob
+import gzip
+import shlex
+import hashlib
+import ntpath
+import posixpath
 import tarfile
+import zipfile
 import fnmatch
 import logging
 import tempfile
 import subprocess
+import threading
 import collections
-from shutil import copyfile, rmtree
+import weakref
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+from shutil import copy2, copymode, rmtree
 
 import requests
 import click
@@ -51,6 +64,77 @@ from .mech_cloud_instance import MechCloudInstance
 
 LOGGER = logging.getLogger('mech')
 
+# process-wide cache of the vmrun executable and its host types (see get_provider())
+VMRUN_CACHE = {}
+
+# maximum number of provider commands (vmrun/VBoxManage) run at the same time
+# by the asynchronous engine (see run_async())
+ASYNC_CONCURRENCY = 8
+ASYNC_SEMAPHORES = weakref.WeakKeyDictionary()
+
+# winrm clients (and their connection), by instance (see winrm_client())
+WINRM_CLIENTS = weakref.WeakKeyDictionary()
+WINRM_CLIENTS_LOCK = threading.Lock()
+
+# extensions of files whose content is already compressed
+# (not worth compressing again when provisioning files)
+COMPRESSED_EXTENSIONS = ('.7z', '.box', '.bz2', '.gif', '.gz', '.iso', '.jar', '.jpeg', '.jpg',
+                         '.mp3', '.mp4', '.png', '.rpm', '.deb', '.tgz', '.whl', '.xz', '.zip',
+                         '.zst')
+
+# files sent with winrm are split in chunks of (at least) this size, sent over
+# up to WINRM_COPY_STREAMS connections at the same time (see winrm_upload())
+WINRM_CHUNK_SIZE = 8 * 1024 * 1024
+WINRM_COPY_STREAMS = 4
+# files at least this big are copied with VMware Tools when possible
+VMRUN_COPY_MIN_SIZE = 16 * 1024 * 1024
+
+UNSAFE_BOX = ("This box is comprised of filenames starting with '/' or '..' \n"
+              "Exiting for the safety of your files.")
+
+# name of the snapshot that linked clones are made of
+# (see vmware_template() and virtualbox_template())
+TEMPLATE_SNAPSHOT = 'mech-template'
+
+# ioctl to clone a file (copy-on-write), see reflink()
+FICLONE = 0x40049409
+
+# box downloads are retried this many times (when the connection fails),
+# waiting 1, 2, 4, ... (up to DOWNLOAD_MAX_DELAY) seconds in between
+DOWNLOAD_RETRIES = 5
+DOWNLOAD_MAX_DELAY = 30
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_ERRORS = (requests.ConnectionError, requests.Timeout,
+                   requests.exceptions.ChunkedEncodingError)
+# (connect, read) timeouts in seconds of the download requests, so a stalled
+# connection fails (and is retried) instead of blocking
+DOWNLOAD_TIMEOUT = (10, 60)
+# big downloads are done in segments (of DOWNLOAD_SEGMENT_MIN to
+# DOWNLOAD_SEGMENT_MAX bytes) over DOWNLOAD_CONNECTIONS connections at the same
+# time, at up to DOWNLOAD_LIMIT_RATE bytes/s in total (no limit if None)
+DOWNLOAD_SEGMENT_MIN = 8 * 1024 * 1024
+DOWNLOAD_SEGMENT_MAX = 64 * 1024 * 1024
+DOWNLOAD_CONNECTIONS = 4
+DOWNLOAD_LIMIT_RATE = None
+
+# seconds an idle ssh master connection is kept around (see ssh_master())
+SSH_CONTROL_PERSIST = 600
+
+# per-thread prefix for output written while running instances in parallel
+# (see run_parallel())
+OUTPUT_PREFIX = threading.local()
+OUTPUT_LOCK = threading.Lock()
+# returned by a worker of run_parallel() that had nothing to do (not a failure)
+SKIPPED = 'skipped'
+# per-thread event set when the run_parallel() a worker is part of is stopped
+# (see check_cancelled())
+CANCEL = threading.local()
+
+# locks so only one worker at a time adds a given box (see init_box())
+BOX_LOCKS = {}
+BOX_LOCKS_LOCK = threading.Lock()
+CHECKSUMS_LOCK = threading.Lock()
+
 
 def main_dir():
     """Return the main directory."""
@@ -73,8 +157,14 @@ def makedirs(name, mode=0o777):
 def start_vm(inst):
     """Start VM.
        inst is a MechInstance
+       Return True if the VM was started (and provisioned, unless
+       provisioning is disabled).
     """
     LOGGER.debug('inst:%s', inst)
+    inst.clear_runtime()
+    winrm_close(inst)
+    # the VM may have been stopped (or got another ip address) since
+    ssh_stop_master(inst)
     started = None
     if inst.provider == 'vmware':
         # Note: user/password is needed for provisioning
@@ -100,7 +190,9 @@ def start_vm(inst):
         click.secho("VM not started", fg="red")
     else:
         click.secho("Getting IP address...", fg="blue")
+        start = time.time()
         ip_address = inst.get_ip(wait=True)
+        click.secho("Waited {:.1f}s for the IP address".format(time.time() - start), fg="blue")
 
         if not inst.disable_shared_folders:
             # Note: virtualbox shared folders is before VM is started
@@ -126,8 +218,7 @@ def start_vm(inst):
         if inst.remove_vagrant:
             del_user(inst, 'vagrant')
 
-        if not inst.disable_provisioning:
-            provision(inst, show=False)
+    return started is not None and (inst.disable_provisioning or provision(inst, show=False))
 
 
 def confirm(prompt, default='y'):
@@ -154,7 +245,7 @@ def confirm(prompt, default='y'):
 
 
 def unpause_vm(inst):
-    """Unpause a VM."""
+    """Unpause a VM (or start it, if it cannot be). Return True if it is running."""
     if inst.provider == 'vmware':
         vmrun = VMrun(inst.vmx)
         if vmrun.unpause(quiet=True) is not None:
@@ -169,9 +260,9 @@ def unpause_vm(inst):
                 click.secho("VM resumed on {}".format(ip_address), fg="green")
             else:
                 click.secho("VM resumed on an unknown IP address", fg="green")
-        else:
-            # Otherwise try starting
-            start_vm(inst)
+            return True
+        # Otherwise try starting
+        return start_vm(inst)
     else:
         vbm = mech.vbm.VBoxManage()
         if vbm.resume(inst.name, quiet=True) is not None:
@@ -182,9 +273,9 @@ def unpause_vm(inst):
                 click.secho("VM resumed on {}".format(ip_address), fg="green")
             else:
                 click.secho("VM resumed on an unknown IP address", fg="green")
-        else:
-            # Otherwise try starting
-            start_vm(inst)
+            return True
+        # Otherwise try starting
+        return start_vm(inst)
 
 
 def save_mechfile_entry(mechfile_entry, name, mechfile_should_exist=False):
@@ -407,6 +498,9 @@ def catalog_to_mechfile(catalog, name=None, box=None, box_version=None, provider
                     mechfile['box'] = catalog['name']
                     mechfile['box_version'] = current_version
                     mechfile['url'] = a_provider['url']
+                    if a_provider.get('checksum') and a_provider.get('checksum_type'):
+                        mechfile['checksum'] = a_provider['checksum']
+                        mechfile['checksum_type'] = a_provider['checksum_type']
                     mechfile['shared_folders'] = default_shared_folders()
                     return mechfile
     sys.exit(click.style("Couldn't find a compatible VM using "
@@ -443,11 +537,17 @@ def tar_cmd(*args, **kwargs):
 
 def init_box(name, box=None, box_version=None, location=None, force=False, save=True,
              instance_path=None, numvcpus=None, memsize=None, no_nat=False, provider=None,
-             windows=None):
+             windows=None, checksum=None, checksum_type=None, linked=False,
+             connections=None, limit_rate=None):
     """Initialize the box. This includes uncompressing the files
        from the box file and updating the vmx file with
        desired settings (if vmware).
 
+       Saved boxes are uncompressed once (see extract_box_image()), each
+       instance gets a clone (or copy) of the extracted files. If linked,
+       the instance is a linked clone of a template VM of the box instead
+       (see vmware_template() and virtualbox_template()).
+
        Return the full path to the vmx or vbox file.
 
        VMware will just use the files as extracted.
@@ -468,19 +568,27 @@ def init_box(name, box=None, box_version=None, location=None, force=False, save=
         # remove them after importing to virtualbox
         if vbox_path != '':
             instance_path += '_tmp'
+    # where the files of the box are (to import them with virtualbox)
+    box_path = instance_path
 
     # if we do not find the vmx file nor is the already imported files in place
     found_vmx_or_ovf = locate(instance_path, look_for)
     if not found_vmx_or_ovf and vbox_path != '':
-        name_version_box = add_box(
-            name=name,
-            box=box,
-            box_version=box_version,
-            location=location,
-            force=force,
-            save=save,
-            provider=provider,
-            windows=windows)
+        with box_lock(provider, box, box_version):
+            name_version_box = add_box(
+                name=name,
+                box=box,
+                box_version=box_version,
+                location=location,
+                force=force,
+                save=save,
+                provider=provider,
+                windows=windows,
+                checksum=checksum,
+                checksum_type=checksum_type,
+                validate=False,
+                connections=connections,
+                limit_rate=limit_rate)
         if not name_version_box:
             sys.exit(click.style("Cannot find a valid box with a VMX/OVF "
                                  "file in boxfile", fg="red"))
@@ -490,23 +598,48 @@ def init_box(name, box=None, box_version=None, location=None, force=False, save=
                                               box_parts[0], box_parts[1], box_version)))
         box_file = locate(box_dir, '*.box')
 
-        click.secho("Extracting box '{}'...".format(box_file), fg="blue")
-        makedirs(instance_path)
-        if sys.platform == 'win32':
-            cmd = tar_cmd('-xf', box_file, force_local=True)
-        else:
-            cmd = tar_cmd('-xf', box_file)
-        if cmd:
-            startupinfo = None
-            if os.name == "nt":
-                startupinfo = subprocess.STARTUPINFO()
-                startupinfo.dwFlags |= subprocess.SW_HIDE | subprocess.STARTF_USESHOWWINDOW
-            proc = subprocess.Popen(cmd, cwd=instance_path, startupinfo=startupinfo)
-            if proc.wait():
-                sys.exit(click.style("Cannot extract box", fg="red"))
+        if linked and not save:
+            click.secho("Linked clones need a saved box, copying the box instead.",
+                        fg="yellow")
+            linked = False
+        if save:
+            # extracted once per box version, then cloned for each instance
+            with box_lock(provider, box, box_version):
+                if linked and provider == 'vmware':
+                    template = vmware_template(box_file)
+                elif linked:
+                    template = virtualbox_template(box_file)
+                else:
+                    template = None
+            if template:
+                click.secho("Creating instance as a linked clone of '{}'...".format(template),
+                            fg="blue")
+                if provider == 'vmware':
+                    makedirs(instance_path)
+                    template = vmware_linked_clone(template, instance_path)
+                elif virtualbox_linked_clone(template, name):
+                    return locate(instance_path_save, '*.vbox')
+                else:
+                    template = None
+            if linked and not template:
+                click.secho("Cannot create a linked clone, copying the box instead.",
+                            fg="yellow")
+            if not template:
+                with box_lock(provider, box, box_version):
+                    image = extract_box_image(box_file, provider)
+            if not template and provider == 'vmware':
+                click.secho("Creating instance from '{}'...".format(image), fg="blue")
+                how = clone_tree(image, instance_path)
+                LOGGER.debug('files: %s', dict(how))
+            elif not template:
+                # virtualbox copies the files of the extracted box when importing them
+                box_path = image
         else:
-            tar = tarfile.open(box_file, 'r')
-            tar.extractall(instance_path)
+            click.secho("Extracting box '{}'...".format(box_file), fg="blue")
+            if os.path.isdir(instance_path):
+                # left over by an instance that could not be created
+                rmtree(instance_path)
+            fill_dir(instance_path, lambda path: extract_box(box_file, path, provider))
 
         if not save and box.startswith(tempfile.gettempdir()):
             os.unlink(box)
@@ -518,7 +651,7 @@ def init_box(name, box=None, box_version=None, location=None, force=False, save=
         update_vmx(vmx_path, numvcpus=numvcpus, memsize=memsize, no_nat=no_nat)
         return vmx_path
     else:
-        ovf_path = locate(instance_path, '*.ovf')
+        ovf_path = locate(box_path, '*.ovf')
         if not ovf_path:
             sys.exit(click.style("Cannot locate an OVF file", fg="red"))
         LOGGER.debug('ovf_path:%s', ovf_path)
@@ -529,17 +662,22 @@ def init_box(name, box=None, box_version=None, location=None, force=False, save=
         vbox_path = locate(instance_path_save, '*.vbox')
         if not vbox_path:
             sys.exit(click.style("Cannot locate a vbox file", fg="red"))
-        # remove the extracted files
-        rmtree(instance_path)
+        if box_path == instance_path:
+            # remove the extracted files
+            rmtree(instance_path)
         return vbox_path
 
 
 def add_box(name=None, box=None, box_version=None, location=None,
-            force=False, save=True, provider=None, windows=None):
-    """Add a box."""
+            force=False, save=True, provider=None, windows=None,
+            checksum=None, checksum_type=None, validate=True,
+            connections=None, limit_rate=None):
+    """Add a box (see add_box_file() for validate, download_file() for
+       connections and limit_rate)."""
     # build the dict
-    LOGGER.debug('name:%s box:%s box_version:%s location:%s provider:%s windows:%s',
-                 name, box, box_version, location, provider, windows)
+    LOGGER.debug('name:%s box:%s box_version:%s location:%s provider:%s windows:%s '
+                 'checksum_type:%s checksum:%s', name, box, box_version, location,
+                 provider, windows, checksum_type, checksum)
 
     mechfile_entry = build_mechfile_entry(
         box=box,
@@ -548,6 +686,9 @@ def add_box(name=None, box=None, box_version=None, location=None,
         box_version=box_version,
         provider=provider,
         windows=windows)
+    if checksum and checksum_type:
+        mechfile_entry['checksum'] = checksum
+        mechfile_entry['checksum_type'] = checksum_type
 
     return add_mechfile(
         mechfile_entry,
@@ -558,13 +699,16 @@ def add_box(name=None, box=None, box_version=None, location=None,
         force=force,
         save=save,
         provider=provider,
-        windows=windows)
+        windows=windows,
+        validate=validate,
+        connections=connections,
+        limit_rate=limit_rate)
 
 
 def add_mechfile(mechfile_entry, name=None, box=None, box_version=None,
                  location=None, force=False, save=True, provider=None,
-                 windows=None):
-    """Add a mechfile entry."""
+                 windows=None, validate=True, connections=None, limit_rate=None):
+    """Add a mechfile entry (see add_box() for the options)."""
     LOGGER.debug('mechfile_entry:%s name:%s box:%s box_version:%s location:%s '
                  'provider:%s windows:%s', mechfile_entry, name, box,
                  box_version, location, provider, windows)
@@ -577,24 +721,33 @@ def add_mechfile(mechfile_entry, name=None, box=None, box_version=None,
 
     url = mechfile_entry.get('url')
     box_file = mechfile_entry.get('file')
+    checksum = mechfile_entry.get('checksum')
+    checksum_type = mechfile_entry.get('checksum_type')
 
     if box_file:
         return add_box_file(box=box, box_version=box_version, filename=box_file,
                             force=force, save=save, provider=provider,
-                            windows=windows)
+                            windows=windows, checksum=checksum, checksum_type=checksum_type,
+                            validate=validate)
 
     if url:
         return add_box_url(name=name, box=box, box_version=box_version,
                            url=url, force=force, save=save,
-                           provider=provider, windows=windows)
+                           provider=provider, windows=windows,
+                           checksum=checksum, checksum_type=checksum_type,
+                           validate=validate, connections=connections,
+                           limit_rate=limit_rate)
     click.secho("Could not find a VMWare compatible VM for '{}'{}".format(
         name, " ({})".format(box_version) if box_version else ""), fg="red")
 
 
-def add_box_url(name, box, box_version, url, force=False, save=True, provider=None, windows=None):
-    """Add a box using the URL."""
-    LOGGER.debug('name:%s box:%s box_version:%s url:%s provider:%s windows:%s',
-                 name, box, box_version, url, provider, windows)
+def add_box_url(name, box, box_version, url, force=False, save=True, provider=None, windows=None,
+                checksum=None, checksum_type=None, validate=True,
+                connections=None, limit_rate=None):
+    """Add a box using the URL (see add_box() for the options)."""
+    LOGGER.debug('name:%s box:%s box_version:%s url:%s provider:%s windows:%s checksum_type:%s '
+                 'checksum:%s', name, box, box_version, url, provider, windows,
+                 checksum_type, checksum)
     box_parts = box.split('/')
     first_box_part = box_parts[0]
     second_box_part = ''
@@ -614,36 +767,36 @@ def add_box_url(name, box, box_version, url, force=False, save=True, provider=No
                         "Attempting to download...".format(provider, box), fg="blue")
         try:
             click.secho("URL: {}".format(url), fg="blue")
-            response = requests.get(url, stream=True)
-            response.raise_for_status()
-            length = int(response.headers['content-length'])
-            chunk_size = 1024 * 1024
-            with click.progressbar(length=length, label="Downloading") as bar:
-                the_file = tempfile.NamedTemporaryFile(delete=False)
-                try:
-                    for chunk in response.iter_content(chunk_size=chunk_size):
-                        if chunk:
-                            the_file.write(chunk)
-                            bar.update(chunk_size)
-                    the_file.close()
-                    if response.headers.get('content-type') == 'application/json':
-                        # Downloaded URL might be a Vagrant catalog if it's json:
-                        catalog = json.load(the_file.name)
-                        mechfile = catalog_to_mechfile(catalog, name, box, box_version)
-                        return add_mechfile(
-                            mechfile,
-                            name=name,
-                            box_version=box_version,
-                            force=force,
-                            save=save,
-                            windows=windows)
-                    else:
-                        # Otherwise it must be a valid box:
-                        return add_box_file(box=box, box_version=box_version,
-                                            filename=the_file.name, url=url, force=force,
-                                            save=save, provider=provider, windows=windows)
-                finally:
-                    os.unlink(the_file.name)
+            filename = os.path.join(download_dir(), download_name(url))
+            content_type = download_file(url, filename, connections=connections,
+                                         limit_rate=limit_rate, checksum=checksum,
+                                         checksum_type=checksum_type)
+            try:
+                if content_type == 'application/json':
+                    # Downloaded URL might be a Vagrant catalog if it's json:
+                    with open(filename) as the_file:
+                        catalog = json.load(the_file)
+                    mechfile = catalog_to_mechfile(catalog, name, box, box_version)
+                    return add_mechfile(
+                        mechfile,
+                        name=name,
+                        box_version=box_version,
+                        force=force,
+                        save=save,
+                        windows=windows,
+                        validate=validate,
+                        connections=connections,
+                        limit_rate=limit_rate)
+                else:
+                    # Otherwise it must be a valid box:
+                    return add_box_file(box=box, box_version=box_version,
+                                        filename=filename, url=url, force=force,
+                                        save=save, provider=provider, windows=windows,
+                                        checksum=checksum, checksum_type=checksum_type,
+                                        move=True, validate=validate)
+            finally:
+                if os.path.isfile(filename):
+                    os.unlink(filename)
         except requests.HTTPError as exc:
             sys.exit(click.style(("Bad response: %s" % exc), fg="red"))
         except requests.ConnectionError:
@@ -651,59 +804,978 @@ def add_box_url(name, box, box_version, url, force=False, save=True, provider=No
     return name, box_version, box
 
 
-def add_box_file(box=None, box_version=None, filename=None, url=None,
-                 force=False, save=True, provider=None, windows=None):
-    """Add a box using a file as the source. Returns box and box_version."""
-    click.secho("\nChecking integrity of provider:{} box:'{}' "
-                "\nfilename:{}...".format(provider, box, filename), fg="blue")
+def download_dir():
+    """Return the directory (in the box cache) where boxes are downloaded."""
+    return os.path.join(mech_dir(), 'boxes', '.downloads')
 
-    valid_endswith = 'vmx'
-    look_for = '*.vmx'
-    if provider == 'virtualbox':
-        valid_endswith = 'ovf'
-        look_for = '*.ovf'
 
-    click.secho("looking for:{}...".format(look_for), fg="blue")
-    if sys.platform == 'win32':
-        cmd = tar_cmd('-tf', filename, look_for, wildcards=True, fast_read=True, force_local=True)
+def download_name(url):
+    """Return the name of the file an url is downloaded to (unique for the url)."""
+    basename = os.path.basename(url.split('?', 1)[0].rstrip('/')) or 'download'
+    return '{}-{}'.format(hashlib.sha256(url.encode('utf-8')).hexdigest()[:16], basename)
+
+
+def load_download_state(partial):
+    """Load the sidecar of a partial download (url, etag, length and content type)."""
+    try:
+        with open(partial + '.json') as the_file:
+            state = json.load(the_file)
+    except (OSError, ValueError):
+        return {}
+    return state if isinstance(state, dict) else {}
+
+
+def save_download_state(partial, state):
+    """Save the sidecar of a partial download."""
+    with open(partial + '.json', 'w') as the_file:
+        json.dump(state, the_file, sort_keys=True, indent=2)
+
+
+def discard_download(partial):
+    """Remove a partial download (and its sidecar)."""
+    for path in (partial, partial + '.json'):
+        if os.path.isfile(path):
+            os.unlink(path)
+
+
+def download_file(url, filename, connections=None, limit_rate=None,
+                  checksum=None, checksum_type=None):
+    """Download url to filename, resuming an interrupted download if possible.
+
+       The download is written to 'filename.partial', next to a sidecar
+       ('filename.partial.json') with the url, etag and length. If the
+       connection fails, it is retried (with a backoff) from where it
+       stopped, using an HTTP Range request. The file is only renamed to
+       filename once it is complete.
+
+       Big downloads from servers supporting Range requests are downloaded in
+       segments over several connections at the same time (see
+       download_segments()). limit_rate caps the download speed (bytes/s).
+
+       If there is a checksum, it is computed as the download is written
+       and checked before the file is renamed (a download that does not
+       match is discarded).
+
+       Returns the content type of the download.
+    """
+    if connections is None:
+        connections = DOWNLOAD_CONNECTIONS
+    if limit_rate is None:
+        limit_rate = DOWNLOAD_LIMIT_RATE
+    makedirs(os.path.dirname(filename))
+    partial = filename + '.partial'
+    state = load_download_state(partial)
+    if state.get('url') != url:
+        discard_download(partial)
+        state = {}
+    limiter = RateLimiter(limit_rate)
+    hasher = DownloadHasher(partial, checksum_type) if usable_checksum(checksum,
+                                                                       checksum_type) else None
+    for _ in range(DOWNLOAD_RETRIES + 1):
+        if state.get('segments') is None:
+            state = download_stream(url, partial, state, connections, limiter, hasher)
+        if state.get('segments') is None:
+            break
+        try:
+            download_segments(url, partial, state, connections, limiter, hasher)
+            break
+        except DownloadChanged as exc:
+            LOGGER.debug('download changed: %s', exc)
+            click.secho("The download changed on the server, starting over...", fg="yellow")
+            discard_download(partial)
+            state = {}
+            if hasher:
+                hasher.restart()
     else:
-        cmd = tar_cmd('-tf', filename, look_for, wildcards=True, fast_read=True)
+        sys.exit(click.style("Cannot download '{}', it keeps changing".format(url), fg="red"))
+    if hasher:
+        hasher.catch_up(state.get('length') or os.path.getsize(partial))
+        if hasher.hexdigest() != checksum.lower():
+            discard_download(partial)
+            sys.exit(click.style("The {} checksum of '{}' is {}, expected {}".format(
+                checksum_type, url, hasher.hexdigest(), checksum.lower()), fg="red"))
+        click.secho("Valid {} checksum".format(checksum_type), fg="blue")
+    os.replace(partial, filename)
+    os.unlink(partial + '.json')
+    if hasher:
+        record_checksum(filename, checksum_type, hasher.hexdigest())
+    return state.get('content_type')
 
-    if cmd:
-        startupinfo = None
-        if os.name == "nt":
-            startupinfo = subprocess.STARTUPINFO()
-            startupinfo.dwFlags |= subprocess.SW_HIDE | subprocess.STARTF_USESHOWWINDOW
-        proc = subprocess.Popen(cmd, startupinfo=startupinfo)
-        valid_tar = not proc.wait()
+
+class DownloadChanged(Exception):
+    """What is downloaded changed on the server since the download started."""
+
+
+class Cancelled(Exception):
+    """The work was stopped (another worker of run_parallel() failed)."""
+
+
+def check_cancelled(event=None):
+    """Raise Cancelled if event (default: the one of the run_parallel()
+       worker of this thread) is set.
+    """
+    if event is None:
+        event = getattr(CANCEL, 'event', None)
+    if event is not None and event.is_set():
+        raise Cancelled()
+
+
+class DownloadHasher():
+    """Compute the checksum of a file as it is written (from its start).
+
+       Data written in order is hashed as it goes by (update()); data written
+       out of order (ex: segments) is hashed once everything before it is
+       there (catch_up()), while it is still in the page cache.
+    """
+
+    def __init__(self, path, checksum_type):
+        self.path = path
+        self.checksum = hashlib.new(checksum_type.lower())
+        self.position = 0
+
+    def update(self, data):
+        """Hash data written at the current position."""
+        self.checksum.update(data)
+        self.position += len(data)
+
+    def catch_up(self, end):
+        """Hash what is in the file from the current position up to end."""
+        if end <= self.position:
+            return
+        with open(self.path, 'rb') as the_file:
+            the_file.seek(self.position)
+            while self.position < end:
+                data = the_file.read(min(DOWNLOAD_CHUNK_SIZE, end - self.position))
+                if not data:
+                    break
+                self.update(data)
+
+    def restart(self, checksum_type=None):
+        """Start over (ex: the download started over)."""
+        self.checksum = hashlib.new(checksum_type or self.checksum.name)
+        self.position = 0
+
+    def hexdigest(self):
+        """Return the checksum (so far)."""
+        return self.checksum.hexdigest()
+
+
+def download_stream(url, partial, state, connections=1, limiter=None, hasher=None):
+    """Download url to the partial file in one stream (see download_file()).
+
+       If the download starts from the beginning, is big, and the server
+       supports Range requests, nothing is downloaded and the returned state
+       has (empty) 'segments', so it is downloaded with download_segments().
+
+       Returns the state of the download (see load_download_state()).
+    """
+    for attempt in range(DOWNLOAD_RETRIES + 1):
+        offset = os.path.getsize(partial) if state and os.path.isfile(partial) else 0
+        headers = {}
+        if offset:
+            click.secho("Resuming download at {:.1f} MB...".format(offset / 1e6), fg="blue")
+            headers['Range'] = 'bytes={}-'.format(offset)
+            if state.get('etag'):
+                headers['If-Range'] = state['etag']
+        try:
+            response = requests.get(url, stream=True, headers=headers,
+                                    timeout=DOWNLOAD_TIMEOUT)
+            if offset and response.status_code == 416:
+                # the partial file is not a part of what is there now
+                discard_download(partial)
+                state = {}
+                continue
+            response.raise_for_status()
+            if response.status_code != 206:
+                offset = 0
+                state = {'url': url,
+                         'etag': response.headers.get('etag'),
+                         'length': int(response.headers.get('content-length') or 0),
+                         'content_type': response.headers.get('content-type')}
+                if (connections > 1 and state['length'] >= 2 * DOWNLOAD_SEGMENT_MIN
+                        and response.headers.get('accept-ranges') == 'bytes'):
+                    response.close()
+                    state['segments'] = []
+                    save_download_state(partial, state)
+                    return state
+                save_download_state(partial, state)
+            length = state['length']
+            if hasher:
+                # hash what was downloaded before (if resuming)
+                hasher.restart()
+                hasher.catch_up(offset)
+            with open(partial, 'ab' if offset else 'wb') as the_file:
+                with click.progressbar(length=length or 1, label="Downloading") as progress:
+                    progress.update(offset)
+                    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        check_cancelled()
+                        if chunk:
+                            the_file.write(chunk)
+                            if hasher:
+                                hasher.update(chunk)
+                            progress.update(len(chunk))
+                            if limiter:
+                                limiter.throttle(len(chunk))
+            if length and os.path.getsize(partial) != length:
+                raise requests.ConnectionError('got {} of {} bytes'.format(
+                    os.path.getsize(partial), length))
+        except DOWNLOAD_ERRORS as exc:
+            if attempt == DOWNLOAD_RETRIES:
+                raise requests.ConnectionError(exc)
+            download_backoff(attempt, exc)
+            continue
+        return state
+    raise requests.ConnectionError("Could not download '{}'".format(url))
+
+
+def download_backoff(attempt, exc):
+    """Wait before retrying a download (1, 2, 4, ... seconds, up to DOWNLOAD_MAX_DELAY)."""
+    delay = min(2 ** attempt, DOWNLOAD_MAX_DELAY)
+    click.secho("Download interrupted ({}), retrying in {}s...".format(exc, delay), fg="yellow")
+    event = getattr(CANCEL, 'event', None)
+    if event is None:
+        time.sleep(delay)
+    else:
+        event.wait(delay)
+    check_cancelled()
+
+
+def missing_ranges(done, length):
+    """Return the (start, end) ranges of [0, length) that are not in the done ranges."""
+    missing = []
+    position = 0
+    for start, end in sorted(done):
+        if start > position:
+            missing.append((position, start))
+        position = max(position, end)
+    if position < length:
+        missing.append((position, length))
+    return missing
+
+
+def merge_ranges(ranges):
+    """Return the (start, end) ranges, sorted and merged where they touch."""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class SegmentQueue():
+    """Hand out the segments of a download to the connections.
+
+       Segments get smaller as less is left to download (but never smaller
+       than DOWNLOAD_SEGMENT_MIN), so that the connections finish at about
+       the same time.
+    """
+
+    def __init__(self, missing, connections):
+        self.lock = threading.Lock()
+        self.missing = collections.deque(missing)
+        self.connections = connections
+
+    def next(self):
+        """Return the next (start, end) segment to download (None if there is none)."""
+        with self.lock:
+            if not self.missing:
+                return None
+            left = sum([end - start for start, end in self.missing])
+            size = min(DOWNLOAD_SEGMENT_MAX,
+                       max(DOWNLOAD_SEGMENT_MIN, left // (self.connections * 2)))
+            start, end = self.missing.popleft()
+            if end - start > size:
+                self.missing.appendleft((start + size, end))
+                end = start + size
+            return start, end
+
+
+class RateLimiter():
+    """Cap the (total) rate of downloads, in bytes per second (no cap if rate is None)."""
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.total = 0
+
+    def throttle(self, size):
+        """Account for size bytes, waiting as needed to stay under the rate."""
+        if not self.rate:
+            return
+        with self.lock:
+            self.total += size
+            wait = self.total / self.rate - (time.time() - self.start)
+        if wait > 0:
+            time.sleep(wait)
+
+
+def write_at(fd, data, offset, lock):
+    """Write data at offset of the file descriptor
+       (os.pwrite where there is one, otherwise seek and write under lock).
+    """
+    if hasattr(os, 'pwrite'):
+        while data:
+            written = os.pwrite(fd, data, offset)
+            data = data[written:]
+            offset += written
+        return
+    with lock:
+        os.lseek(fd, offset, os.SEEK_SET)
+        while data:
+            data = data[os.write(fd, data):]
+
+
+def download_segments(url, partial, state, connections, limiter=None, hasher=None):
+    """Download url to the (preallocated) partial file in segments, over
+       several connections at the same time, using Range requests.
+
+       The segments already downloaded are kept in the state (see
+       load_download_state()), so an interrupted download only fetches
+       what is missing. If a connection fails, the others stop too.
+    """
+    length = state['length']
+    cancel = getattr(CANCEL, 'event', None)
+    stop = threading.Event()
+    done = [tuple(segment) for segment in state['segments']]
+    queue = SegmentQueue(missing_ranges(done, length), connections)
+    lock = threading.Lock()
+    hash_lock = threading.Lock()
+    with open(partial, 'r+b' if os.path.isfile(partial) else 'wb') as the_file:
+        the_file.truncate(length)
+    click.secho("Downloading with {} connections...".format(connections), fg="blue")
+
+    def fetch(fd, start, end, progress):
+        position = start
+        for attempt in range(DOWNLOAD_RETRIES + 1):
+            headers = {'Range': 'bytes={}-{}'.format(position, end - 1)}
+            if state.get('etag'):
+                headers['If-Range'] = state['etag']
+            try:
+                response = requests.get(url, stream=True, headers=headers,
+                                        timeout=DOWNLOAD_TIMEOUT)
+                response.raise_for_status()
+                if response.status_code != 206:
+                    # If-Range did not match: what is on the server is not what
+                    # the partial file is a part of
+                    response.close()
+                    raise DownloadChanged('Range request not honored (status {})'.format(
+                        response.status_code))
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    check_cancelled(stop)
+                    check_cancelled(cancel)
+                    if chunk:
+                        chunk = chunk[:end - position]
+                        write_at(fd, chunk, position, lock)
+                        position += len(chunk)
+                        with lock:
+                            progress.update(len(chunk))
+                        if limiter:
+                            limiter.throttle(len(chunk))
+                if position < end:
+                    raise requests.ConnectionError('got {} of {} bytes'.format(
+                        position - start, end - start))
+                return
+            except DOWNLOAD_ERRORS as exc:
+                if attempt == DOWNLOAD_RETRIES:
+                    raise requests.ConnectionError(exc)
+                download_backoff(attempt, exc)
+
+    def worker(progress):
+        # the connections run in their own threads, share the event of this worker
+        CANCEL.event = cancel
+        fd = os.open(partial, os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+        try:
+            segment = queue.next()
+            while segment is not None:
+                check_cancelled(stop)
+                fetch(fd, segment[0], segment[1], progress)
+                with lock:
+                    done.append(segment)
+                    state['segments'] = merge_ranges(done)
+                    save_download_state(partial, state)
+                    complete = state['segments'][0][1] if state['segments'][0][0] == 0 else 0
+                if hasher:
+                    with hash_lock:
+                        hasher.catch_up(complete)
+                segment = queue.next()
+        except BaseException:
+            stop.set()
+            raise
+        finally:
+            os.close(fd)
+
+    with click.progressbar(length=length, label="Downloading") as progress:
+        progress.update(sum([end - start for start, end in done]))
+        with ThreadPoolExecutor(max_workers=connections) as executor:
+            futures = [executor.submit(worker, progress) for _ in range(connections)]
+        errors = [future.exception() for future in futures if future.exception() is not None]
+        if errors:
+            # raise why it failed, not that the other connections were stopped
+            raise next((error for error in errors if not isinstance(error, Cancelled)),
+                       errors[0])
+
+
+def parse_rate(rate):
+    """Return the bytes per second of a rate like '500K', '10M' or '1G' (None for None)."""
+    if rate is None:
+        return None
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([kKmMgG]?)[bB]?\s*$', str(rate))
+    if not match:
+        raise ValueError("Invalid rate '{}' (ex: 500K, 10M)".format(rate))
+    multiplier = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}[match.group(2).lower()]
+    return int(float(match.group(1)) * multiplier)
+
+
+def usable_checksum(checksum, checksum_type):
+    """Return True if there is a checksum of a type that can be computed."""
+    if not checksum or not checksum_type:
+        return False
+    if checksum_type.lower() not in hashlib.algorithms_available:
+        click.secho("Unsupported checksum type ({}), not checking it".format(checksum_type),
+                    fg="yellow")
+        return False
+    return True
+
+
+def checksums_file():
+    """Return the path of the record of verified box checksums."""
+    return os.path.join(mech_dir(), 'boxes', 'checksums.json')
+
+
+def load_checksums():
+    """Load the verified box checksums (size, mtime and checksums, by path)."""
+    try:
+        with open(checksums_file()) as the_file:
+            checksums = json.load(the_file)
+    except (OSError, ValueError):
+        return {}
+    return checksums if isinstance(checksums, dict) else {}
+
+
+def record_checksum(path, checksum_type, checksum):
+    """Record the verified checksum of a box file (if the boxes directory exists)."""
+    if not os.path.isdir(os.path.dirname(checksums_file())):
+        return
+    with CHECKSUMS_LOCK:
+        # forget about the files that are gone
+        checksums = {key: value for key, value in load_checksums().items()
+                     if os.path.isfile(key)}
+        stat = os.stat(path)
+        key = os.path.abspath(path)
+        entry = checksums.get(key)
+        if not (isinstance(entry, dict) and entry.get('size') == stat.st_size
+                and entry.get('mtime') == stat.st_mtime_ns):
+            entry = {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+        entry[checksum_type.lower()] = checksum.lower()
+        checksums[key] = entry
+        try:
+            with open(checksums_file(), 'w') as the_file:
+                json.dump(checksums, the_file, sort_keys=True, indent=2)
+        except OSError as exc:
+            LOGGER.debug('could not save checksums: %s', exc)
+
+
+def file_checksum(path, checksum_type):
+    """Return the checksum of a file, from the record of verified checksums
+       if the file did not change since (otherwise, it is computed).
+    """
+    stat = os.stat(path)
+    entry = load_checksums().get(os.path.abspath(path))
+    if (isinstance(entry, dict) and entry.get('size') == stat.st_size
+            and entry.get('mtime') == stat.st_mtime_ns and entry.get(checksum_type.lower())):
+        LOGGER.debug('known %s checksum of %s', checksum_type, path)
+        return entry[checksum_type.lower()]
+    click.secho("Computing the {} checksum of {}...".format(checksum_type, path), fg="blue")
+    hasher = DownloadHasher(path, checksum_type)
+    hasher.catch_up(stat.st_size)
+    return hasher.hexdigest()
+
+
+def add_box_file(box=None, box_version=None, filename=None, url=None,
+                 force=False, save=True, provider=None, windows=None,
+                 checksum=None, checksum_type=None, move=False, validate=True):
+    """Add a box using a file as the source. Returns box and box_version.
+       If move, the file is moved to the box cache (ex: it was downloaded)
+       instead of being cloned, linked or copied (see place_file()).
+       If not validate, the box is not read now (unless its members were
+       indexed) but while it is extracted.
+    """
+    verified = usable_checksum(checksum, checksum_type)
+    if verified:
+        got = file_checksum(filename, checksum_type)
+        if got != checksum.lower():
+            sys.exit(click.style("The {} checksum of '{}' is {}, expected {}".format(
+                checksum_type, filename, got, checksum.lower()), fg="red"))
+        record_checksum(filename, checksum_type, got)
+
+    if save and not force:
+        cached = box_cache_file(box, box_version, provider, url if url else filename)
+        if os.path.exists(cached) and load_box_index(cached) is not None:
+            # already added (and checked) from the same box
+            return cached, box_version
+
+    members = load_box_index(filename)
+    if members is None and validate:
+        click.secho("\nChecking integrity of provider:{} box:'{}' "
+                    "\nfilename:{}...".format(provider, box, filename), fg="blue")
+        members = list_box(filename)
+        valid_tar = members is not None and check_box_members(members, provider)
+    elif members is None:
+        # checked while it is extracted (see extract_box())
+        valid_tar = True
     else:
-        tar = tarfile.open(filename, 'r')
-        files = tar.getnames()
-        valid_tar = False
-        for i in files:
-            if i.endswith(valid_endswith):
-                valid_tar = True
-                break
-            if i.startswith('/') or i.startswith('..'):
-                sys.exit(click.style("This box is comprised of filenames "
-                                     "starting with '/' or '..' \n"
-                                     "Exiting for the safety of your files.", fg="red"))
+        valid_tar = check_box_members(members, provider)
 
     if valid_tar:
         click.secho("Valid tar", fg="blue")
         if save:
-            boxname = os.path.basename(url if url else filename)
-            box = os.path.join(*filter(None, (mech_dir(), 'boxes', provider, box,
-                                              box_version, boxname)))
+            box = box_cache_file(box, box_version, provider, url if url else filename)
             path = os.path.dirname(box)
             makedirs(path)
             if not os.path.exists(box) or force:
-                copyfile(filename, box)
+                how = place_file(filename, box, move=move)
+                LOGGER.debug('%s %s to %s', how, filename, box)
+                if os.path.isdir(box_image_dir(box)):
+                    # extracted from the box it replaces
+                    rmtree(box_image_dir(box))
+                remove_box_templates(os.path.dirname(box))
+                if verified:
+                    record_checksum(box, checksum_type, checksum)
+                if members is not None:
+                    save_box_index(box, members)
         else:
             box = filename
         return box, box_version
 
 
+def box_cache_file(box, box_version, provider, source):
+    """Path of a box file in the box cache (named after its url or file)."""
+    return os.path.join(*filter(None, (mech_dir(), 'boxes', provider, box,
+                                       box_version, os.path.basename(source))))
+
+
+def box_index_file(box):
+    """The member index of a box file is kept next to it."""
+    return box + '.index.json'
+
+
+def load_box_index(box):
+    """Return the (checked) member names of a box file, if they were indexed
+       and the file did not change since. Otherwise, return None.
+    """
+    try:
+        with open(box_index_file(box)) as the_file:
+            index = json.load(the_file)
+        stat = os.stat(box)
+    except (OSError, ValueError):
+        return None
+    if not (isinstance(index, dict) and index.get('size') == stat.st_size
+            and index.get('mtime') == stat.st_mtime_ns
+            and isinstance(index.get('members'), list)):
+        return None
+    return index['members']
+
+
+def save_box_index(box, members):
+    """Save the member names of a box file (once they were checked)."""
+    stat = os.stat(box)
+    index = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'members': members}
+    temporary = '{}.{}.tmp'.format(box_index_file(box), random_string())
+    try:
+        with open(temporary, 'w') as the_file:
+            json.dump(index, the_file, indent=2)
+        os.replace(temporary, box_index_file(box))
+    except OSError as exc:
+        LOGGER.debug('could not save the index of %s: %s', box, exc)
+        if os.path.isfile(temporary):
+            os.unlink(temporary)
+
+
+def unsafe_member(name):
+    """Return True if a box member would be extracted outside of the instance directory."""
+    name = name.replace('\\', '/')
+    return (name.startswith('/') or re.match(r'^[a-zA-Z]:', name) is not None
+            or '..' in name.split('/'))
+
+
+def unsafe_tar_member(member, path):
+    """Return True if a tar member would be written (or would link) outside
+       of path, also through a symbolic link extracted before it.
+    """
+    if unsafe_member(member.name):
+        return True
+    root = os.path.realpath(path)
+    target = os.path.realpath(os.path.join(path, member.name))
+    if os.path.commonpath([root, target]) != root:
+        return True
+    if member.issym() or member.islnk():
+        if os.path.isabs(member.linkname):
+            return True
+        # a symbolic link is relative to its directory, a hard link to the archive
+        base = os.path.dirname(target) if member.issym() else root
+        linked = os.path.realpath(os.path.join(base, member.linkname))
+        if os.path.commonpath([root, linked]) != root:
+            return True
+    return False
+
+
+def check_box_members(members, provider):
+    """Exit if a member of the box is not safe to extract. Returns True if
+       there is a VMX (or OVF for virtualbox) file in the box.
+    """
+    if any(unsafe_member(name) for name in members):
+        sys.exit(click.style(UNSAFE_BOX, fg="red"))
+    valid_endswith = 'ovf' if provider == 'virtualbox' else 'vmx'
+    return any(name.endswith(valid_endswith) for name in members)
+
+
+def list_box(filename):
+    """List the members of a box file (reading it once).
+       Returns None if it is not a valid tar archive.
+    """
+    cmd = tar_cmd('-tf', filename, force_local=sys.platform == 'win32')
+    if cmd:
+        startupinfo = None
+        if os.name == "nt":
+            startupinfo = subprocess.STARTUPINFO()
+            startupinfo.dwFlags |= subprocess.SW_HIDE | subprocess.STARTF_USESHOWWINDOW
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, startupinfo=startupinfo, text=True)
+        stdoutdata, _ = proc.communicate()
+        if proc.returncode:
+            return None
+        return stdoutdata.splitlines()
+    try:
+        with tarfile.open(filename, 'r|*') as tar:
+            return [member.name for member in tar]
+    except (OSError, tarfile.TarError) as exc:
+        LOGGER.debug('cannot read %s: %s', filename, exc)
+        return None
+
+
+def extract_box(box_file, path, provider=None):
+    """Extract a box file to path.
+
+       If the members of the box were indexed (they were checked when the
+       box was added), it is extracted with tar. Otherwise, the members are
+       checked as they are extracted (the box is only read once) and indexed.
+       Exits if the box cannot be extracted or has no VMX (or OVF) file, path
+       is then only partly filled (see fill_dir()).
+    """
+    if load_box_index(box_file) is not None:
+        cmd = tar_cmd('-xf', box_file, force_local=sys.platform == 'win32')
+        if cmd:
+            startupinfo = None
+            if os.name == "nt":
+                startupinfo = subprocess.STARTUPINFO()
+                startupinfo.dwFlags |= subprocess.SW_HIDE | subprocess.STARTF_USESHOWWINDOW
+            proc = subprocess.Popen(cmd, cwd=path, startupinfo=startupinfo)
+            if proc.wait():
+                sys.exit(click.style("Cannot extract box", fg="red"))
+            return
+
+    cached = os.path.abspath(box_file).startswith(
+        os.path.abspath(os.path.join(mech_dir(), 'boxes')) + os.sep)
+    members = []
+    error = None
+    try:
+        with tarfile.open(box_file, 'r|*') as tar:
+            for member in tar:
+                if unsafe_tar_member(member, path):
+                    error = UNSAFE_BOX
+                    break
+                if hasattr(tarfile, 'data_filter'):
+                    tar.extract(member, path, filter='data')
+                else:
+                    tar.extract(member, path)
+                members.append(member.name)
+    except getattr(tarfile, 'FilterError', ()) as exc:
+        LOGGER.debug('cannot extract %s: %s', box_file, exc)
+        error = UNSAFE_BOX
+    except (OSError, tarfile.TarError) as exc:
+        LOGGER.debug('cannot extract %s: %s', box_file, exc)
+        error = "Cannot extract box"
+    if not error and not check_box_members(members, provider):
+        error = "Cannot find a valid box with a VMX/OVF file in boxfile"
+    if error:
+        if cached:
+            # it was not checked when it was added, do not keep it
+            os.unlink(box_file)
+        sys.exit(click.style(error, fg="red"))
+    if cached:
+        save_box_index(box_file, members)
+
+
+def box_image_dir(box_file):
+    """The files of a (cached) box file are extracted next to it."""
+    return os.path.join(os.path.dirname(box_file), 'extracted')
+
+
+def fill_dir(path, fill):
+    """Create the directory path with fill(directory), in a temporary
+       directory that is renamed to path once it is complete.
+    """
+    temporary = '{}.{}.tmp'.format(path, random_string())
+    makedirs(temporary)
+    try:
+        fill(temporary)
+        try:
+            os.replace(temporary, path)
+        except OSError:
+            # another mech made it meanwhile
+            if not os.path.isdir(path):
+                raise
+    finally:
+        if os.path.isdir(temporary):
+            rmtree(temporary)
+
+
+def extract_box_image(box_file, provider=None):
+    """Extract a box file to the 'extracted' directory next to it, unless
+       it was already. Returns that directory.
+    """
+    image = box_image_dir(box_file)
+    if not os.path.isdir(image):
+        click.secho("Extracting box '{}'...".format(box_file), fg="blue")
+        fill_dir(image, lambda path: extract_box(box_file, path, provider))
+    return image
+
+
+def box_template_dir(box_file):
+    """The template VM of a (cached) box file is next to it. A box that is
+       replaced gets another one (the linked clones of the template VM of the
+       box it replaces still need theirs, see remove_box_templates()).
+    """
+    stat = os.stat(box_file)
+    identity = '{}:{}'.format(stat.st_size, stat.st_mtime_ns)
+    return os.path.join(os.path.dirname(box_file),
+                        'template-' + hashlib.sha1(identity.encode()).hexdigest()[:8])
+
+
+def box_template_dirs(box_dir):
+    """Return the directories of the template VMs in a box (version) directory."""
+    try:
+        names = os.listdir(box_dir)
+    except OSError:
+        return []
+    return sorted(os.path.join(box_dir, name) for name in names
+                  if re.match(r'^template-[0-9a-f]{8}$', name))
+
+
+def vmware_template(box_file):
+    """Return the vmx file of the template VM of a (cached) box file, that
+       linked clones are made of (from its TEMPLATE_SNAPSHOT snapshot).
+
+       The template VM is made (registered and snapshotted) the first time,
+       from the extracted box (that it takes over, the box is not stored
+       once more). Returns None if it cannot be.
+    """
+    template = box_template_dir(box_file)
+    if not os.path.isdir(template):
+        click.secho("Creating template VM '{}'...".format(template), fg="blue")
+        image = box_image_dir(box_file)
+        if os.path.isdir(image):
+            os.replace(image, template)
+        else:
+            fill_dir(template, lambda path: extract_box(box_file, path, 'vmware'))
+    vmx = locate(template, '*.vmx')
+    if not vmx:
+        return None
+    vmrun = VMrun(vmx)
+    snapshots = vmrun.list_snapshots(quiet=True)
+    if snapshots is None:
+        return None
+    # the first line is the number of snapshots
+    if TEMPLATE_SNAPSHOT not in snapshots.splitlines()[1:]:
+        # not available with VMware Fusion (not needed to clone)
+        vmrun.register(quiet=True)
+        if vmrun.snapshot(TEMPLATE_SNAPSHOT) is None:
+            return None
+    return vmx
+
+
+def vmware_linked_clones(template):
+    """Return the disks (of the instances in mech_dir()) of the linked clones
+       of the template VM in the directory template.
+    """
+    template = os.path.abspath(template)
+    disks = []
+    for root, dirs, filenames in os.walk(mech_dir()):
+        if root == mech_dir() and 'boxes' in dirs:
+            dirs.remove('boxes')
+        for filename in fnmatch.filter(filenames, '*.vmdk'):
+            path = os.path.join(root, filename)
+            try:
+                # the descriptor of a disk is at its beginning (or is the whole file)
+                with open(path, 'rb') as the_file:
+                    head = the_file.read(65536)
+            except OSError:
+                continue
+            for match in re.finditer(rb'parentFileNameHint="([^"]*)"', head):
+                parent = os.path.join(root, match.group(1).decode('utf-8', 'replace'))
+                if os.path.abspath(parent).startswith(template + os.sep):
+                    disks.append(path)
+    return disks
+
+
+def remove_box_template(template):
+    """Remove the template VM in the directory template (see box_template_dir()),
+       if there is one. It is kept while it still has linked clones (their
+       disks are the changes from its disks). The base VM of virtualbox is
+       unregistered and deleted (virtualbox refuses when it has linked clones).
+       Return True if it was removed.
+    """
+    if not os.path.isdir(template):
+        return True
+    vmx = locate(template, '*.vmx')
+    if vmx:
+        if vmware_linked_clones(template):
+            click.secho("Keeping template VM '{}', it still has linked "
+                        "clones".format(template), fg="yellow")
+            return False
+        VMrun(vmx).unregister(quiet=True)
+    vbox_path = locate(template, '*.vbox')
+    if vbox_path:
+        vmname = os.path.splitext(os.path.basename(vbox_path))[0]
+        if mech.vbm.VBoxManage().unregister(vmname, delete=True, quiet=True) is None:
+            click.secho("Cannot remove base VM '{}' (does it still have linked "
+                        "clones?)".format(vmname), fg="yellow")
+            return False
+    rmtree(template)
+    return True
+
+
+def remove_box_templates(box_dir):
+    """Remove the template VMs in a box (version) directory (see remove_box_template()).
+       Return True if all of them were removed.
+    """
+    removed = [remove_box_template(template) for template in box_template_dirs(box_dir)]
+    return all(removed)
+
+
+def vmware_linked_clone(template, instance_path):
+    """Create a VM in instance_path as a linked clone of the template VM.
+       Returns the path of its vmx file (None if it failed).
+    """
+    vmx = os.path.join(instance_path, os.path.basename(template))
+    if VMrun(template).clone(vmx, 'linked', TEMPLATE_SNAPSHOT) is None:
+        return None
+    return vmx
+
+
+def virtualbox_template(box_file):
+    """Return the name of the base VM of a (cached) box file, that linked
+       clones are made of (from its TEMPLATE_SNAPSHOT snapshot).
+
+       The base VM is imported from the extracted box (in the template
+       directory next to it) and snapshotted the first time. The extracted
+       box is then removed (the base VM has its own copy of the files).
+       Returns None if it cannot be.
+    """
+    template = box_template_dir(box_file)
+    # VM names are global to virtualbox (but boxes are saved per directory),
+    # a box that is replaced gets another template (see box_template_dir())
+    vmname = 'mech-{}-{}'.format('-'.join(os.path.abspath(box_file).split(os.sep)[-4:-1]),
+                                 hashlib.sha1(template.encode()).hexdigest()[:8])
+    vbm = mech.vbm.VBoxManage()
+    if vbm.get_vm_info(vmname, quiet=True) is None:
+        vbox_path = locate(template, '*.vbox')
+        if vbox_path:
+            vbm.register(vbox_path, quiet=True)
+        else:
+            ovf_path = locate(extract_box_image(box_file, 'virtualbox'), '*.ovf')
+            if not ovf_path:
+                return None
+            click.secho("Importing base VM '{}'...".format(vmname), fg="blue")
+            vbm.importvm(path_to_ovf=ovf_path, name=vmname, base_folder=template, quiet=True)
+        if vbm.get_vm_info(vmname, quiet=True) is None:
+            return None
+        if os.path.isdir(box_image_dir(box_file)):
+            rmtree(box_image_dir(box_file))
+    if TEMPLATE_SNAPSHOT not in vbm.list_snapshots(vmname):
+        if vbm.snapshot(vmname, TEMPLATE_SNAPSHOT) is None:
+            return None
+    return vmname
+
+
+def virtualbox_linked_clone(template, name):
+    """Create (and register) the VM name as a linked clone of the template VM.
+       Returns True if it worked.
+    """
+    vbm = mech.vbm.VBoxManage()
+    return vbm.clonevm(template, name, base_folder=mech_dir(), snapshot=TEMPLATE_SNAPSHOT,
+                       link=True) is not None
+
+
+def clone_tree(source, destination):
+    """Clone (or copy) the files of the source directory to destination.
+       The files are never hard linked, the copies are meant to be changed.
+       Returns a Counter of how the files were placed (see place_file()).
+    """
+    how = collections.Counter()
+    for root, _, filenames in os.walk(source):
+        path = os.path.join(destination, os.path.relpath(root, source))
+        makedirs(path)
+        for filename in filenames:
+            how[place_file(os.path.join(root, filename), os.path.join(path, filename),
+                           link=False)] += 1
+    return how
+
+
+def reflink(source, destination):
+    """Make destination a copy-on-write clone of source (Linux FICLONE ioctl,
+       ex: btrfs, xfs). Return True if it worked.
+    """
+    if not sys.platform.startswith('linux'):
+        return False
+    import fcntl  # pylint: disable=import-outside-toplevel
+    try:
+        with open(source, 'rb') as src, open(destination, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return True
+    except OSError as exc:
+        LOGGER.debug('cannot reflink %s: %s', source, exc)
+        if os.path.isfile(destination):
+            os.unlink(destination)
+        return False
+
+
+def place_file(source, destination, move=False, link=True):
+    """Put a file at destination (atomically), without writing it again when possible.
+
+       If move, source is renamed (it is on the same filesystem, ex: a
+       download). Otherwise it is cloned (reflink), else hard linked (if
+       link), and copied only if neither is possible. The file mode is kept.
+
+       Returns how it was placed ('moved', 'cloned', 'linked' or 'copied').
+    """
+    if move:
+        os.replace(source, destination)
+        return 'moved'
+    temporary = '{}.{}.tmp'.format(destination, random_string())
+    try:
+        how = None
+        if reflink(source, destination=temporary):
+            copymode(source, temporary)
+            how = 'cloned'
+        elif link:
+            try:
+                os.link(source, temporary)
+                how = 'linked'
+            except OSError as exc:
+                LOGGER.debug('cannot hard link %s: %s', source, exc)
+        if how is None:
+            copy2(source, temporary)
+            how = 'copied'
+        os.replace(temporary, destination)
+    finally:
+        if os.path.isfile(temporary):
+            os.unlink(temporary)
+    return how
+
+
 def get_info_for_auth(mech_use=False):
     """Get information (username/pub_key) for authentication."""
     username = os.getlogin()
@@ -824,6 +1896,73 @@ def add_auth(instance):
         click.secho("No auth to add.", fg="blue")
 
 
+def vm_states(insts):
+    """Return the state and ip address of many instances at once.
+
+       Instead of asking the provider about each instance, ask each provider
+       once about all of its VMs ('vmrun list' or 'VBoxManage list -l vms').
+
+    Args:
+        insts (list of MechInstance): the instances
+
+    Returns:
+        dict of instance name: (state, ip_address) for the instances that
+        could be queried in bulk (instances not created, or whose provider
+        is not available, are left out)
+
+    """
+    states = {}
+    vmware_insts = [inst for inst in insts
+                    if inst.created and inst.provider == 'vmware' and inst.vmx]
+    if vmware_insts:
+        vmrun = VMrun()
+        if vmrun.installed():
+            results = vmrun.vm_states([inst.vmx for inst in vmware_insts])
+            if results is not None:
+                for inst in vmware_insts:
+                    states[inst.name] = results[inst.vmx]
+
+    vbox_insts = [inst for inst in insts if inst.created and inst.provider == 'virtualbox']
+    if vbox_insts:
+        vbm = mech.vbm.VBoxManage()
+        if vbm.installed():
+            results = vbm.vm_states()
+            if results is not None:
+                for inst in vbox_insts:
+                    states[inst.name] = results.get(inst.name, (None, None))
+    LOGGER.debug('states:%s', states)
+    return states
+
+
+def vm_running(inst):
+    """Return True if the VM of the instance is running (or paused), False if
+       it is not (ex: it is stopped, or the provider does not know it), or None
+       if the provider cannot tell.
+    """
+    if inst.provider == 'vmware':
+        vmrun = VMrun()
+        running = vmrun.running_vms() if vmrun.installed() else None
+        if running is None or not inst.vmx:
+            return None
+        running = set(os.path.normcase(os.path.realpath(vmx)) for vmx in running)
+        return os.path.normcase(os.path.realpath(inst.vmx)) in running
+    vbm = mech.vbm.VBoxManage()
+    states = vbm.vm_states() if vbm.installed() else None
+    if states is None:
+        return None
+    state = states.get(inst.name, (None, None))[0]
+    return state not in (None, 'powered off', 'aborted', 'saved')
+
+
+def port_open(ip_address, port, timeout=0.5):
+    """Return True if a TCP connection to ip_address:port can be made."""
+    try:
+        with socket.create_connection((ip_address, port), timeout=timeout):
+            return True
+    except (OSError, ValueError):
+        return False
+
+
 def vm_ready_based_on_state(state):
     """Return True if the state is one where we can communicate with it (scp/ssh, etc.)
     """
@@ -832,7 +1971,7 @@ def vm_ready_based_on_state(state):
     return False
 
 
-def ssh(instance, command, plain=None, extra=None, command_args=None):
+def ssh(instance, command, plain=None, extra=None, command_args=None, input_data=None):
     """Run ssh command.
 
        Parameters:
@@ -841,6 +1980,8 @@ def ssh(instance, command, plain=None, extra=None, command_args=None):
           plain(bool): use user/pass auth
           extra(str): arguments to pass to ssh
           command_args(str): arguments for command
+          input_data(bytes): send to the command's stdin (or a function writing
+                             to it), and show the output of the command as it runs
 
        Returns:
           return_code(int): 0=success
@@ -852,8 +1993,8 @@ def ssh(instance, command, plain=None, extra=None, command_args=None):
              which is useful, but could be MITM attacks. Not likely locally, but still
              could be an issue.
     """
-    LOGGER.debug('command:%s plain:%s extra:%s command_args:%s',
-                 command, plain, extra, command_args)
+    LOGGER.debug('command:%s plain:%s extra:%s command_args:%s input_data:%s',
+                 command, plain, extra, command_args, input_data is not None)
     if instance.created:
         state = instance.get_vm_state()
         if vm_ready_based_on_state(state):
@@ -866,6 +2007,7 @@ def ssh(instance, command, plain=None, extra=None, command_args=None):
                 cmds = ['ssh']
                 if not plain:
                     cmds.extend(('-F', temp_file.name))
+                    cmds.extend(ssh_master(instance, temp_file.name, config_ssh['Host']))
                 if not plain:
                     cmds.append(config_ssh['Host'])
                 if extra:
@@ -877,6 +2019,9 @@ def ssh(instance, command, plain=None, extra=None, command_args=None):
 
                 LOGGER.debug('cmds:%s', cmds)
 
+                # if streaming a script
+                if input_data is not None:
+                    return run_streaming(cmds, input_data)
                 # if running a script
                 if command:
                     result = subprocess.run(cmds, capture_output=True)
@@ -892,6 +2037,114 @@ def ssh(instance, command, plain=None, extra=None, command_args=None):
             return 1, '', 'VM not ready({})'.format(state)
 
 
+def run_streaming(cmds, input_data=None):
+    """Run a command, feeding it input_data and showing its output as it is produced.
+       input_data is either bytes or a function writing to the command's stdin.
+
+    Returns:
+        return_code(int): return code of the command
+        stdout(str): Output from the command
+        stderr(str): Error from the command
+
+    """
+    # the output is shown from other threads, keep the output prefix of this one
+    prefix = getattr(OUTPUT_PREFIX, 'prefix', None)
+    proc = subprocess.Popen(cmds, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    output = {False: [], True: []}
+
+    def pump(pipe, err):
+        OUTPUT_PREFIX.prefix = prefix
+        for line in iter(pipe.readline, b''):
+            line = line.decode('utf-8', 'replace')
+            output[err].append(line)
+            click.echo(line, nl=False, err=err)
+        pipe.close()
+
+    threads = [threading.Thread(target=pump, args=(proc.stdout, False)),
+               threading.Thread(target=pump, args=(proc.stderr, True))]
+    for thread in threads:
+        thread.start()
+    try:
+        if callable(input_data):
+            input_data(proc.stdin)
+        elif input_data:
+            proc.stdin.write(input_data)
+        proc.stdin.close()
+    except OSError as exc:
+        # the command exited early (or input_data could not be read): stop it,
+        # it would wait for the rest of its input
+        LOGGER.debug('cannot feed %s: %s', cmds[0], exc)
+        proc.kill()
+        try:
+            proc.stdin.close()
+        except OSError:
+            pass
+    for thread in threads:
+        thread.join()
+    return proc.wait(), ''.join(output[False]).strip(), ''.join(output[True]).strip()
+
+
+def ssh_control_path(instance):
+    """Return the path of the ssh control socket of the instance
+       (None if connection sharing cannot be used).
+    """
+    if sys.platform == 'win32' or not os.path.isdir(instance.path):
+        return None
+    control_path = os.path.join(instance.path, 'ssh-control')
+    # the path of a unix socket is limited to about 100 characters
+    if len(control_path) > 100:
+        return None
+    return control_path
+
+
+def ssh_master(instance, config_file, host):
+    """Make sure an ssh master connection to the instance is running
+       (so ssh/scp do not need a new connection and handshake each time).
+
+       Return the ssh options to use the master connection
+       (empty if it is not available).
+    """
+    control_path = ssh_control_path(instance)
+    if control_path is None:
+        return []
+    options = ['-o', 'ControlPath={}'.format(control_path)]
+    if os.path.exists(control_path):
+        result = subprocess.run(['ssh', '-F', config_file, '-O', 'check'] + options + [host],
+                                capture_output=True)
+        if result.returncode == 0:
+            return options + ['-o', 'ControlMaster=no']
+        # stale socket from a master that went away
+        try:
+            os.unlink(control_path)
+        except OSError:
+            pass
+    # Note: do not capture the output, the master stays in the background
+    cmds = ['ssh', '-F', config_file, '-N', '-f', '-o', 'ControlMaster=yes',
+            '-o', 'ControlPersist={}'.format(SSH_CONTROL_PERSIST)]
+    cmds.extend(options)
+    cmds.append(host)
+    result = subprocess.run(cmds, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+    LOGGER.debug('started ssh master:%s returncode:%s', control_path, result.returncode)
+    if result.returncode != 0:
+        return []
+    return options + ['-o', 'ControlMaster=no']
+
+
+def ssh_stop_master(instance):
+    """Stop the ssh master connection of the instance (if any)."""
+    control_path = ssh_control_path(instance)
+    if control_path is None or not os.path.exists(control_path):
+        return
+    subprocess.run(['ssh', '-o', 'ControlPath={}'.format(control_path), '-O', 'exit',
+                    instance.name], capture_output=True)
+    try:
+        os.unlink(control_path)
+    except OSError:
+        pass
+
+
 def scp(instance, src, dst, dst_is_host, extra=None):
     """Run scp command.
        Note: May not really need the tempfile if self.use_psk==True.
@@ -911,6 +2164,7 @@ def scp(instance, src, dst, dst_is_host, extra=None):
 
                 cmds = ['scp']
                 cmds.extend(('-F', temp_file.name))
+                cmds.extend(ssh_master(instance, temp_file.name, config_ssh['Host']))
                 if extra:
                     cmds.extend(extra)
 
@@ -959,18 +2213,29 @@ def del_user(instance, username):
     ssh(instance=instance, command=cmd)
 
 
-def provision(instance, show=False):
+def provision(instance, show=False, force=False, from_step=None, pyinfra_batch=None):
     """Provision an instance.
 
     Args:
         instance (MechInstance): an instance
         show (bool): just print the provisioning
+        force (bool): run every step, even the ones already applied
+        from_step (int): run the steps from this one (1 is the first step), even
+                         if they were already applied
+        pyinfra_batch (PyinfraBatch): runs the pyinfra steps shared with other
+                                      instances (provisioned at the same time)
+
+    Returns:
+        bool: True if every step succeeded (or was skipped)
 
     Notes:
         Valid provision types are:
            file: copies files to instances
            shell: executes scripts
 
+        A step is skipped when it was applied successfully before and its
+        fingerprint (the entry and the contents of its local files) is unchanged.
+
     """
 
     if not instance:
@@ -988,9 +2253,29 @@ def provision(instance, show=False):
     click.secho('Provisioning instance:{}'.format(instance.name), fg="green")
 
     provisioned = 0
+    skipped = 0
+    failed = 0
+    time_saved = 0.0
+    applied = {} if show else load_provisioned(instance)
+    pyinfra_keys = pyinfra_step_keys(instance.provision)
     if instance.provision:
         for i, pro in enumerate(instance.provision):
             provision_type = pro.get('type')
+            step = i + 1
+            if not show and provision_type in ('file', 'shell', 'ps', 'pyinfra'):
+                fingerprint = step_fingerprint(instance, pro)
+                record = applied.get(str(step))
+                if (not force and (from_step is None or step < from_step)
+                        and isinstance(record, dict) and record.get('fingerprint') == fingerprint):
+                    click.secho("Step {} ({}) already applied, skipping".format(
+                        step, provision_type), fg="blue")
+                    skipped += 1
+                    time_saved += record.get('duration', 0)
+                    if pyinfra_batch is not None and step in pyinfra_keys:
+                        pyinfra_batch.leave(instance, pyinfra_keys[step])
+                    continue
+                started = time.time()
+
             if provision_type == 'file':
                 source = pro.get('source')
                 destination = pro.get('destination')
@@ -1005,7 +2290,7 @@ def provision(instance, show=False):
                     LOGGER.debug('results:%s', results)
                     if results is None:
                         click.secho("Not Provisioned", fg="red")
-                        return
+                        return False
                 provisioned += 1
 
             elif provision_type == 'shell':
@@ -1022,9 +2307,11 @@ def provision(instance, show=False):
                 else:
                     click.secho("Inline shell provisioining (inline:{} path:{} args:{}".format(
                                 inline, path, args), fg="green")
-                    if provision_shell(instance, inline, path, args) is None:
+                    results = provision_shell(instance, inline, path, args,
+                                              stream=pro.get('stream', True))
+                    if results is None:
                         click.secho("Not Provisioned", fg="red")
-                        return
+                        return False
                 provisioned += 1
 
             elif provision_type == 'ps':
@@ -1041,9 +2328,10 @@ def provision(instance, show=False):
                 else:
                     click.secho("Inline ps provisioining (inline:{} path:{} args:{}".format(
                                 inline, path, args), fg="green")
-                    if provision_ps(instance, inline, path) is None:
+                    results = provision_ps(instance, inline, path)
+                    if results is None:
                         click.secho("Not Provisioned", fg="red")
-                        return
+                        return False
                 provisioned += 1
 
             elif provision_type == 'pyinfra':
@@ -1059,35 +2347,245 @@ def provision(instance, show=False):
                 else:
                     click.secho("pyinfra provisioining (path:{} args:{}".format(
                                 path, args), fg="green")
-                    return_code, stdout, stderr = provision_pyinfra(instance, path, args)
-                    if return_code is None:
+                    if pyinfra_batch is not None and pyinfra_batch.shared(pyinfra_keys[step]):
+                        results = pyinfra_batch.run(instance, pyinfra_keys[step], path, args)
+                    else:
+                        results = provision_pyinfra(instance, path, args)
+                    if results is None or results[0] is None:
                         click.secho("Not Provisioned", fg="red")
-                        return
-                    LOGGER.debug('return_code:%d stdout:%s stderr:%s', return_code, stdout, stderr)
+                        return False
+                    LOGGER.debug('results:%s', results)
                 provisioned += 1
 
             else:
                 click.secho("Not Provisioned - unknown provision type ({}) "
                             "(entries:{})".format(provision_type, i), fg="red")
-                return
+                return False
+
+            if not show:
+                if step_succeeded(results):
+                    applied[str(step)] = {'fingerprint': fingerprint,
+                                          'duration': round(time.time() - started, 3),
+                                          'time': time.time()}
+                else:
+                    click.secho("Step {} ({}) failed".format(step, provision_type), fg="red")
+                    applied.pop(str(step), None)
+                    failed += 1
+                save_provisioned(instance, applied)
         else:
             click.secho("VM ({}) Provision {} "
                         "entries".format(instance.name, provisioned), fg="green")
+            if not show and skipped:
+                click.secho("Executed {} and skipped {} steps (saved about {:.1f}s), "
+                            "use --force or --from-step to run them again".format(
+                                provisioned, skipped, time_saved), fg="green")
     else:
         click.secho("Nothing to provision", fg="blue")
+    return failed == 0
+
+
+def provisioned_path(instance):
+    """Return the path of the record of applied provisioning steps for the instance."""
+    return os.path.join(instance.path, 'provisioned.json')
+
+
+def load_provisioned(instance):
+    """Load the record of applied provisioning steps (fingerprint, duration and time, by step)."""
+    try:
+        with open(provisioned_path(instance)) as the_file:
+            applied = json.load(the_file)
+    except (OSError, ValueError, TypeError):
+        return {}
+    return applied if isinstance(applied, dict) else {}
+
+
+def save_provisioned(instance, applied):
+    """Save the record of applied provisioning steps (if the instance directory exists)."""
+    if not isinstance(instance.path, str) or not os.path.isdir(instance.path):
+        return
+    try:
+        with open(provisioned_path(instance), 'w') as the_file:
+            json.dump(applied, the_file, sort_keys=True, indent=2)
+    except OSError as exc:
+        LOGGER.debug('could not save provisioned steps: %s', exc)
+
+
+def step_succeeded(results):
+    """Return True if the results of a provisioning step are a success
+       (a return code of 0, when there is one).
+    """
+    if isinstance(results, (tuple, list)) and results and isinstance(results[0], int):
+        return results[0] == 0
+    return results is not None
+
+
+def step_fingerprint(instance, pro):
+    """Return the fingerprint (sha256) of a provisioning step: the entry itself, the
+       contents of the local files it uses (remote scripts are identified by their url)
+       and the version of the box of the instance (a new box needs the steps again).
+    """
+    local = pro.get('source') if pro.get('type') == 'file' else pro.get('path')
+    paths = []
+    if isinstance(local, str):
+        if os.path.isfile(local):
+            paths = [local]
+        elif os.path.isdir(local) or has_glob(local):
+            paths = [path for path, _ in walk_entries(file_entries(local))]
+    hashes = source_hashes(instance, paths) if paths else {}
+    contents = json.dumps({'entry': pro, 'files': hashes, 'box_version': instance.box_version},
+                          sort_keys=True, default=str)
+    return hashlib.sha256(contents.encode('utf-8')).hexdigest()
+
+
+def winrm_client(instance):
+    '''Return the winrm client of the instance.
+
+       The client (and its connection) is kept in a pool and shared by every
+       winrm operation on the instance, for as long as the instance is used.
+    '''
+    with WINRM_CLIENTS_LOCK:
+        client = WINRM_CLIENTS.get(instance)
+    if client is None:
+        suppress_urllib3_errors()
+        client = Client(instance.get_ip(), username=instance.user,
+                        password=instance.password, ssl=False)
+        with WINRM_CLIENTS_LOCK:
+            WINRM_CLIENTS[instance] = client
+    return client
+
+
+def winrm_close(instance):
+    '''Close the pooled winrm client of the instance (if there is one).'''
+    with WINRM_CLIENTS_LOCK:
+        client = WINRM_CLIENTS.pop(instance, None)
+    if client is None or not hasattr(client, 'close'):
+        return
+    try:
+        client.close()
+    except Exception as exc:  # pylint: disable=broad-except
+        LOGGER.debug('could not close winrm client: %s', exc)
+
+
+def winrm_call(instance, method, *args, **kwargs):
+    '''Call a method (ex: 'execute_ps') of the pooled winrm client of the instance.
+
+       A client that fails is dropped from the pool. If a reused client cannot
+       connect anymore (ex: the instance was restarted), the call is retried
+       once with a new client.
+    '''
+    with WINRM_CLIENTS_LOCK:
+        reused = instance in WINRM_CLIENTS
+    try:
+        return getattr(winrm_client(instance), method)(*args, **kwargs)
+    except requests.ConnectionError:
+        winrm_close(instance)
+        if not reused:
+            raise
+        LOGGER.debug('winrm connection lost, reconnecting')
+        return getattr(winrm_client(instance), method)(*args, **kwargs)
+    except Exception:
+        winrm_close(instance)
+        raise
 
 
 def winrm_copy(instance, local, remote):
     '''Copy file using winrm.'''
-    suppress_urllib3_errors()
-    client = Client(instance.get_ip(), username=instance.user,
-                    password=instance.password, ssl=False)
-    client.copy(local, remote)
+    if os.path.isfile(local):
+        if winrm_upload(instance, local, remote) is None:
+            return None
+    else:
+        winrm_call(instance, 'copy', local, remote)
     click.echo("Copied")
     # return code, stdout, stderr
     return 0, '', ''
 
 
+def winrm_upload(instance, local, remote, streams=WINRM_COPY_STREAMS):
+    '''Send a local file to the guest.
+
+       Small files are sent with one winrm copy (checked by pypsrp itself).
+       Big files are copied with VMware Tools when possible, or else split in
+       chunks sent over several winrm connections at the same time and joined
+       in the guest; either way the sha256 of the result is checked.
+       Environment variables in remote (ex: '%TEMP%') are expanded.
+
+       Returns the path of the file in the guest (None if it failed).
+    '''
+    size = os.path.getsize(local)
+    start = time.time()
+    chunks = min(streams, max(1, -(-size // WINRM_CHUNK_SIZE)))
+    if chunks == 1 and size < VMRUN_COPY_MIN_SIZE:
+        remote = winrm_call(instance, 'copy', local, remote, expand_variables=True)
+    else:
+        remote, _, _ = winrm_call(
+            instance, 'execute_ps',
+            "[Environment]::ExpandEnvironmentVariables('{}')".format(remote.replace("'", "''")))
+        remote = remote.strip()
+        if not (size >= VMRUN_COPY_MIN_SIZE and vmrun_upload(instance, local, remote)):
+            winrm_upload_chunks(instance, local, remote, chunks)
+        if guest_sha256(instance, [remote]).get(remote) != file_sha256(local):
+            click.secho("Could not verify the copy of ({}) to ({})".format(local, remote), fg="red")
+            return None
+    elapsed = max(time.time() - start, 0.001)
+    click.secho("Sent {:.1f} MB in {:.1f}s ({:.1f} MB/s)".format(
+        size / 1e6, elapsed, size / 1e6 / elapsed), fg="blue")
+    return remote
+
+
+def vmrun_upload(instance, local, remote):
+    '''Copy a local file to the guest with VMware Tools (vmware instances only).
+       Return True if it was copied.
+    '''
+    if instance.provider != 'vmware' or not instance.vmx:
+        return False
+    vmrun = VMrun(instance.vmx, user=instance.user, password=instance.password)
+    return vmrun.copy_file_from_host_to_guest(local, remote, quiet=True) is not None
+
+
+def winrm_upload_chunks(instance, local, remote, chunks):
+    '''Send a local file to the guest in chunks, each over its own winrm
+       connection (at the same time), then join them in the guest.
+    '''
+    chunk_size = -(-os.path.getsize(local) // chunks)
+    parts = ['{}.part{}'.format(remote, number) for number in range(chunks)]
+
+    def send(number):
+        the_file = tempfile.NamedTemporaryFile(delete=False)
+        try:
+            with open(local, 'rb') as source:
+                source.seek(number * chunk_size)
+                remaining = chunk_size
+                while remaining > 0:
+                    data = source.read(min(remaining, 1024 * 1024))
+                    if not data:
+                        break
+                    the_file.write(data)
+                    remaining -= len(data)
+            the_file.close()
+            client = Client(instance.get_ip(), username=instance.user,
+                            password=instance.password, ssl=False)
+            try:
+                client.copy(the_file.name, parts[number])
+            finally:
+                client.close()
+        finally:
+            the_file.close()
+            os.unlink(the_file.name)
+
+    suppress_urllib3_errors()
+    with ThreadPoolExecutor(max_workers=chunks) as executor:
+        # consume the results, to raise the first error (if any)
+        for _ in executor.map(send, range(chunks)):
+            pass
+    winrm_call(instance, 'execute_ps',
+               "$out = [IO.File]::Create('{remote}'); try {{ foreach ($p in @({parts})) {{ "
+               "$in = [IO.File]::OpenRead($p); "
+               "try {{ $in.CopyTo($out) }} finally {{ $in.Close() }}; "
+               "Remove-Item -LiteralPath $p }} }} finally {{ $out.Close() }}".format(
+                   remote=remote.replace("'", "''"),
+                   parts=', '.join(["'{}'".format(part.replace("'", "''")) for part in parts])))
+
+
 def winrm_execute_cmd(instance, command):
     '''Run command prompt command using winrm.
 
@@ -1097,10 +2595,7 @@ def winrm_execute_cmd(instance, command):
           stderr
     '''
     LOGGER.debug('instance.name:%s command:%s', instance.name, command)
-    suppress_urllib3_errors()
-    client = Client(instance.get_ip(), username=instance.user,
-                    password=instance.password, ssl=False)
-    stdout, stderr, return_code = client.execute_cmd(command)
+    stdout, stderr, return_code = winrm_call(instance, 'execute_cmd', command)
     LOGGER.debug('command:%s return_code:%d stdout:%s stderr:%s',
                  command, return_code, stdout, stderr)
     if stdout:
@@ -1119,15 +2614,12 @@ def winrm_execute_ps(instance, powershell, args=None):
           stderr (which will be '')
     '''
     LOGGER.debug('instance.name:%s powershell:%s args:%s', instance.name, powershell, args)
-    suppress_urllib3_errors()
 
     powershell_with_args = powershell
     if args is not None:
         powershell_with_args = '{} {}'.format(powershell, args)
 
-    client = Client(instance.get_ip(), username=instance.user,
-                    password=instance.password, ssl=False)
-    output, _, had_errors = client.execute_ps(powershell_with_args)
+    output, _, had_errors = winrm_call(instance, 'execute_ps', powershell_with_args)
     LOGGER.debug('powershell:%s output:%s had_errors:%s', powershell, output, had_errors)
 
     return_code = 0
@@ -1143,8 +2635,9 @@ def provision_file(instance, source, destination):
 
     Args:
         instance (MechInstance): instance of the MechInstance class
-        source (str): full path of a file to copy
-        source (str): full path where the file is to be copied to
+        source (str): full path of a file, a directory or a glob pattern to copy
+        destination (str): full path where the file is to be copied to
+                           (the directory to copy to for a directory or glob pattern)
 
     Returns:
         return_code
@@ -1152,10 +2645,32 @@ def provision_file(instance, source, destination):
         stderr
 
     Notes:
-       This function copies a file from host to guest.
+       This function copies files from host to guest.
+       Directories and glob patterns are sent as a single archive.
 
     """
     click.secho("Copying ({}) to ({})".format(source, destination), fg="blue")
+    if os.path.isdir(source) or has_glob(source):
+        entries = file_entries(source)
+        if not entries:
+            click.secho("Nothing to copy for ({})".format(source), fg="red")
+            return None
+        walked = list(walk_entries(entries))
+        changed = changed_files(instance, [(path, guest_path_join(instance, destination, arcname))
+                                           for path, arcname in walked])
+        if not changed:
+            click.secho("Unchanged, not copied", fg="blue")
+            return 0, '', ''
+        if len(changed) < len(walked):
+            # only send what changed
+            entries = [(path, arcname) for path, arcname in walked if path in changed]
+        if instance.windows is True:
+            click.secho("Note: Windows instance.", fg="blue")
+            return winrm_copy_files(instance, entries, destination)
+        return scp_files(instance, entries, destination)
+    if os.path.isfile(source) and not changed_files(instance, [(source, destination)]):
+        click.secho("Unchanged, not copied", fg="blue")
+        return 0, '', ''
     if instance.windows is True:
         click.secho("Note: Windows instance.", fg="blue")
         return winrm_copy(instance, source, destination)
@@ -1163,6 +2678,254 @@ def provision_file(instance, source, destination):
         return scp(instance, source, destination, True)
 
 
+def guest_path_join(instance, directory, name):
+    """Join a guest directory and a (host) relative path."""
+    if instance.windows is True:
+        return ntpath.join(directory, name.replace(os.sep, '\\').replace('/', '\\'))
+    return posixpath.join(directory, name.replace(os.sep, '/'))
+
+
+def file_manifest_path(instance):
+    """Return the path of the manifest of provisioned files for the instance."""
+    return os.path.join(instance.path, 'file_manifest.json')
+
+
+def load_file_manifest(instance):
+    """Load the manifest of provisioned files
+       (size, mtime and sha256 of the source files, by path).
+    """
+    try:
+        with open(file_manifest_path(instance)) as the_file:
+            manifest = json.load(the_file)
+    except (OSError, ValueError, TypeError):
+        return {}
+    return manifest if isinstance(manifest, dict) else {}
+
+
+def save_file_manifest(instance, manifest):
+    """Save the manifest of provisioned files (if the instance directory exists)."""
+    if not isinstance(instance.path, str) or not os.path.isdir(instance.path):
+        return
+    try:
+        with open(file_manifest_path(instance), 'w') as the_file:
+            json.dump(manifest, the_file, sort_keys=True, indent=2)
+    except OSError as exc:
+        LOGGER.debug('could not save file manifest: %s', exc)
+
+
+def file_sha256(path):
+    """Return the sha256 (hex digest) of a file."""
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as the_file:
+        for chunk in iter(lambda: the_file.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def source_hashes(instance, paths):
+    """Return the sha256 of the local files (by path).
+       Hashes from the manifest are reused when the size and mtime of a file are unchanged.
+    """
+    manifest = load_file_manifest(instance)
+    hashes = {}
+    for path in paths:
+        key = os.path.abspath(path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        entry = manifest.get(key)
+        unchanged = (isinstance(entry, dict) and entry.get('size') == stat.st_size
+                     and entry.get('mtime') == stat.st_mtime_ns)
+        if not unchanged:
+            entry = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'sha256': file_sha256(path)}
+            manifest[key] = entry
+        hashes[path] = entry['sha256']
+    save_file_manifest(instance, manifest)
+    return hashes
+
+
+def guest_sha256(instance, guest_paths):
+    """Return the sha256 of the files in the guest (by path), in one batch.
+       Files that do not exist (or cannot be read) are left out.
+    """
+    if not guest_paths:
+        return {}
+    hashes = {}
+    if instance.windows is True:
+        script = ("foreach ($p in @({})) {{ if (Test-Path -LiteralPath $p -PathType Leaf) {{ "
+                  "(Get-FileHash -Algorithm SHA256 -LiteralPath $p).Hash.ToLower() + '  ' + $p "
+                  "}} }}").format(', '.join(["'{}'".format(path.replace("'", "''"))
+                                             for path in guest_paths]))
+        try:
+            stdout, _, _ = winrm_call(instance, 'execute_ps', script)
+        except Exception as exc:  # pylint: disable=broad-except
+            LOGGER.debug('could not get the sha256 of guest files: %s', exc)
+            return {}
+    else:
+        command = 'sha256sum -- {} 2>/dev/null'.format(
+            ' '.join([guest_quote(path) for path in guest_paths]))
+        results = ssh(instance, command)
+        if not results or not isinstance(results[1], str):
+            return {}
+        stdout = results[1]
+    # the guest shows '~/...' paths expanded (ex: '/home/vagrant/...')
+    home_paths = [path for path in guest_paths if path.startswith('~/')]
+    for line in stdout.splitlines():
+        parts = line.strip().split('  ', 1)
+        if len(parts) == 2:
+            path = parts[1]
+            if path not in guest_paths:
+                path = next((home_path for home_path in home_paths
+                             if path.endswith(home_path[1:])), path)
+            hashes[path] = parts[0].lstrip('\\')
+    LOGGER.debug('guest hashes:%s', hashes)
+    return hashes
+
+
+def changed_files(instance, files):
+    """Return the local paths of the (local path, guest path) files that are different
+       (or missing) in the guest.
+    """
+    hashes = source_hashes(instance, [path for path, _ in files])
+    in_guest = guest_sha256(instance, [guest_path for _, guest_path in files])
+    return {path for path, guest_path in files
+            if hashes.get(path) is None or in_guest.get(guest_path) != hashes[path]}
+
+
+def has_glob(path):
+    """Return True if the path is a glob pattern."""
+    return any(char in path for char in '*?[')
+
+
+def file_entries(source):
+    """Return the (path, name in archive) of what to copy for a directory or glob pattern.
+       For a directory, that is what is in it (not the directory itself).
+    """
+    if os.path.isdir(source):
+        paths = [os.path.join(source, name) for name in os.listdir(source)]
+    else:
+        paths = glob.glob(source)
+    return [(path, os.path.basename(path)) for path in sorted(paths)]
+
+
+def walk_entries(entries):
+    """Yield (path, name in archive) for every file of the entries (walking directories)."""
+    for path, arcname in entries:
+        if os.path.isdir(path):
+            for root, _, filenames in os.walk(path):
+                for filename in sorted(filenames):
+                    full_path = os.path.join(root, filename)
+                    yield full_path, os.path.join(arcname, os.path.relpath(full_path, path))
+        else:
+            yield path, arcname
+
+
+def compressible(path):
+    """Return True if the file is worth compressing (based on its extension)."""
+    return not path.lower().endswith(COMPRESSED_EXTENSIONS)
+
+
+def worth_compressing(entries):
+    """Return True if most of the content of the entries (by size) is compressible."""
+    sizes = {True: 0, False: 0}
+    for path, _ in walk_entries(entries):
+        try:
+            sizes[compressible(path)] += os.path.getsize(path)
+        except OSError:
+            pass
+    return sizes[True] >= sizes[False]
+
+
+def write_tar(entries, fileobj, compress=True):
+    """Write a tar (gzip compressed if compress) archive of the entries to fileobj."""
+    gzip_file = None
+    if compress:
+        gzip_file = fileobj = gzip.GzipFile(fileobj=fileobj, mode='wb', compresslevel=6)
+    with tarfile.open(fileobj=fileobj, mode='w|') as tar:
+        for path, arcname in entries:
+            tar.add(path, arcname=arcname)
+    if gzip_file:
+        gzip_file.close()
+
+
+def guest_quote(path):
+    """Quote a path for the shell of the guest, a leading '~' is still
+       expanded to the home directory (as scp does).
+    """
+    if path == '~':
+        return path
+    if path.startswith('~/'):
+        return '~/' + shlex.quote(path[2:])
+    return shlex.quote(path)
+
+
+def scp_files(instance, entries, destination):
+    """Copy files/directories to the destination directory in the guest
+       using a single tar stream (file modes are preserved).
+
+    Returns:
+        return_code
+        stdout
+        stderr
+
+    """
+    compress = worth_compressing(entries)
+    command = 'mkdir -p {dest} && tar -x{z}pf - --no-same-owner -C {dest}'.format(
+        dest=guest_quote(destination), z='z' if compress else '')
+    LOGGER.debug('entries:%s compress:%s command:%s', entries, compress, command)
+    results = ssh(instance, command,
+                  input_data=lambda pipe: write_tar(entries, pipe, compress=compress))
+    if results is None or results[0] != 0:
+        click.secho("Could not copy files to ({})".format(destination), fg="red")
+        return None
+    click.echo("Copied")
+    return results
+
+
+def write_zip(entries, filename):
+    """Write a zip archive of the entries (compressing only what is compressible)."""
+    with zipfile.ZipFile(filename, 'w') as the_zip:
+        for path, arcname in walk_entries(entries):
+            the_zip.write(path, arcname=arcname,
+                          compress_type=zipfile.ZIP_DEFLATED if compressible(path)
+                          else zipfile.ZIP_STORED)
+
+
+def winrm_copy_files(instance, entries, destination):
+    """Copy files/directories to the destination directory in the guest
+       using a single zip archive (and the pooled winrm client).
+
+    Returns:
+        return_code
+        stdout
+        stderr
+
+    """
+    the_file = tempfile.NamedTemporaryFile(suffix='.zip', delete=False)
+    the_file.close()
+    try:
+        write_zip(entries, the_file.name)
+        remote_zip = winrm_upload(instance, the_file.name,
+                                  '%TEMP%\\mech_{}.zip'.format(random_string()))
+        if remote_zip is None:
+            return None
+        stdout, streams, had_errors = winrm_call(
+            instance, 'execute_ps',
+            "Expand-Archive -Path '{zip}' -DestinationPath '{dest}' -Force; "
+            "Remove-Item -Path '{zip}'".format(zip=remote_zip.replace("'", "''"),
+                                               dest=destination.replace("'", "''")))
+    finally:
+        os.unlink(the_file.name)
+    stderr = '\n'.join([str(error) for error in streams.error])
+    LOGGER.debug('stdout:%s stderr:%s had_errors:%s', stdout, stderr, had_errors)
+    if had_errors:
+        click.secho("Could not copy files to ({}): {}".format(destination, stderr), fg="red")
+        return None
+    click.echo("Copied")
+    return 0, stdout, stderr
+
+
 def create_tempfile_in_guest(instance):
     """Create a tempfile in the guest."""
     cmd = 'tmpfile=$(mktemp); echo $tmpfile'
@@ -1177,20 +2940,80 @@ def winrm_create_tempfile_in_guest(instance):
     return stdout
 
 
-def provision_shell(instance, inline, script_path, args=None):
+def read_script(inline, script_path):
+    """Return the contents (bytes) of the script to run (None if there is not one)."""
+    if script_path and os.path.isfile(script_path):
+        with open(script_path, 'rb') as the_file:
+            return the_file.read()
+    if script_path:
+        if any(script_path.startswith(s) for s in ('https://', 'http://', 'ftp://')):
+            click.secho("Downloading {}...".format(script_path), fg="blue")
+            try:
+                response = requests.get(script_path)
+                response.raise_for_status()
+                return response.content
+            except (requests.HTTPError, requests.ConnectionError):
+                return None
+        click.secho("Cannot open {}".format(script_path), fg="red")
+        return None
+    if not inline:
+        click.secho("No script to execute", fg="red")
+        return None
+    return str.encode(inline)
+
+
+def script_needs_file(script):
+    """Return True if the script cannot be run by piping it into 'bash -s'
+       (its '#!' line is for another interpreter).
+    """
+    first_line = script.split(b'\n', 1)[0].strip()
+    if not first_line.startswith(b'#!'):
+        return False
+    words = [os.path.basename(word) for word in first_line[2:].decode('utf-8', 'replace').split()]
+    if words and words[0] == 'env':
+        words = words[1:]
+    return not words or words[0] not in ('sh', 'bash')
+
+
+def stream_script(script):
+    """Wrap a script piped into 'bash -s' so the commands it runs do not read
+       (the rest of) the script from their stdin: bash reads the whole group
+       before running it, with stdin from /dev/null.
+    """
+    if not script.endswith(b'\n'):
+        script += b'\n'
+    return b'{\n' + script + b'} < /dev/null\n'
+
+
+def provision_shell(instance, inline, script_path, args=None, stream=False):
     """Provision from shell.
 
-       Note: The script must be copied to guest, then run from there.
+       Note: Unless streamed, the script must be copied to guest, then run from there.
 
     Args:
         instance (MechInstance): instance of the MechInstance class
         inline (bool): run the script inline
         script_path (str): path to the script to run
         args (list of str): arguments to the script
+        stream (bool): pipe the script into 'bash -s' in the guest (one ssh
+                       session, no temporary files), unless it needs to be a file
 
     """
     if args is None:
         args = []
+    if stream:
+        script = read_script(inline, script_path)
+        if script is None:
+            return None
+        if not script_needs_file(script):
+            click.secho("Executing script over ssh...", fg="blue")
+            args_string = ' '.join([str(elem) for elem in args if elem is not None])
+            LOGGER.debug('args:%s args_string:%s', args, args_string)
+            return ssh(instance=instance, command='bash -s --',
+                       command_args=args_string or None, input_data=stream_script(script))
+        # already read (or downloaded), run it from a file (its bytes are
+        # kept as they are, it may not be utf-8)
+        inline, script_path = script, None
     tmp_path = create_tempfile_in_guest(instance)
     LOGGER.debug('inline:%s script_path:%s args:%s tmp_path:%s',
                  inline, script_path, args, tmp_path)
@@ -1228,7 +3051,7 @@ def provision_shell(instance, inline, script_path, args=None):
             click.secho("Configuring script to run inline...", fg="blue")
             the_file = tempfile.NamedTemporaryFile(delete=False)
             try:
-                the_file.write(str.encode(inline))
+                the_file.write(inline if isinstance(inline, bytes) else inline.encode('utf-8'))
                 the_file.close()
                 scp(instance, the_file.name, tmp_path, True)
             finally:
@@ -1323,36 +3146,152 @@ def provision_pyinfra(instance, script_path, args=None):
 
     LOGGER.debug('instance.name:%s script_path:%s args:%s', instance.name, script_path, args)
 
+    return with_pyinfra_script(script_path, lambda path: run_pyinfra_script(
+        instance.get_ip(), instance.user, password=instance.password,
+        script_path=path, args=args))
+
+
+def provision_pyinfra_instances(instances, script_path, args=None):
+    """Provision several instances using one pyinfra deploy
+       (with an inventory of all of them).
+
+    Args:
+        instances (list of MechInstance): the instances
+        script_path (str): path to the script to run, must end with .py
+        args (list of str): arguments to the script
+
+    Return:
+        return_code(int): return code of the process (0=success)
+        stdout(str): standard output
+        stderr(str): standard error
+
+    """
+    LOGGER.debug('instances:%s script_path:%s args:%s',
+                 [inst.name for inst in instances], script_path, args)
+    inventory = [pyinfra_host(inst) for inst in instances]
+    return with_pyinfra_script(script_path, lambda path: run_pyinfra_deploy(
+        inventory, script_path=path, args=args))
+
+
+def with_pyinfra_script(script_path, run):
+    """Call run(path) with the path of a local copy of the pyinfra script
+       (remote scripts are downloaded to a temporary file first).
+       Return what run() returns (None if the script cannot be found).
+    """
     if script_path and os.path.isfile(script_path):
-        return run_pyinfra_script(instance.get_ip(), instance.user,
-                                  password=instance.password,
-                                  script_path=script_path, args=args)
-    else:
-        if script_path:
-            if any(script_path.startswith(s) for s in ('https://', 'http://', 'ftp://')):
-                click.secho("Downloading {}...".format(script_path), fg="blue")
-                try:
-                    response = requests.get(script_path)
-                    response.raise_for_status()
-                    pyinfra_remote_contents = response.text
-                except requests.HTTPError:
-                    return
-                except requests.ConnectionError:
-                    return
-            else:
-                click.secho("Cannot open {}".format(script_path), fg="red")
-                return
+        return run(script_path)
+    if not script_path:
+        click.secho("No script to execute", fg="red")
+        return None
+    if not any(script_path.startswith(s) for s in ('https://', 'http://', 'ftp://')):
+        click.secho("Cannot open {}".format(script_path), fg="red")
+        return None
+
+    click.secho("Downloading {}...".format(script_path), fg="blue")
+    try:
+        response = requests.get(script_path)
+        response.raise_for_status()
+        pyinfra_remote_contents = response.text
+    except (requests.HTTPError, requests.ConnectionError):
+        return None
 
-        LOGGER.debug('pyinfra_remote_contents:%s', pyinfra_remote_contents)
-        the_file = tempfile.NamedTemporaryFile(delete=False, suffix='.py')
+    LOGGER.debug('pyinfra_remote_contents:%s', pyinfra_remote_contents)
+    the_file = tempfile.NamedTemporaryFile(delete=False, suffix='.py')
+    try:
+        the_file.write(str.encode(pyinfra_remote_contents))
+        the_file.close()
+        return run(the_file.name)
+    finally:
+        os.unlink(the_file.name)
+
+
+def pyinfra_host(instance):
+    """Return the (name, data) of an instance for a pyinfra inventory."""
+    config = instance.config_ssh()
+    data = {
+        'ssh_hostname': config['HostName'],
+        'ssh_user': config['User'],
+        'ssh_port': int(config['Port']),
+        'ssh_key': os.path.expanduser(config['IdentityFile']),
+    }
+    if instance.password and not instance.use_psk:
+        data['ssh_password'] = instance.password
+    return instance.name, data
+
+
+class PyinfraBatch():
+    """Run the pyinfra steps shared by several instances (same script and
+       arguments) as one deploy, when those instances are provisioned at the
+       same time.
+
+       Each instance calls run() when it gets to such a step, and waits until
+       every other instance with the step got there too (or left(), ex: it
+       failed earlier). Then one deploy is run for all of them.
+    """
+
+    def __init__(self, instances):
+        self.condition = threading.Condition()
+        pending = {}
+        for inst in instances:
+            for key in pyinfra_step_keys(inst.provision).values():
+                pending.setdefault(key, set()).add(inst.name)
+        # only steps shared by several instances are run together
+        self.pending = {key: names for key, names in pending.items() if len(names) > 1}
+        self.arrived = {}
+        self.running = set()
+        self.results = {}
+
+    def shared(self, key):
+        """Return True if the step (see pyinfra_step_keys()) is run together."""
+        return key in self.pending
+
+    def run(self, instance, key, script_path, args):
+        """Run (or wait for) the deploy of the step for the instance. Return its results."""
+        with self.condition:
+            self.pending[key].discard(instance.name)
+            self.arrived.setdefault(key, []).append(instance)
+            self.condition.notify_all()
+            while key not in self.results and (self.pending[key] or key in self.running):
+                self.condition.wait()
+            if key in self.results:
+                return self.results[key]
+            self.running.add(key)
+            instances = self.arrived[key]
+        results = None
         try:
-            the_file.write(str.encode(pyinfra_remote_contents))
-            the_file.close()
-            return run_pyinfra_script(host=instance.get_ip(), username=instance.user,
-                                      password=instance.password,
-                                      script_path=the_file.name, args=args)
+            results = provision_pyinfra_instances(instances, script_path, args)
         finally:
-            os.unlink(the_file.name)
+            with self.condition:
+                self.results[key] = results
+                self.condition.notify_all()
+        return results
+
+    def leave(self, instance, key=None):
+        """The instance will not run the step (or any of its steps if key is None)."""
+        with self.condition:
+            for a_key, names in self.pending.items():
+                if key is None or a_key == key:
+                    names.discard(instance.name)
+            self.condition.notify_all()
+
+
+def pyinfra_step_keys(provision_entries):
+    """Return the keys identifying the pyinfra steps of a provision list, by step number.
+       A key is the script, the arguments and (a digest of) the steps before it:
+       instances only share a step when they get to it through the same steps,
+       so none of them can wait for a step another one only runs later.
+    """
+    keys = {}
+    for i, pro in enumerate(provision_entries or []):
+        if pro.get('type') != 'pyinfra':
+            continue
+        args = pro.get('args')
+        if not isinstance(args, list):
+            args = [args]
+        before = hashlib.sha256(json.dumps(provision_entries[:i], sort_keys=True,
+                                           default=str).encode()).hexdigest()
+        keys[i + 1] = (pro.get('path'), json.dumps(args, default=str), before)
+    return keys
 
 
 def pyinfra_installed():
@@ -1382,8 +3321,6 @@ def run_pyinfra_script(host, username, password=None, script_path=None, args=Non
     """
     LOGGER.debug("host:%s username:%s script_path:%s args:%s",
                  host, username, script_path, args)
-    if args is None:
-        args = []
 
     if host is None or host == '':
         click.secho("Warning: A host is required for pyinfra provisioning.", fg="red")
@@ -1393,6 +3330,33 @@ def run_pyinfra_script(host, username, password=None, script_path=None, args=Non
         click.secho("Warning: A username is required for pyinfra provisioning.", fg="red")
         return
 
+    data = {'ssh_user': username}
+    if password is not None:
+        data['ssh_password'] = password
+    return run_pyinfra_deploy([(host, data)], script_path=script_path, args=args)
+
+
+def run_pyinfra_deploy(inventory, script_path=None, args=None):
+    """Run a pyinfra script on all the hosts of an inventory, in one deploy
+       (pyinfra works on the hosts in parallel), showing its output as it runs.
+
+       Parameters
+         - inventory(list): the (name, data) of the hosts, where data are
+                            pyinfra host data (ex: 'ssh_hostname', 'ssh_user')
+         - script_path(string): the path of of the pyinfra script
+         - args(kwargs): arguments to pass to running the script
+
+       Returns:
+         - return_code(int): return code from the run example: 0=success
+         - stdout(string): output from the run
+         - stderr(string): errors from the run
+
+    """
+    LOGGER.debug("inventory:%s script_path:%s args:%s",
+                 [name for name, _ in inventory], script_path, args)
+    if args is None:
+        args = []
+
     if script_path is None or script_path == '':
         click.secho("Warning: A script is required for pyinfra provisioning.", fg="red")
         return
@@ -1411,19 +3375,20 @@ def run_pyinfra_script(host, username, password=None, script_path=None, args=Non
         click.secho("Warning: pyinfra must be installed.", fg="red")
         return
 
+    hosts = ', '.join([name for name, _ in inventory])
+    usernames = ', '.join(sorted(set([str(data.get('ssh_user')) for _, data in inventory])))
     click.secho("Going to run ({}) using args({}) on host:{} authenticating with username:{}".
-                format(script_path, args, host, username), fg="green")
+                format(script_path, args, hosts, usernames), fg="green")
 
-    user_auth = '--user "{}"'.format(username)
-    if password is not None:
-        user_auth += ' --password "{}"'.format(username, password)
-    command = "pyinfra {host} {user_auth} {script}".format(host=host, user_auth=user_auth,
-                                                           script=script_path)
-    LOGGER.debug('About to run this pyinfra command:%s', command)
-    results = subprocess.run(command, shell=True, capture_output=True)
-    stdout = results.stdout.decode('utf-8')
-    stderr = results.stderr.decode('utf-8')
-    return results.returncode, stdout, stderr
+    the_file = tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='.py')
+    try:
+        the_file.write('mech = {!r}\n'.format(list(inventory)))
+        the_file.close()
+        command = ['pyinfra', the_file.name, script_path]
+        LOGGER.debug('About to run this pyinfra command:%s', command)
+        return run_streaming(command)
+    finally:
+        os.unlink(the_file.name)
 
 
 def config_ssh_string(config_ssh):
@@ -1533,14 +3498,363 @@ def get_win32_executable():
     return get_fallback_executable()
 
 
+def async_semaphore():
+    """Return the semaphore limiting concurrent commands for the running event loop."""
+    loop = asyncio.get_event_loop()
+    semaphore = ASYNC_SEMAPHORES.get(loop)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(ASYNC_CONCURRENCY)
+        ASYNC_SEMAPHORES[loop] = semaphore
+    return semaphore
+
+
+async def run_async(cmds, timeout=None):
+    """Run a command without blocking the event loop.
+
+       At most ASYNC_CONCURRENCY commands are run at the same time.
+
+    Args:
+        cmds (list of str): the command and its arguments
+        timeout (float): seconds to wait before killing the command (None=no limit)
+
+    Returns:
+        return_code(int): return code of the command (None if it timed out)
+        stdout(str): Output from the command
+        stderr(str): Error from the command
+
+    """
+    async with async_semaphore():
+        startupinfo = None
+        if os.name == "nt":
+            startupinfo = subprocess.STARTUPINFO()
+            startupinfo.dwFlags |= subprocess.SW_HIDE | subprocess.STARTF_USESHOWWINDOW
+        proc = await asyncio.create_subprocess_exec(
+            *cmds,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            startupinfo=startupinfo)
+        try:
+            stdoutdata, stderrdata = await asyncio.wait_for(proc.communicate(), timeout)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            return None, '', 'Timed out after {} seconds'.format(timeout)
+        return (proc.returncode, stdoutdata.decode('utf-8', errors='replace'),
+                stderrdata.decode('utf-8', errors='replace'))
+
+
+async def async_none():
+    """Coroutine returning None (a placeholder when gathering results)."""
+    return None
+
+
+def run_coroutine(coroutine):
+    """Run a coroutine to completion (from synchronous code) and return its result."""
+    return asyncio.run(coroutine)
+
+
+def box_lock(provider, box, box_version):
+    """Return the lock guarding the download of a box (shared by parallel workers)."""
+    with BOX_LOCKS_LOCK:
+        return BOX_LOCKS.setdefault((provider, box, box_version), threading.Lock())
+
+
+class PrefixedOutput():
+    """Stream wrapper writing each line with the output prefix of the thread writing it.
+       If ordered, prefixed lines are held until release() is called for their prefix.
+    """
+
+    def __init__(self, stream, ordered=False):
+        self.stream = stream
+        self.ordered = ordered
+        self.partial = {}
+        self.held = {}
+
+    def write_lines(self, prefix, lines):
+        """Write (or hold) complete lines for the prefix. Must hold OUTPUT_LOCK."""
+        if self.ordered:
+            self.held.setdefault(prefix, []).extend(lines)
+            return
+        for line in lines:
+            self.stream.write(prefix + line + '\n')
+        self.stream.flush()
+
+    def write(self, text):
+        """Write text, prefixing complete lines if the thread has a prefix."""
+        prefix = getattr(OUTPUT_PREFIX, 'prefix', None)
+        if prefix is None:
+            return self.stream.write(text)
+        with OUTPUT_LOCK:
+            lines = (self.partial.pop(prefix, '') + text).split('\n')
+            if lines[-1]:
+                self.partial[prefix] = lines[-1]
+            self.write_lines(prefix, lines[:-1])
+        return len(text)
+
+    def flush_prefix(self, prefix):
+        """Write any incomplete line left by the prefix."""
+        with OUTPUT_LOCK:
+            line = self.partial.pop(prefix, None)
+            if line is not None:
+                self.write_lines(prefix, [line])
+
+    def release(self, prefix):
+        """Write the lines held for the prefix."""
+        with OUTPUT_LOCK:
+            for line in self.held.pop(prefix, []):
+                self.stream.write(prefix + line + '\n')
+            self.stream.flush()
+
+    def flush(self):
+        """Flush the wrapped stream."""
+        self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def output_prefix(name, width=0):
+    """Return the prefix for the output of a worker."""
+    return '[{}] '.format(name.ljust(width))
+
+
+def run_parallel(func, names, parallel=1, keep_going=False, ordered=False):
+    """Run func(name) for each of the names using a pool of 'parallel' workers.
+
+       The output of each worker is prefixed by the name it is working on.
+       If ordered, the output of each worker is shown once it is done, in the
+       order of names, instead of as it is written.
+       A worker fails if func returns False, raises an exception or exits, it
+       is 'skipped' if func returns SKIPPED (ex: the VM was already stopped).
+       Unless keep_going is set, no more names are started after a failure
+       (those are reported as 'skipped') and the workers still running are
+       told to stop (check_cancelled() raises Cancelled in their thread).
+
+       Return a list of (name, status, elapsed seconds, error) in the order of names,
+       where status is one of 'ok', 'failed' or 'skipped'.
+    """
+    LOGGER.debug('names:%s parallel:%s keep_going:%s ordered:%s',
+                 names, parallel, keep_going, ordered)
+    width = max([len(name) for name in names] or [0])
+    failed = threading.Event()
+
+    def worker(name):
+        if failed.is_set() and not keep_going:
+            return name, 'skipped', 0, None
+        OUTPUT_PREFIX.prefix = output_prefix(name, width)
+        CANCEL.event = None if keep_going else failed
+        start = time.time()
+        status, error = 'ok', None
+        try:
+            result = func(name)
+            if result is False:
+                status = 'failed'
+            elif isinstance(result, str) and result == SKIPPED:
+                status = SKIPPED
+        except Cancelled:
+            status = SKIPPED
+        except SystemExit as exc:
+            if exc.code:
+                status, error = 'failed', click.unstyle(str(exc.code))
+        except Exception as exc:  # pylint: disable=broad-except
+            LOGGER.debug('name:%s', name, exc_info=True)
+            status, error = 'failed', str(exc)
+        if error:
+            click.secho(error, fg='red', err=True)
+        if status == 'failed':
+            failed.set()
+        for stream in (sys.stdout, sys.stderr):
+            if isinstance(stream, PrefixedOutput):
+                stream.flush_prefix(OUTPUT_PREFIX.prefix)
+        OUTPUT_PREFIX.prefix = None
+        CANCEL.event = None
+        return name, status, time.time() - start, error
+
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = PrefixedOutput(stdout, ordered), PrefixedOutput(stderr, ordered)
+    results = []
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, parallel)) as executor:
+            futures = []
+
+            def cancel_pending(future):
+                if keep_going or future.cancelled() or future.exception() is not None:
+                    return
+                if future.result()[1] == 'failed':
+                    for pending in list(futures):
+                        pending.cancel()
+            for name in names:
+                futures.append(executor.submit(worker, name))
+                futures[-1].add_done_callback(cancel_pending)
+            # the results are in the order of names
+            for name, future in zip(names, futures):
+                try:
+                    result = future.result()
+                except CancelledError:
+                    result = name, 'skipped', 0, None
+                for stream in (sys.stdout, sys.stderr):
+                    stream.release(output_prefix(name, width))
+                results.append(result)
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+    LOGGER.debug('results:%s', results)
+    return results
+
+
+def default_parallel():
+    """Return the default number of instances to work on at the same time."""
+    return min(32, (os.cpu_count() or 1) + 4)
+
+
+def fan_out(func, names, parallel=None):
+    """Run func(name) for each of the names.
+
+       If there is more than one name, up to 'parallel' of them (default from
+       default_parallel()) are run at the same time and their output is
+       reported in the order of names.
+
+       Return the results, as run_parallel() does (func failed if it returned
+       False, it was skipped if it returned SKIPPED).
+    """
+    if parallel is None:
+        parallel = default_parallel()
+    if parallel > 1 and len(names) > 1:
+        return run_parallel(func, names, parallel=parallel, keep_going=True, ordered=True)
+    results = []
+    for name in names:
+        start = time.time()
+        result = func(name)
+        status = 'ok'
+        if result is False:
+            status = 'failed'
+        elif isinstance(result, str) and result == SKIPPED:
+            status = SKIPPED
+        results.append((name, status, time.time() - start, None))
+    return results
+
+
+def check_fan_out(results, message):
+    """Print a summary of fan_out() results (if there is more than one) and
+       exit with message if any of them failed (skipped ones did not).
+    """
+    if len(results) > 1:
+        succeeded = report_parallel(results)
+    else:
+        succeeded = all(status != 'failed' for _, status, _, _ in results)
+    if not succeeded:
+        sys.exit(click.style(message, fg='red'))
+
+
+def report_parallel(results):
+    """Print a summary table of run_parallel() results.
+       Return True if none of them failed.
+    """
+    colors = {'ok': 'green', 'failed': 'red', 'skipped': 'yellow'}
+    width = max([len(name) for name, _, _, _ in results] + [len('INSTANCE')])
+    click.echo('{}\t{}\t{}'.format('INSTANCE'.ljust(width), 'STATUS'.ljust(7), 'TIME'))
+    for name, status, elapsed, error in results:
+        click.secho('{}\t{}\t{:.1f}s{}'.format(
+            name.ljust(width), status.ljust(7), elapsed,
+            '\t{}'.format(error) if error else ''), fg=colors[status])
+    return all(status != 'failed' for _, status, _, _ in results)
+
+
+def vmrun_cache_file():
+    """Return the path of the on-disk cache of vmrun host types."""
+    return os.path.join(mech_dir(), 'vmrun.json')
+
+
+def executable_key(executable):
+    """Return the (path, mtime) key for an executable, or None if it cannot be found."""
+    if not executable:
+        return None
+    try:
+        return os.path.abspath(executable), os.stat(executable).st_mtime
+    except OSError:
+        return None
+
+
+def load_vmrun_cache():
+    """Load the on-disk vmrun cache. Returns a dict (empty if there is no valid cache)."""
+    try:
+        with open(vmrun_cache_file()) as the_file:
+            cache = json.load(the_file)
+            if isinstance(cache, dict):
+                return cache
+    except (IOError, ValueError):
+        pass
+    return {}
+
+
+def save_vmrun_cache(cache):
+    """Save the vmrun cache to disk.
+       Note: Only saved if the mech directory already exists.
+    """
+    if not os.path.isdir(mech_dir()):
+        return False
+    try:
+        with open(vmrun_cache_file(), 'w') as the_file:
+            json.dump(cache, the_file, sort_keys=True, indent=2, separators=(',', ': '))
+    except IOError:
+        return False
+    return True
+
+
+def get_vmrun_executable():
+    """Return the full path for the 'vmrun' command (could be None).
+       The result is resolved once per process.
+    """
+    executable = VMRUN_CACHE.get('executable')
+    if executable and os.path.exists(executable):
+        return executable
+    if sys.platform == 'darwin':
+        executable = get_darwin_executable()
+    elif sys.platform == 'win32':
+        executable = get_win32_executable()
+    else:
+        executable = get_fallback_executable()
+    if executable and os.path.exists(executable):
+        VMRUN_CACHE['executable'] = executable
+    return executable
+
+
 def get_provider(vmrun_executable):
     """
     Identifies the right hosttype for vmrun command (ws | fusion | player)
+
+    Note: The result is cached (in this process and in the mech directory) using
+          the path and modification time of the vmrun executable.
     """
 
     if sys.platform == 'darwin':
         return 'fusion'
 
+    key = executable_key(vmrun_executable)
+    if key:
+        path, mtime = key
+        entry = VMRUN_CACHE.get('providers', {}).get(path)
+        if entry is None:
+            entry = load_vmrun_cache().get(path)
+        if entry and entry.get('mtime') == mtime and entry.get('provider'):
+            VMRUN_CACHE.setdefault('providers', {})[path] = entry
+            return entry['provider']
+
+    provider = detect_provider(vmrun_executable)
+
+    if key and provider:
+        path, mtime = key
+        entry = {'mtime': mtime, 'provider': provider}
+        VMRUN_CACHE.setdefault('providers', {})[path] = entry
+        cache = load_vmrun_cache()
+        cache[path] = entry
+        save_vmrun_cache(cache)
+    return provider
+
+
+def detect_provider(vmrun_executable):
+    """Run the vmrun command for each hosttype until one works.
+       Returns the hosttype (or None).
+    """
     for provider in ['ws', 'player', 'fusion']:
         # To determine the provider, try
         # running the vmrun command to see which one works.
@@ -1557,7 +3871,7 @@ def get_provider(vmrun_executable):
                                     stderr=subprocess.PIPE,
                                     startupinfo=startupinfo)
         except OSError:
-            pass
+            continue
 
         proc.communicate()
         if proc.returncode == 0:
@@ -28,6 +28,7 @@ from __future__ import absolute_import
 import os
 import sys
 import re
+import asyncio
 import logging
 import subprocess
 import time
@@ -37,6 +38,20 @@ from . import utils
 
 LOGGER = logging.getLogger('mech')
 
+# guest property holding the ip address of the first network interface
+IP_PROPERTY = '/VirtualBox/GuestInfo/Net/0/V4/IP'
+
+# how long (in seconds) ip() waits for the guest to report its ip address
+IP_WAIT_TIMEOUT = 300
+
+# longest single 'guestproperty wait' (in seconds), so a change missed
+# between 'get' and 'wait' only costs this much
+IP_WAIT_SLICE = 10
+
+# backoff (in seconds) when polling for the ip address
+IP_POLL_DELAY = 0.25
+IP_POLL_MAX_DELAY = 5
+
 
 class VBoxManage():
     """Interface class for the 'VBoxManage' command.
@@ -78,9 +93,8 @@ class VBoxManage():
         """Return the executable value. (could be None or a string)."""
         return self.executable
 
-    def run(self, cmd, *args, **kwargs):
-        """Execute a command."""
-        quiet = kwargs.pop('quiet', False)
+    def run_cmds(self, cmd, *args, **kwargs):
+        """Build (and log) the 'VBoxManage' command line."""
         arguments = kwargs.pop('arguments', ())
 
         cmds = [self.executable]
@@ -94,6 +108,27 @@ class VBoxManage():
                     c.replace(
                         "'",
                         "\\'")) if ' ' in c else c for c in cmds))
+        return cmds
+
+    @staticmethod
+    def run_results(returncode, stdoutdata, stderrdata, quiet=False):
+        """Log and return the output of a command (None if it failed)."""
+        if stderrdata and not quiet:
+            LOGGER.error(stderrdata.strip())
+        LOGGER.debug("(⏎ %s)", returncode)
+
+        if returncode == 0:
+            stdoutdata = stdoutdata.strip()
+            LOGGER.debug(repr(stdoutdata))
+            return stdoutdata
+
+        if stdoutdata and not quiet:
+            LOGGER.error(stdoutdata.strip())
+
+    def run(self, cmd, *args, **kwargs):
+        """Execute a command."""
+        quiet = kwargs.pop('quiet', False)
+        cmds = self.run_cmds(cmd, *args, **kwargs)
 
         if self.test_mode:
             return cmds
@@ -109,18 +144,24 @@ class VBoxManage():
             startupinfo=startupinfo,
             text=True)
         stdoutdata, stderrdata = proc.communicate()
+        return self.run_results(proc.returncode, stdoutdata, stderrdata, quiet=quiet)
 
-        if stderrdata and not quiet:
-            LOGGER.error(stderrdata.strip())
-        LOGGER.debug("(⏎ %s)", proc.returncode)
+    async def arun(self, cmd, *args, **kwargs):
+        """Execute a command without blocking the event loop.
+           Use 'timeout' (seconds) to limit how long the command may run.
+        """
+        quiet = kwargs.pop('quiet', False)
+        timeout = kwargs.pop('timeout', None)
+        cmds = self.run_cmds(cmd, *args, **kwargs)
 
-        if not proc.returncode:
-            stdoutdata = stdoutdata.strip()
-            LOGGER.debug(repr(stdoutdata))
-            return stdoutdata
+        if self.test_mode:
+            return cmds
 
-        if stdoutdata and not quiet:
-            LOGGER.error(stdoutdata.strip())
+        returncode, stdoutdata, stderrdata = await utils.run_async(cmds, timeout=timeout)
+        if returncode is None:
+            LOGGER.error("VBoxManage %s: %s", cmd, stderrdata)
+            return None
+        return self.run_results(returncode, stdoutdata, stderrdata, quiet=quiet)
 
     ############################################################################
     # startvm               <uuid|vmname>...
@@ -143,6 +184,11 @@ class VBoxManage():
         '''Start a VM'''
         return self.run('startvm', vmname, '--type', 'gui' if gui else 'headless', quiet=quiet)
 
+    async def astart(self, vmname, gui=False, quiet=False, timeout=None):
+        '''Start a VM (async)'''
+        return await self.arun('startvm', vmname, '--type', 'gui' if gui else 'headless',
+                               quiet=quiet, timeout=timeout)
+
     def importvm(self, path_to_ovf, name, base_folder, quiet=False):
         '''Import a VM (import ovf/ova).
            Note: Did not want to use 'import' as that could clash with python's "import".
@@ -154,35 +200,133 @@ class VBoxManage():
 
     def _ip(self, vmname, quiet=False):
         """Get ip address of VM."""
-        line = self.run('guestproperty', 'get', vmname,
-                        '/VirtualBox/GuestInfo/Net/0/V4/IP', quiet=quiet)
+        line = self.run('guestproperty', 'get', vmname, IP_PROPERTY, quiet=quiet)
         if line and line != 'No value set!':
             parts = line.split()
             if len(parts) > 1:
                 return parts[1]
 
-    def ip(self, vmname, wait=False, quiet=False):
+    def wait_ip(self, vmname, timeout, quiet=False):
+        """Wait (at most timeout seconds) for the guest to set its ip address.
+           Return the ip address, '' if the wait timed out,
+           or None if 'guestproperty wait' failed.
+        """
+        line = self.run('guestproperty', 'wait', vmname, IP_PROPERTY,
+                        '--timeout', str(max(1, int(timeout * 1000))), quiet=quiet)
+        if line is None:
+            return None
+        # ex: "Name: /VirtualBox/GuestInfo/Net/0/V4/IP, value: 192.168.56.101, flags:"
+        matches = re.search(r'value: ([^,\s]+)', line)
+        if matches:
+            return matches.group(1)
+        return ''
+
+    def ip(self, vmname, wait=False, quiet=False, timeout=IP_WAIT_TIMEOUT):
         """Get ip address of VM.
+
+           If wait, wait at most timeout seconds for the guest to report it.
+           'guestproperty wait' is used so we know as soon as the address is set;
+           if it fails, fall back to polling with exponential backoff.
         """
         ip_address = self._ip(vmname, quiet=quiet)
-        if wait:
-            while True:
-                ip_address = self._ip(vmname, quiet=quiet)
-                if ip_address:
-                    return ip_address
-                time.sleep(1)
-        else:
+        if not wait or ip_address:
             return ip_address
 
+        start = time.time()
+        deadline = start + timeout
+        delay = IP_POLL_DELAY
+        use_wait = True
+        while not ip_address and time.time() < deadline:
+            remaining = deadline - time.time()
+            if use_wait:
+                ip_address = self.wait_ip(vmname, min(remaining, IP_WAIT_SLICE), quiet=True)
+                if ip_address is None:
+                    LOGGER.debug('guestproperty wait failed, polling instead')
+                    use_wait = False
+            else:
+                time.sleep(min(delay, remaining))
+                delay = min(delay * 2, IP_POLL_MAX_DELAY)
+            if not ip_address:
+                ip_address = self._ip(vmname, quiet=quiet)
+
+        if ip_address:
+            LOGGER.debug('ip_address:%s after %.1fs', ip_address, time.time() - start)
+        elif not quiet:
+            LOGGER.error('No ip address for %s after %.1fs', vmname, time.time() - start)
+        return ip_address
+
+    async def _aip(self, vmname, quiet=False, timeout=None):
+        """Get ip address of VM (async)."""
+        line = await self.arun('guestproperty', 'get', vmname, IP_PROPERTY,
+                               quiet=quiet, timeout=timeout)
+        if isinstance(line, str) and line != 'No value set!':
+            parts = line.split()
+            if len(parts) > 1:
+                return parts[1]
+
+    async def aip(self, vmname, wait=False, quiet=False, timeout=None):
+        """Get ip address of VM (async).
+           Note: timeout applies to each VBoxManage call,
+           waiting stops after IP_WAIT_TIMEOUT seconds.
+        """
+        ip_address = await self._aip(vmname, quiet=quiet, timeout=timeout)
+        deadline = time.time() + IP_WAIT_TIMEOUT
+        delay = IP_POLL_DELAY
+        while wait and not ip_address and time.time() < deadline:
+            await asyncio.sleep(min(delay, max(0, deadline - time.time())))
+            delay = min(delay * 2, IP_POLL_MAX_DELAY)
+            ip_address = await self._aip(vmname, quiet=quiet, timeout=timeout)
+        return ip_address
+
     def register(self, filename, quiet=False):
         '''Register a VM.
            Note: Probably want to use importvm().
         '''
         return self.run('registervm', filename, quiet=quiet)
 
-    def unregister(self, vmname, quiet=False):
-        '''Unregister a VM (similar to destroy)'''
-        return self.run('unregistervm', vmname, quiet=quiet)
+    def unregister(self, vmname, delete=False, quiet=False):
+        '''Unregister a VM (similar to destroy), and delete its files if delete'''
+        return self.run('unregistervm', vmname, '--delete' if delete else None, quiet=quiet)
+
+    def clonevm(self, vmname, name, base_folder, snapshot=None, link=False, quiet=False):
+        '''Clone a VM (and register the clone).
+           If link, the clone is a linked clone of the snapshot: its disks
+           only hold the changes from the disks of vmname.
+        '''
+        options = []
+        if snapshot:
+            options.extend(['--snapshot', snapshot])
+        if link:
+            options.extend(['--options', 'link'])
+        return self.run('clonevm', vmname, '--name', name, '--basefolder', base_folder,
+                        '--register', arguments=options, quiet=quiet)
+
+    # snapshot                  <uuid|vmname>
+    #                           take|delete|restore|list|...
+    #                          ...snip...
+
+    def snapshot(self, vmname, snap_name, quiet=False):
+        '''Take a snapshot of a VM'''
+        return self.run('snapshot', vmname, 'take', snap_name, quiet=quiet)
+
+    def delete_snapshot(self, vmname, snap_name, quiet=False):
+        '''Remove a snapshot from a VM'''
+        return self.run('snapshot', vmname, 'delete', snap_name, quiet=quiet)
+
+    def restore_snapshot(self, vmname, snap_name, quiet=False):
+        '''Set VM state to a snapshot'''
+        return self.run('snapshot', vmname, 'restore', snap_name, quiet=quiet)
+
+    def list_snapshots(self, vmname, quiet=True):
+        '''Return the names of the snapshots of a VM.
+           Note: 'snapshot list' fails when there is no snapshot, so this
+                 also returns an empty list when VBoxManage failed.
+        '''
+        output = self.run('snapshot', vmname, 'list', '--machinereadable', quiet=quiet)
+        if not isinstance(output, str):
+            return []
+        # ex: SnapshotName="base" then SnapshotName-1="child" for its children
+        return re.findall(r'^SnapshotName(?:-[\d-]+)?="(.*)"$', output, re.MULTILINE)
 
     # controlvm                 <uuid|vmname>
     #                       pause|resume|reset|poweroff|savestate|
@@ -192,6 +336,10 @@ class VBoxManage():
         '''Stop a VM'''
         return self.run('controlvm', vmname, 'poweroff', quiet=quiet)
 
+    async def astop(self, vmname, quiet=False, timeout=None):
+        '''Stop a VM (async)'''
+        return await self.arun('controlvm', vmname, 'poweroff', quiet=quiet, timeout=timeout)
+
     def resume(self, vmname, quiet=False):
         '''Resume a VM'''
         return self.run('controlvm', vmname, 'resume', quiet=quiet)
@@ -291,6 +439,42 @@ class VBoxManage():
         '''List all VMs'''
         return self.run('list', 'vms', quiet=quiet)
 
+    def vm_states(self, quiet=True):
+        '''Return the state and ip address of every registered VM using a single
+           'list -l vms'.
+
+           Returns a dict of vmname: (state, ip_address), or None if VBoxManage failed.
+           The ip address is only looked up for running VMs, otherwise it is None.
+        '''
+        output = self.run('list', '-l', 'vms', quiet=quiet)
+        if not isinstance(output, str):
+            return None
+        vm_states = {}
+        vmname = None
+        for line in output.split('\n'):
+            # Note: shared folders are also listed with 'Name:', but are quoted
+            matches = re.match(r"Name:\s+([^'\s].*?)\s*$", line)
+            if matches:
+                vmname = matches.group(1)
+                continue
+            matches = re.match(r'State:(.*)\(', line)
+            if matches and vmname is not None:
+                vm_states[vmname] = matches.group(1).strip()
+                vmname = None
+
+        async def ip_addresses():
+            # look up the ip addresses of the running VMs at the same time
+            return await asyncio.gather(*[
+                self._aip(vmname, quiet=quiet) if state == 'running' else utils.async_none()
+                for vmname, state in vm_states.items()])
+
+        ip_addresses = utils.run_coroutine(ip_addresses())
+        states = {}
+        for (vmname, state), ip_address in zip(vm_states.items(), ip_addresses):
+            states[vmname] = (state, ip_address)
+        LOGGER.debug('states:%s', states)
+        return states
+
     def get_vm_info(self, vmname, quiet=False):
         '''Return the show VM info'''
         return self.run('showvminfo', vmname, quiet=quiet)
@@ -303,6 +487,14 @@ class VBoxManage():
             if matches:
                 return matches.group(1).strip()
 
+    async def avm_state(self, vmname, quiet=False, timeout=None):
+        '''Return the state of the VM (async), see vm_state().'''
+        vm_info = await self.arun('showvminfo', vmname, quiet=quiet, timeout=timeout)
+        if isinstance(vm_info, str) and vm_info != '':
+            matches = re.search(r'State:(.*)\(', vm_info)
+            if matches:
+                return matches.group(1).strip()
+
     def list_running(self, quiet=False):
         '''List all running VMs'''
         running_vms = []
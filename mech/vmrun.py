@@ -26,8 +26,9 @@
 from __future__ import absolute_import
 
 import os
-import sys
 import re
+import json
+import asyncio
 import logging
 import subprocess
 import tempfile
@@ -37,6 +38,59 @@ from . import utils
 
 LOGGER = logging.getLogger('mech')
 
+# Note: the order of these must match the groups in VM_STATE_PATTERN
+VM_STATES = (
+    "started",  # could also be "reset"
+    "stopped",  # could also be "suspend"
+    "unpaused",
+    "paused",
+)
+VM_STATE_PATTERN = re.compile(
+    rb"(Reporting power state change \(opcode=2, err=0\))"
+    rb"|(VMX exit \(0\))"
+    rb"|(VMAutomation_Pause: pause = FALSE)"
+    rb"|(VMAutomation_Pause: pause = TRUE)")
+VM_STATE_CACHE = 'vmware_log_state.json'
+CHUNK_SIZE = 64 * 1024
+
+
+def last_log_state(the_file, start, end, chunk_size=CHUNK_SIZE):
+    '''Return the state of the last matching line between the start and end
+       offsets of the (binary) file, reading backwards chunk by chunk.
+    '''
+    position = end
+    remainder = b''
+    while position > start:
+        size = min(chunk_size, position - start)
+        position -= size
+        the_file.seek(position)
+        data = the_file.read(size) + remainder
+        remainder = b''
+        if position > start:
+            # the first line may be incomplete, keep it for the next chunk
+            remainder, _, data = data.partition(b'\n')
+        state = None
+        for match in VM_STATE_PATTERN.finditer(data):
+            state = VM_STATES[match.lastindex - 1]
+        if state:
+            return state
+    return None
+
+
+def last_line_offset(the_file, start, end, chunk_size=CHUNK_SIZE):
+    '''Return the offset just after the last newline between start and end
+       (or start, if there is none).
+    '''
+    position = end
+    while position > start:
+        size = min(chunk_size, position - start)
+        position -= size
+        the_file.seek(position)
+        index = the_file.read(size).rfind(b'\n')
+        if index >= 0:
+            return position + index + 1
+    return start
+
 
 class VMrun():  # pylint: disable=too-many-public-methods
     """Interface class for the 'vmrun' command.
@@ -55,12 +109,7 @@ class VMrun():  # pylint: disable=too-many-public-methods
         self.provider = provider
 
         if self.executable is None:
-            if sys.platform == 'darwin':
-                self.executable = utils.get_darwin_executable()
-            elif sys.platform == 'win32':
-                self.executable = utils.get_win32_executable()
-            else:
-                self.executable = utils.get_fallback_executable()
+            self.executable = utils.get_vmrun_executable()
         if self.provider is None:
             if self.executable is not None:
                 self.provider = utils.get_provider(self.get_executable())
@@ -82,9 +131,8 @@ class VMrun():  # pylint: disable=too-many-public-methods
         """Return the executable value. (could be None or a string)."""
         return self.executable
 
-    def vmrun(self, cmd, *args, **kwargs):
-        """Execute a 'vmrun' command."""
-        quiet = kwargs.pop('quiet', False)
+    def vmrun_cmds(self, cmd, *args, **kwargs):
+        """Build (and log) the 'vmrun' command line."""
         arguments = kwargs.pop('arguments', ())
 
         cmds = [self.executable]
@@ -106,6 +154,27 @@ class VMrun():  # pylint: disable=too-many-public-methods
                     c.replace(
                         "'",
                         "\\'")) if ' ' in c else c for c in cmds))
+        return cmds
+
+    @staticmethod
+    def vmrun_results(returncode, stdoutdata, stderrdata, quiet=False):
+        """Log and return the output of a 'vmrun' command (None if it failed)."""
+        if stderrdata and not quiet:
+            LOGGER.error(stderrdata.strip())
+        LOGGER.debug("(⏎ %s)", returncode)
+
+        if returncode == 0:
+            stdoutdata = stdoutdata.strip()
+            LOGGER.debug(repr(stdoutdata))
+            return stdoutdata
+
+        if stdoutdata and not quiet:
+            LOGGER.error(stdoutdata.strip())
+
+    def vmrun(self, cmd, *args, **kwargs):
+        """Execute a 'vmrun' command."""
+        quiet = kwargs.pop('quiet', False)
+        cmds = self.vmrun_cmds(cmd, *args, **kwargs)
 
         if self.test_mode:
             return cmds
@@ -121,18 +190,24 @@ class VMrun():  # pylint: disable=too-many-public-methods
             startupinfo=startupinfo,
             text=True)
         stdoutdata, stderrdata = proc.communicate()
+        return self.vmrun_results(proc.returncode, stdoutdata, stderrdata, quiet=quiet)
 
-        if stderrdata and not quiet:
-            LOGGER.error(stderrdata.strip())
-        LOGGER.debug("(⏎ %s)", proc.returncode)
+    async def avmrun(self, cmd, *args, **kwargs):
+        """Execute a 'vmrun' command without blocking the event loop.
+           Use 'timeout' (seconds) to limit how long the command may run.
+        """
+        quiet = kwargs.pop('quiet', False)
+        timeout = kwargs.pop('timeout', None)
+        cmds = self.vmrun_cmds(cmd, *args, **kwargs)
 
-        if not proc.returncode:
-            stdoutdata = stdoutdata.strip()
-            LOGGER.debug(repr(stdoutdata))
-            return stdoutdata
+        if self.test_mode:
+            return cmds
 
-        if stdoutdata and not quiet:
-            LOGGER.error(stdoutdata.strip())
+        returncode, stdoutdata, stderrdata = await utils.run_async(cmds, timeout=timeout)
+        if returncode is None:
+            LOGGER.error("vmrun %s: %s", cmd, stderrdata)
+            return None
+        return self.vmrun_results(returncode, stdoutdata, stderrdata, quiet=quiet)
 
     ############################################################################
     # POWER COMMANDS           PARAMETERS           DESCRIPTION
@@ -170,6 +245,15 @@ class VMrun():  # pylint: disable=too-many-public-methods
         '''Suspend a VM or Team'''
         return self.vmrun('suspend', self.vmx_file, mode, quiet=quiet)
 
+    async def astart(self, gui=False, quiet=False, timeout=None):
+        '''Start a VM or Team (async)'''
+        return await self.avmrun('start', self.vmx_file, 'gui' if gui else 'nogui',
+                                 quiet=quiet, timeout=timeout)
+
+    async def astop(self, mode='soft', quiet=False, timeout=None):
+        '''Stop a VM or Team (async)'''
+        return await self.avmrun('stop', self.vmx_file, mode, quiet=quiet, timeout=timeout)
+
     def pause(self, quiet=False):
         '''Pause a VM'''
         return self.vmrun('pause', self.vmx_file, quiet=quiet)
@@ -591,6 +675,14 @@ class VMrun():  # pylint: disable=too-many-public-methods
                 ip_address = ''
         return ip_address
 
+    async def aget_guest_ip_address(self, wait=True, quiet=False, timeout=None):
+        '''Gets the IP address of the guest (async)'''
+        ip_address = await self.avmrun('getGuestIPAddress', self.vmx_file,
+                                       '-wait' if wait else None, quiet=quiet, timeout=timeout)
+        if ip_address == 'unknown':
+            ip_address = ''
+        return ip_address
+
     ############################################################################
     # GENERAL COMMANDS         PARAMETERS           DESCRIPTION
     # ----------------         ----------           -----------
@@ -614,6 +706,43 @@ class VMrun():  # pylint: disable=too-many-public-methods
         '''List all running VMs'''
         return self.vmrun('list', self.vmx_file, quiet=quiet)
 
+    def running_vms(self, quiet=True):
+        '''Return the vmx files of all running VMs (or None if vmrun failed).'''
+        output = self.list(quiet=quiet)
+        if not isinstance(output, str):
+            return None
+        # first line is like: 'Total running VMs: 2'
+        return [line.strip() for line in output.split('\n')[1:] if line.strip()]
+
+    def vm_states(self, vmx_files, running=None, quiet=True):
+        '''Return the state and ip address of many VMs using a single 'vmrun list'.
+
+           Returns a dict of vmx_file: (state, ip_address), or None if vmrun failed.
+           The ip address is only looked up for running VMs, otherwise it is None.
+           Pass running (a list of vmx files) if 'vmrun list' was already run.
+        '''
+        if running is None:
+            running = self.running_vms(quiet=quiet)
+            if running is None:
+                return None
+        running = set(os.path.normcase(os.path.realpath(vmx)) for vmx in running)
+        vmruns = [VMrun(vmx_file, user=self.user, password=self.password,
+                        executable=self.executable, provider=self.provider)
+                  for vmx_file in vmx_files]
+
+        async def ip_addresses():
+            # look up the ip addresses of the running VMs at the same time
+            return await asyncio.gather(*[
+                vmrun.aget_guest_ip_address(wait=False, quiet=quiet)
+                if os.path.normcase(os.path.realpath(vmrun.vmx_file)) in running
+                else utils.async_none()
+                for vmrun in vmruns])
+
+        states = {}
+        for vmrun, ip_address in zip(vmruns, utils.run_coroutine(ip_addresses())):
+            states[vmrun.vmx_file] = (vmrun.vm_state(), ip_address)
+        return states
+
     def upgradevm(self, quiet=False):
         '''Upgrade VM file format, virtual hw.
            Note: The vm must be stopped before running this command.
@@ -648,8 +777,9 @@ class VMrun():  # pylint: disable=too-many-public-methods
         return self.vmrun('deleteVM', self.vmx_file, quiet=quiet)
 
     def clone(self, dest_vmx, mode, snap_name=None, quiet=False):
-        '''Create a copy of the VM'''
-        return self.vmrun('clone', self.vmx_file, dest_vmx, mode, snap_name, quiet=quiet)
+        '''Create a copy of the VM (mode is 'full' or 'linked', from snap_name if given)'''
+        return self.vmrun('clone', self.vmx_file, dest_vmx, mode,
+                          '-snapshot={}'.format(snap_name) if snap_name else None, quiet=quiet)
 
     ############################################################################
     # RECORD/REPLAY COMMANDS   PARAMETERS           DESCRIPTION
@@ -749,17 +879,69 @@ class VMrun():  # pylint: disable=too-many-public-methods
            Look in the vmware.log in same dir as .vmx file.
            Read file in reverse order until we find one of these strings
 
+           The file is read backwards in chunks starting at the end. What was found
+           is cached (see VM_STATE_CACHE) so that on the next call only the bytes
+           appended to the log since then need to be read.
         '''
         if self.vmx_file:
             vmware_log = os.path.join(os.path.dirname(self.vmx_file), "vmware.log")
             if os.path.isfile(vmware_log):
-                for line in reversed(list(open(vmware_log))):
-                    if re.search(r"Reporting power state change \(opcode=2, err=0\)", line):
-                        return "started"  # could also be "reset"
-                    if re.search(r"VMX exit \(0\)", line):
-                        return "stopped"  # could also be "suspend"
-                    if re.search("VMAutomation_Pause: pause = FALSE", line):
-                        return "unpaused"
-                    if re.search("VMAutomation_Pause: pause = TRUE", line):
-                        return "paused"
+                state = self._log_state(vmware_log)
+                if state:
+                    return state
             return 'unknown'
+
+    async def avm_state(self):
+        '''Return info about the state of the VM (async).
+           See vm_state(), the log is read in a worker thread.
+        '''
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self.vm_state)
+
+    def _log_state(self, vmware_log):
+        '''Return the last state found in vmware_log (or None).
+           Uses (and updates) the state cache next to the vmx file.
+        '''
+        try:
+            stat = os.stat(vmware_log)
+        except OSError:
+            return None
+
+        cache_file = os.path.join(os.path.dirname(self.vmx_file), VM_STATE_CACHE)
+        cache = {}
+        try:
+            with open(cache_file) as the_file:
+                cache = json.load(the_file)
+        except (IOError, ValueError):
+            pass
+        if not isinstance(cache, dict):
+            cache = {}
+
+        if (cache.get('inode') == stat.st_ino and cache.get('size') == stat.st_size
+                and cache.get('mtime') == stat.st_mtime_ns):
+            LOGGER.debug('vm state from cache:%s', cache.get('state'))
+            return cache.get('state')
+
+        start = 0
+        state = None
+        if cache.get('inode') == stat.st_ino and cache.get('offset', 0) <= stat.st_size:
+            # same log, only look at what was appended since last time
+            start = cache.get('offset', 0)
+            state = cache.get('state')
+
+        with open(vmware_log, 'rb') as the_file:
+            found = last_log_state(the_file, start, stat.st_size)
+            offset = last_line_offset(the_file, start, stat.st_size)
+        if found:
+            state = found
+        LOGGER.debug('vmware_log:%s start:%s size:%s state:%s',
+                     vmware_log, start, stat.st_size, state)
+
+        cache = {'inode': stat.st_ino, 'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+                 'offset': offset, 'state': state}
+        try:
+            with open(cache_file, 'w') as the_file:
+                json.dump(cache, the_file)
+        except IOError:
+            pass
+        return state